@@ -0,0 +1,608 @@
+import argparse
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import re
+import resource
+import shlex
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import urllib.request
+from pathlib import Path
+
+import numpy as np
+
+import music
+
+def make_audio_file(directory, size_mb, source_dir="data/raw"):
+    """Concatenate the sample clips into one file of roughly size_mb to stand in for a long recording"""
+    sources = sorted(Path(source_dir).glob("song_*.opus"))
+    path = Path(directory) / f"long_{size_mb}mb.opus"
+    target = int(size_mb * 1e6)
+    written = 0
+    with open(path, 'wb') as out:
+        while written < target:
+            for source in sources:
+                data = source.read_bytes()
+                out.write(data)
+                written += len(data)
+                if written >= target:
+                    break
+    return path
+
+def measure(fn):
+    """Run fn once under tracemalloc; returns (seconds, peak Python heap bytes, fn's result)"""
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = fn()
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak, result
+
+def bench_payload_memory(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(args.file) if args.file else make_audio_file(tmp, args.size_mb)
+        size = path.stat().st_size
+
+        def in_memory():
+            # What the original analyze_audio did: base64 the whole file, then requests' json= dump
+            return len(json.dumps(music.build_payload(path, 20)).encode('utf-8'))
+
+        def streaming():
+            return sum(len(chunk) for chunk in music.PayloadBody(path, 20))
+
+        print(f"Audio: {path.name} ({size / 1e6:.1f} MB)")
+        print(f"{'mode':<12}{'body MB':>10}{'peak MB':>10}{'peak/audio':>12}{'seconds':>10}")
+        for name, fn in [("in-memory", in_memory), ("streaming", streaming)]:
+            elapsed, peak, body_size = measure(fn)
+            print(f"{name:<12}{body_size / 1e6:>10.1f}{peak / 1e6:>10.1f}{peak / size:>12.2f}{elapsed:>10.3f}")
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+@contextlib.contextmanager
+def mock_server(mock_args):
+    """Run mock_server.py in a subprocess; yields (chat-completions URL, stats URL)"""
+    port = free_port()
+    script = Path(__file__).with_name("mock_server.py")
+    proc = subprocess.Popen([sys.executable, str(script), "--port", str(port), *mock_args],
+                            stdout=subprocess.DEVNULL)
+    base = f"http://127.0.0.1:{port}"
+    try:
+        for _ in range(100):
+            try:
+                urllib.request.urlopen(f"{base}/stats")
+                break
+            except OSError:
+                time.sleep(0.05)
+        yield f"{base}/v1/chat/completions", f"{base}/stats"
+    finally:
+        proc.terminate()
+        proc.wait()
+
+def server_stats(stats_url):
+    with urllib.request.urlopen(stats_url) as response:
+        return json.load(response)
+
+def synthetic_jobs(n_songs, dispatched, source_dir="data/raw", copies=1):
+    """n_songs jobs cycling over the sample clips; records each job's dispatch time as it is pulled.
+    
+    With copies > 1, each clip (with its listener count) comes that many times in a row under
+    different song ids, like a catalog that ingested the same recording more than once.
+    """
+    sources = sorted(Path(source_dir).glob("song_*.opus"))
+    for i in range(n_songs):
+        song_id = f"song_{i + 1}"
+        dispatched[song_id] = time.perf_counter()
+        clip = i // copies
+        yield song_id, sources[clip % len(sources)], 10 + clip % 45
+
+def run_throughput_scenario(n_songs, url, music_argv):
+    """Runs in a fresh process so peak RSS belongs to this scenario alone"""
+    os.environ.setdefault("OPENROUTER_API_KEY", "bench")
+    music.OPENROUTER_URL = url
+    args = music.parse_args(music_argv)
+    dispatched, latencies, errors = {}, [], []
+    
+    def on_result(song_id, pred, error):
+        latencies.append(time.perf_counter() - dispatched[song_id])
+        if error is not None:
+            errors.append(error)
+    
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        components = music.run_predictions(synthetic_jobs(n_songs, dispatched), args, on_result)
+    elapsed = time.perf_counter() - start
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+    return {
+        "songs": n_songs,
+        "errors": len(errors),
+        "seconds": elapsed,
+        "songs_per_sec": n_songs / elapsed,
+        "p50": p50, "p95": p95, "p99": p99,
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "components": {label: component.stats() for label, component in components},
+    }
+
+def bench_throughput(args):
+    music_argv = [arg for arg in args.music_args if arg != "--"] or ["--workers", "64"]
+    # Every synthetic song reuses one of the 40 sample clips, so the response cache would
+    # turn most of the run into hits
+    if "--no-cache" not in music_argv:
+        music_argv.append("--no-cache")
+    results = []
+    with mock_server(shlex.split(args.mock_args)) as (url, stats_url):
+        ctx = multiprocessing.get_context("spawn")
+        print(f"music.py {' '.join(music_argv)} | mock_server.py {args.mock_args}")
+        print(f"{'songs':>7}{'errors':>8}{'songs/s':>9}{'p50 s':>8}{'p95 s':>8}{'p99 s':>8}"
+              f"{'RSS MB':>8}{'MB up':>9}{'MB down':>9}")
+        for n_songs in args.songs:
+            before = server_stats(stats_url)
+            with ctx.Pool(1) as pool:
+                result = pool.apply(run_throughput_scenario, (n_songs, url, music_argv))
+            after = server_stats(stats_url)
+            result["requests"] = after["requests"] - before["requests"]
+            result["bytes_up"] = after["bytes_in"] - before["bytes_in"]
+            result["bytes_down"] = after["bytes_out"] - before["bytes_out"]
+            results.append(result)
+            print(f"{n_songs:>7}{result['errors']:>8}{result['songs_per_sec']:>9.1f}{result['p50']:>8.2f}"
+                  f"{result['p95']:>8.2f}{result['p99']:>8.2f}{result['peak_rss_mb']:>8.0f}"
+                  f"{result['bytes_up'] / 1e6:>9.1f}{result['bytes_down'] / 1e6:>9.2f}")
+    for label, stats in results[-1]["components"].items():
+        print(f"{label}: {stats}")
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({"music_args": music_argv, "mock_args": args.mock_args, "results": results}, f, indent=2)
+        print(f"Wrote {args.output}")
+
+def make_long_track(directory, minutes, source_dir="data/raw"):
+    """Join sample clips with ffmpeg stream copy into one continuous Ogg Opus track of about `minutes`"""
+    sources = sorted(Path(source_dir).glob("song_*.opus"))
+    seconds, listing = 0.0, []
+    while seconds < minutes * 60:
+        source = sources[len(listing) % len(sources)]
+        listing.append(f"file '{source.resolve()}'")
+        seconds += music.ogg_opus_duration(source)
+    list_path = Path(directory) / "long.txt"
+    list_path.write_text("\n".join(listing) + "\n")
+    path = Path(directory) / f"long_{minutes:g}min.opus"
+    subprocess.run(["ffmpeg", "-nostdin", "-v", "error", "-y", "-f", "concat", "-safe", "0", "-i", str(list_path),
+                    "-c", "copy", "-map_metadata", "-1", "-f", "ogg", str(path)], check=True)
+    return path
+
+def bench_segments(args):
+    os.environ.setdefault("OPENROUTER_API_KEY", "bench")
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(args.file) if args.file else make_long_track(tmp, args.minutes)
+        print(f"Audio: {path.name} ({music.ogg_opus_duration(path) or 0:.0f}s, {path.stat().st_size / 1e6:.1f} MB), "
+              f"--workers {args.workers} | mock_server.py {args.mock_args}")
+        print(f"{'mode':<16}{'requests':>10}{'seconds':>10}{'speedup':>10}")
+        modes = [("full track", [])]
+        modes += [(f"{length:g}s segments", ["--segments", str(length), "--segment-align", args.align,
+                                             "--segment-dir", str(Path(tmp) / "segments")]) for length in args.lengths]
+        with mock_server(shlex.split(args.mock_args)) as (url, stats_url):
+            music.OPENROUTER_URL = url
+            baseline = None
+            for name, music_argv in modes:
+                music_args = music.parse_args(["--no-cache", "--workers", str(args.workers), *music_argv])
+                errors = []
+                before = server_stats(stats_url)
+                start = time.perf_counter()
+                with contextlib.redirect_stdout(io.StringIO()):
+                    music.run_predictions([("song_1", path, 20)], music_args,
+                                          lambda song_id, pred, error: errors.append(error) if error else None)
+                elapsed = time.perf_counter() - start
+                requests = server_stats(stats_url)["requests"] - before["requests"]
+                baseline = baseline or elapsed
+                print(f"{name:<16}{requests:>10}{elapsed:>10.2f}{baseline / elapsed:>9.1f}x"
+                      + (f"  ({len(errors)} failed: {errors[0]})" if errors else ""))
+
+def run_mode(n_songs, stats_url, music_argv, copies=1):
+    """Run synthetic songs through run_predictions in-process; returns the numbers the mode benchmarks print"""
+    music_args = music.parse_args(["--no-cache", *music_argv])
+    dispatched, latencies, errors = {}, [], []
+    
+    def on_result(song_id, pred, error):
+        latencies.append(time.perf_counter() - dispatched[song_id])
+        if error is not None:
+            errors.append(error)
+    
+    before = server_stats(stats_url)
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        components = dict(music.run_predictions(synthetic_jobs(n_songs, dispatched, copies=copies), music_args,
+                                                on_result))
+    elapsed = time.perf_counter() - start
+    after = server_stats(stats_url)
+    return {"seconds": elapsed, "p50": np.median(latencies), "p95": np.percentile(latencies, 95),
+            "p99": np.percentile(latencies, 99), "errors": errors, "cancelled": after["cancelled"] - before["cancelled"], "components": components, "requests": after["requests"] - before["requests"],
+            "bytes_up": after["bytes_in"] - before["bytes_in"], "bytes_down": after["bytes_out"] - before["bytes_out"]}
+
+def failures(result):
+    errors = result["errors"]
+    return f"  ({len(errors)} failed: {errors[0]})" if errors else ""
+
+def bench_excerpt(args):
+    os.environ.setdefault("OPENROUTER_API_KEY", "bench")
+    print(f"{args.songs} songs, --workers {args.workers} | mock_server.py {args.mock_args}")
+    print(f"{'mode':<20}{'seconds':>9}{'p50 s':>8}{'p95 s':>8}{'MB up':>8}{'excerpt ms/song':>17}")
+    with tempfile.TemporaryDirectory() as tmp, mock_server(shlex.split(args.mock_args)) as (url, stats_url):
+        music.OPENROUTER_URL = url
+        # Each budget runs with an empty excerpt cache, then again reusing what the first run cut
+        modes = [("full track", [])]
+        for budget in args.budgets:
+            excerpt_argv = ["--excerpt", f"{budget:g}", "--excerpt-window", f"{args.window:g}",
+                            "--excerpt-dir", str(Path(tmp) / f"excerpts-{budget:g}")]
+            modes += [(f"--excerpt {budget:g} new", excerpt_argv), (f"--excerpt {budget:g} cached", excerpt_argv)]
+        for name, music_argv in modes:
+            result = run_mode(args.songs, stats_url, ["--workers", str(args.workers), *music_argv])
+            excerpt = result["components"]["Stage timings"].sums.get("excerpt", 0.0) / args.songs * 1000
+            print(f"{name:<20}{result['seconds']:>9.2f}{result['p50']:>8.2f}{result['p95']:>8.2f}"
+                  f"{result['bytes_up'] / 1e6:>8.1f}{excerpt:>17.1f}" + failures(result))
+
+def bench_upload(args):
+    os.environ.setdefault("OPENROUTER_API_KEY", "bench")
+    print(f"{args.songs} songs, --workers {args.workers} | mock_server.py {args.mock_args}")
+    print(f"{'mode':<36}{'MB up':>8}{'vs json':>9}{'seconds':>9}{'p50 s':>8}{'encode ms/song':>16}")
+    with mock_server(shlex.split(args.mock_args)) as (url, stats_url):
+        music.OPENROUTER_URL = url
+        baseline = None
+        for mode in args.modes:
+            result = run_mode(args.songs, stats_url, ["--workers", str(args.workers), *shlex.split(mode)])
+            baseline = baseline or result["bytes_up"]
+            encode = result["components"]["Stage timings"].sums["encode"] / args.songs * 1000
+            print(f"{mode or 'json':<36}{result['bytes_up'] / 1e6:>8.1f}{result['bytes_up'] / baseline:>9.2f}"
+                  f"{result['seconds']:>9.2f}{result['p50']:>8.2f}{encode:>16.2f}" + failures(result))
+
+def bench_batch(args):
+    os.environ.setdefault("OPENROUTER_API_KEY", "bench")
+    print(f"{args.songs} songs, music.py {args.music_args} | mock_server.py {args.mock_args}")
+    print(f"{'batch size':>10}{'requests':>10}{'songs/s':>9}{'speedup':>9}{'p50 s':>8}{'MB up':>8}{'fallbacks':>11}")
+    with mock_server(shlex.split(args.mock_args)) as (url, stats_url):
+        music.OPENROUTER_URL = url
+        baseline = None
+        for size in args.sizes:
+            result = run_mode(args.songs, stats_url, [*shlex.split(args.music_args), "--batch-size", str(size)])
+            rate = args.songs / result["seconds"]
+            baseline = baseline or rate
+            batcher = result["components"].get("Batcher")
+            print(f"{size:>10}{result['requests']:>10}{rate:>9.1f}{rate / baseline:>8.1f}x{result['p50']:>8.2f}"
+                  f"{result['bytes_up'] / 1e6:>8.1f}{batcher.fallbacks if batcher else 0:>11}" + failures(result))
+
+def bench_stream(args):
+    os.environ.setdefault("OPENROUTER_API_KEY", "bench")
+    print(f"{args.songs} songs, --workers {args.workers}")
+    for mock_args in args.mock_args:
+        print(f"\nmock_server.py {mock_args}")
+        print(f"{'mode':<10}{'seconds':>9}{'p50 s':>8}{'p95 s':>8}{'KB down':>9}{'failed':>8}")
+        with mock_server(shlex.split(mock_args)) as (url, stats_url):
+            music.OPENROUTER_URL = url
+            for mode in ["", "--stream"]:
+                result = run_mode(args.songs, stats_url, ["--workers", str(args.workers), *shlex.split(mode)])
+                print(f"{mode or 'whole':<10}{result['seconds']:>9.2f}{result['p50']:>8.2f}{result['p95']:>8.2f}"
+                      f"{result['bytes_down'] / 1e3:>9.0f}{len(result['errors']):>8}")
+
+def bench_hedge(args):
+    os.environ.setdefault("OPENROUTER_API_KEY", "bench")
+    hedge_args = f"--hedge {args.percentile:g} --hedge-budget {args.budget:g}"
+    print(f"{args.songs} songs, {args.workers} in flight; hedged with {hedge_args}")
+    print("hedged = second copies sent per song, cancelled = requests the mock saw abandoned")
+    for mock_args in args.mock_args:
+        print(f"\nmock_server.py {mock_args}")
+        print(f"{'mode':<16}{'seconds':>9}{'p50 s':>8}{'p95 s':>8}{'p99 s':>8}{'hedged':>8}{'cancelled':>11}")
+        with mock_server(shlex.split(mock_args)) as (url, stats_url):
+            music.OPENROUTER_URL = url
+            for label, concurrency in [("threads", f"--workers {args.workers}"),
+                                       ("async", f"--async --max-in-flight {args.workers}")]:
+                for hedge in ["", hedge_args]:
+                    result = run_mode(args.songs, stats_url, shlex.split(f"{concurrency} {hedge}"))
+                    # Thread-mode losers may still be running, so the mock's request count isn't final yet
+                    hedger = result["components"].get("Hedger")
+                    hedged = hedger.hedges / args.songs if hedger else 0.0
+                    mode = label + (" hedged" if hedge else "")
+                    print(f"{mode:<16}{result['seconds']:>9.2f}{result['p50']:>8.2f}{result['p95']:>8.2f}"
+                          f"{result['p99']:>8.2f}{hedged:>8.1%}{result['cancelled']:>11}" + failures(result))
+
+def bench_coalesce(args):
+    os.environ.setdefault("OPENROUTER_API_KEY", "bench")
+    print(f"{args.songs} songs, --workers {args.workers} | mock_server.py {args.mock_args}")
+    print(f"{'copies':>6}  {'mode':<14}{'requests':>9}{'seconds':>9}{'p50 s':>8}{'p95 s':>8}{'coalesced':>11}")
+    with mock_server(shlex.split(args.mock_args)) as (url, stats_url):
+        music.OPENROUTER_URL = url
+        for copies in args.copies:
+            for mode in ["--no-coalesce", ""]:
+                result = run_mode(args.songs, stats_url, ["--workers", str(args.workers), *shlex.split(mode)], copies)
+                coalescer = result["components"].get("Coalescing")
+                print(f"{copies:>6}  {mode or 'coalesced':<14}{result['requests']:>9}{result['seconds']:>9.2f}"
+                      f"{result['p50']:>8.2f}{result['p95']:>8.2f}{coalescer.coalesced if coalescer else 0:>11}"
+                      + failures(result))
+
+def legacy_parse_content(content):
+    """The reply parser analyze_audio() used before parse_gems(), kept for comparison"""
+    try:
+        return json.loads(content)
+    except json.JSONDecodeError:
+        json_match = re.search(r'\{.*\}', content, re.DOTALL)
+        return json.loads(json_match.group()) if json_match else {}
+
+def reply_corpus(results):
+    """(name, replies) pairs: saved predictions rendered the ways models answer, plus adversarial replies"""
+    preds = [{emotion: pred[emotion] for emotion in music.EMOTIONS} for pred in results.values()]
+    compact = [json.dumps(pred) for pred in preds]
+    pretty = [json.dumps(pred, indent=2) for pred in preds]
+    sample = pretty[0]
+    return [
+        ("bare JSON", compact),
+        ("indented JSON", pretty),
+        ("code fence", [f"```json\n{reply}\n```" for reply in pretty]),
+        ("prose around", [f"Here is my estimate:\n{reply}\nThe clip is mostly calm." for reply in pretty]),
+        ("long chatter after", [reply + "\n\n" + "The strings suggest tenderness. " * 300 for reply in compact]),
+        ("cut off", [reply[:len(reply) * 3 // 5] for reply in compact]),
+        ("out of range", [reply.replace('"mean": 0.', '"mean": 7.', 2) for reply in compact]),
+        ("emotion missing", [json.dumps({k: v for k, v in pred.items() if k != "sadness"}) for pred in preds]),
+        ("brace in prose first", [f"Format: {{mean, std}}. Answer: {reply}" for reply in compact]),
+        ("braces in strings", ['{"note": "a } \\" {", ' + reply[1:] for reply in compact]),
+        ("no JSON", ["I'm sorry, I can't listen to audio files. " * 20]),
+        ("10 KB of '{'", ["{" * 10000]),
+        ("10 KB of '{\"'", ['{"' * 5000]),
+        ("5 KB of '{ ' first", ["Sure " + "{ " * 2500 + sample]),
+    ]
+
+def bench_parse(args):
+    with open(args.results) as f:
+        results = {song_id: pred for song_id, pred in json.load(f).items()
+                   if all(emotion in pred for emotion in music.EMOTIONS)}
+    print(f"{len(results)} saved predictions from {args.results}; us per reply, best of {args.repeat}")
+    print(f"{'reply':<22}{'legacy us':>10}{'legacy result':>16}{'parse_gems us':>15}{'parse_gems result':>20}")
+    for name, replies in reply_corpus(results):
+        row = [name]
+        for parse, describe in [(legacy_parse_content, describe_legacy), (music.parse_gems, describe_answer)]:
+            best, outcome = float("inf"), None
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                outcomes = [attempt(parse, reply) for reply in replies]
+                best = min(best, (time.perf_counter() - start) / len(replies))
+                outcome = describe(outcomes[0])
+            row += [best * 1e6, outcome]
+        print(f"{row[0]:<22}{row[1]:>10.1f}{row[2]:>16}{row[3]:>15.1f}{row[4]:>20}")
+
+def attempt(parse, reply):
+    try:
+        return parse(reply)
+    except Exception as e:
+        return e
+
+def describe_legacy(result):
+    if not isinstance(result, dict):
+        return type(result).__name__
+    return f"{sum(emotion in result for emotion in music.EMOTIONS)} emotions"
+
+def describe_answer(answer):
+    missing = len(answer.missing())
+    if not missing:
+        return "complete"
+    return f"re-ask {missing}" if answer.estimates else "rejected"
+
+def drop_page_cache(paths):
+    """Ask the kernel to drop cached pages of these (clean) files so the next read goes to disk"""
+    for path in paths:
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+
+def bench_read(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        raw = Path(tmp) / "raw"
+        raw.mkdir()
+        sources = [path.read_bytes() for path in sorted(Path("data/raw").glob("song_*.opus"))]
+        for i in range(args.songs):
+            (raw / f"song_{i + 1}.opus").write_bytes(sources[i % len(sources)])
+        pack_path = Path(tmp) / "raw.pack"
+        count, size = music.write_pack(raw, pack_path)
+        song_ids = [f"song_{i + 1}" for i in range(args.songs)]
+        files = [raw / f"{song_id}.opus" for song_id in song_ids]
+        pack = music.AudioPack(pack_path)
+
+        def read_files():
+            for path in files:
+                with open(path, 'rb') as f:
+                    yield f.read()
+
+        def read_pack():
+            for song_id in song_ids:
+                yield bytes(pack.get(song_id).data)
+
+        def slice_pack():
+            for song_id in song_ids:
+                yield pack.get(song_id)
+
+        print(f"{count} songs, {size / 1e6:.0f} MB, {'cold' if args.cold else 'warm'} page cache")
+        print(f"{'mode':<26}{'us/song':>10}{'p99 us':>10}{'songs/s':>12}")
+        for name, reader, paths in [("open(path).read()", read_files, files),
+                                    ("pack get() + bytes()", read_pack, [pack_path]),
+                                    ("pack get() (zero-copy)", slice_pack, [pack_path])]:
+            if args.cold:
+                drop_page_cache(paths)
+            times = []
+            items = reader()
+            start = time.perf_counter()
+            while True:
+                t0 = time.perf_counter()
+                if next(items, None) is None:
+                    break
+                times.append(time.perf_counter() - t0)
+            elapsed = time.perf_counter() - start
+            print(f"{name:<26}{np.mean(times) * 1e6:>10.1f}{np.percentile(times, 99) * 1e6:>10.1f}"
+                  f"{len(times) / elapsed:>12.0f}")
+        pack.close()
+
+def bench_route(args):
+    """Replay --backend route offline: local answers where the estimators agree, saved API rows elsewhere"""
+    truth, _ = music.load_ground_truth_and_listeners()
+    with open(args.api_results) as f:
+        api = {song_id: pred for song_id, pred in json.load(f).items()
+               if pred.get("_meta", {}).get("backend", "api") == "api"}
+    catalog = sorted(((path.stem, path) for path in Path("data/raw").glob("song_*.opus")),
+                     key=lambda song: music.song_number(song[0]))
+    with tempfile.TemporaryDirectory() as tmp:
+        # Without --feature-store, features are computed into a scratch store rather than the working directory
+        store = music.FeatureStore(args.feature_store or Path(tmp) / "features.arrow")
+        local = music.LocalBackend(store, truth, catalog)
+    songs = [(song_id, path) for song_id, path in catalog if song_id in truth and song_id in api]
+    song_ids = [song_id for song_id, _ in songs]
+    start = time.perf_counter()
+    estimates = [local.estimate(path) for _, path in songs]
+    local_ms = (time.perf_counter() - start) * 1000 / len(songs)
+    local_means = np.array([means for means, _ in estimates])
+    disagreement = np.array([d for _, d in estimates])
+    truth_means = music.emotion_array(truth, song_ids)[..., 0]
+    api_means = music.emotion_array(api, song_ids)[..., 0]
+    api_rmse = np.sqrt(np.mean((api_means - truth_means) ** 2))
+
+    print(f"{len(songs)} songs with truth and API results in {args.api_results}; "
+          f"local estimate {local_ms:.2f} ms/song (features cached)")
+    print(f"{'threshold':>10}{'local':>8}{'API calls':>11}{'RMSE':>9}{'vs API':>9}")
+    for threshold in sorted(args.thresholds):
+        escalate = disagreement > threshold
+        routed = np.where(escalate[:, None], api_means, local_means)
+        rmse = np.sqrt(np.mean((routed - truth_means) ** 2))
+        print(f"{threshold:>10g}{1 - escalate.mean():>8.0%}{int(escalate.sum()):>11}{rmse:>9.4f}{rmse - api_rmse:>+9.4f}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks for the music.py pipeline")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    payload = subparsers.add_parser("payload-memory", help="peak memory to build one request body")
+    payload.add_argument("--file", help="audio file to encode (default: synthetic file built from data/raw)")
+    payload.add_argument("--size-mb", type=float, default=100, help="size of the synthetic file (default: 100)")
+    payload.set_defaults(func=bench_payload_memory)
+
+    throughput = subparsers.add_parser(
+        "throughput", help="end-to-end songs/sec, latency percentiles, RSS and bytes against the mock server",
+        description="Extra arguments after -- are passed to music.py (default: --workers 64).")
+    throughput.add_argument("--songs", type=int, nargs="+", default=[40, 1000, 10000],
+                            help="run sizes (default: 40 1000 10000)")
+    throughput.add_argument("--mock-args", default="--latency 0.5 --jitter 0.5 --latency-dist lognormal --seed 0",
+                            help="arguments for mock_server.py")
+    throughput.add_argument("--output", help="also write the results as JSON")
+    throughput.add_argument("music_args", nargs=argparse.REMAINDER)
+    throughput.set_defaults(func=bench_throughput)
+
+    read = subparsers.add_parser("read", help="per-song audio read time: one file per song vs a --pack file")
+    read.add_argument("--songs", type=int, default=20000, help="number of songs (default: 20000)")
+    read.add_argument("--cold", action="store_true", help="drop the files from the page cache before each mode")
+    read.set_defaults(func=bench_read)
+
+    segments = subparsers.add_parser(
+        "segments", help="wall-clock time for one long track sent whole vs as concurrent --segments requests")
+    segments.add_argument("--file", help="audio file to analyze (default: sample clips joined into one track)")
+    segments.add_argument("--minutes", type=float, default=10, help="length of the joined track (default: 10)")
+    segments.add_argument("--lengths", type=float, nargs="+", default=[120, 60, 30],
+                          help="segment lengths in seconds (default: 120 60 30)")
+    segments.add_argument("--align", choices=["fixed", "beats"], default="fixed")
+    segments.add_argument("--workers", type=int, default=16, help="concurrent requests (default: 16)")
+    segments.add_argument("--mock-args", default="--latency 1.0 --seconds-per-mb 5 --seed 0",
+                          help="arguments for mock_server.py")
+    segments.set_defaults(func=bench_segments)
+
+    excerpt = subparsers.add_parser(
+        "excerpt", help="latency and upload for full tracks vs --excerpt against a mock that charges per MB of audio")
+    excerpt.add_argument("--songs", type=int, default=40, help="number of songs (default: 40)")
+    excerpt.add_argument("--workers", type=int, default=8, help="concurrent requests (default: 8)")
+    excerpt.add_argument("--budgets", type=float, nargs="+", default=[20],
+                         help="--excerpt budgets in seconds (default: 20)")
+    excerpt.add_argument("--window", type=float, default=10, help="--excerpt-window (default: 10)")
+    excerpt.add_argument("--mock-args", default="--latency 0.2 --seconds-per-mb 10 --seed 0",
+                         help="mock_server.py arguments (default: '--latency 0.2 --seconds-per-mb 10 --seed 0')")
+    excerpt.set_defaults(func=bench_excerpt)
+
+    upload = subparsers.add_parser(
+        "upload", help="bytes on the wire and latency for each request body format against a bandwidth-limited mock")
+    upload.add_argument("--songs", type=int, default=100, help="number of songs (default: 100)")
+    upload.add_argument("--workers", type=int, default=8, help="concurrent requests (default: 8)")
+    upload.add_argument("--modes", nargs="+",
+                        default=["", "--compress gzip", "--compress zstd", "--upload multipart",
+                                 "--upload multipart --compress zstd"],
+                        help="music.py arguments for each mode; the first is the baseline")
+    upload.add_argument("--mock-args", default="--latency 0.5 --uplink-mbps 5 --seed 0",
+                        help="arguments for mock_server.py")
+    upload.set_defaults(func=bench_upload)
+
+    batch = subparsers.add_parser(
+        "batch", help="songs/sec for multi-song requests of several sizes against a mock with a request quota")
+    batch.add_argument("--songs", type=int, default=200, help="number of songs (default: 200)")
+    batch.add_argument("--sizes", type=int, nargs="+", default=[1, 2, 4, 8, 16],
+                       help="--batch-size values; the first is the baseline (default: 1 2 4 8 16)")
+    batch.add_argument("--music-args", default="--workers 64 --rpm 60",
+                       help="arguments for music.py (default: --workers 64 --rpm 60)")
+    batch.add_argument("--mock-args", default="--latency 1.0 --jitter 0.2 --seconds-per-mb 1 --seed 0",
+                       help="arguments for mock_server.py")
+    batch.set_defaults(func=bench_batch)
+
+    stream = subparsers.add_parser(
+        "stream", help="time to result for whole vs streamed (--stream) responses from a token-by-token mock")
+    stream.add_argument("--songs", type=int, default=100, help="number of songs (default: 100)")
+    stream.add_argument("--workers", type=int, default=16, help="concurrent requests (default: 16)")
+    stream.add_argument("--mock-args", nargs="+",
+                        default=["--latency 0.5 --token-delay 0.01 --seed 0",
+                                 "--latency 0.5 --token-delay 0.01 --chatter-tokens 100 --seed 0",
+                                 "--latency 0.5 --token-delay 0.01 --broken-rate 0.2 --seed 0"],
+                        help="mock_server.py arguments for each scenario")
+    stream.set_defaults(func=bench_stream)
+
+    hedge = subparsers.add_parser(
+        "hedge", help="tail latency and extra requests with and without --hedge, against a mock with slow stragglers")
+    hedge.add_argument("--songs", type=int, default=400, help="number of songs (default: 400)")
+    hedge.add_argument("--workers", type=int, default=16, help="concurrent songs (default: 16)")
+    hedge.add_argument("--percentile", type=float, default=95, help="--hedge percentile (default: 95)")
+    hedge.add_argument("--budget", type=float, default=0.1, help="--hedge-budget (default: 0.1)")
+    hedge.add_argument("--mock-args", nargs="+",
+                       default=["--latency 0.5 --jitter 0.05 --slow-rate 0.03 --slow-latency 5 --seed 0",
+                                "--latency 0.5 --jitter 0.6 --latency-dist lognormal --seed 0"],
+                       help="mock_server.py arguments for each scenario")
+    hedge.set_defaults(func=bench_hedge)
+
+    coalesce = subparsers.add_parser(
+        "coalesce", help="requests and latency with and without coalescing, for catalogs with repeated recordings")
+    coalesce.add_argument("--songs", type=int, default=200, help="number of songs (default: 200)")
+    coalesce.add_argument("--workers", type=int, default=16, help="concurrent songs (default: 16)")
+    coalesce.add_argument("--copies", type=int, nargs="+", default=[1, 2, 4],
+                          help="consecutive songs sharing each recording (default: 1 2 4)")
+    coalesce.add_argument("--mock-args", default="--latency 0.5 --jitter 0.1 --seed 0",
+                          help="mock_server.py arguments (default: '--latency 0.5 --jitter 0.1 --seed 0')")
+    coalesce.set_defaults(func=bench_coalesce)
+
+    parse = subparsers.add_parser(
+        "parse", help="reply parsing time and outcome, legacy regex fallback vs parse_gems(), on clean and adversarial replies")
+    parse.add_argument("--results", default="gemini_output.json",
+                       help="saved predictions to render as replies (default: gemini_output.json)")
+    parse.add_argument("--repeat", type=int, default=5, help="timing repeats per reply type (default: 5)")
+    parse.set_defaults(func=bench_parse)
+
+    route = subparsers.add_parser(
+        "route", help="accuracy vs API calls for --backend route thresholds, replayed from saved API results")
+    route.add_argument("--api-results", default="gemini_output.json",
+                       help="predictions from --backend api (default: gemini_output.json)")
+    route.add_argument("--feature-store",
+                       help="feature store to reuse and extend, e.g. music.py's .cache/features.arrow "
+                            "(default: a temporary one)")
+    route.add_argument("--thresholds", type=float, nargs="+", default=[0, 0.05, 0.06, 0.07, 0.08, 0.1, 0.15, 1],
+                       help="disagreement thresholds to replay (default: 0 0.05 0.06 0.07 0.08 0.1 0.15 1)")
+    route.set_defaults(func=bench_route)
+
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,388 @@
+import argparse
+import base64
+import email.parser
+import email.policy
+import gzip
+import hashlib
+import json
+import math
+import random
+import re
+import select
+import socket
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+EMOTIONS = ['amazement', 'solemnity', 'tenderness', 'nostalgia', 'calmness',
+            'power', 'joyful_activation', 'tension', 'sadness']
+
+def fake_gems(seed_bytes, n_listeners):
+    """Deterministic GEMS prediction derived from the request audio, shaped like a real reply"""
+    rng = random.Random(hashlib.sha256(seed_bytes).digest())
+    result = {}
+    for emotion in EMOTIONS:
+        votes = sum(rng.random() < rng.random() for _ in range(n_listeners))
+        mean = votes / n_listeners
+        result[emotion] = {"mean": round(mean, 4), "std": round((mean * (1 - mean)) ** 0.5, 4)}
+    return result
+
+def extract_request(payload):
+    """Pull the prompt text and base64 audio out of a chat-completions payload"""
+    text, audio = "", ""
+    for part in payload["messages"][0]["content"]:
+        if part["type"] == "text":
+            text += part["text"]
+        elif part["type"] == "audio":
+            audio += part["audio"]["data"]
+    match = re.search(r"Assume N = (\d+) listeners", text)
+    return text, audio, int(match.group(1)) if match else 10
+
+def extract_batch(payload):
+    """[(label, audio, n_listeners)] for a multi-clip request, whose audio parts each follow a label line; [] otherwise"""
+    clips, label = [], None
+    for part in payload["messages"][0]["content"]:
+        if part["type"] == "text":
+            match = re.fullmatch(r"(\S+): N = (\d+) listeners", part["text"])
+            label = match.groups() if match else None
+        elif part["type"] == "audio" and label:
+            clips.append((label[0], part["audio"]["data"], int(label[1])))
+            label = None
+    return clips
+
+def decode_body(body, content_encoding):
+    """Undo a gzip or zstd Content-Encoding; raises ValueError for anything else"""
+    if content_encoding in ("", "identity"):
+        return body
+    if content_encoding == "gzip":
+        return gzip.decompress(body)
+    if content_encoding == "zstd":
+        import zstandard
+        return zstandard.ZstdDecompressor().decompressobj().decompress(body)
+    raise ValueError(f"unsupported Content-Encoding: {content_encoding}")
+
+def parse_multipart(body, content_type):
+    """Payload dict from a multipart upload, with the raw "audio" part inlined as base64 data"""
+    message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(
+        f"Content-Type: {content_type}\r\n\r\n".encode() + body)
+    parts = {part.get_param("name", header="content-disposition"): part.get_payload(decode=True)
+             for part in message.iter_parts()}
+    payload = json.loads(parts["payload"])
+    for part in payload["messages"][0]["content"]:
+        if part["type"] == "audio" and "part" in part["audio"]:
+            part["audio"]["data"] = base64.b64encode(parts[part["audio"].pop("part")]).decode()
+    return payload
+
+CHATTER = ("\n\nThese estimates are based on the tempo, instrumentation and dynamics of the clip; "
+           "listeners may of course differ in how strongly they respond to each emotion. ")
+
+def generate(content, chatter_tokens=0, broken=False, truncated=False):
+    """Split a reply into ~4-character tokens the way a model would emit it, optionally going wrong or rambling on"""
+    if broken:
+        # A generation that derails: the second emotion gets an impossible mean and the rest is noise
+        content = re.sub(r'("solemnity": \{"mean": )[0-9.]+', r'\g<1>7.5', content) + " ..." * 200
+    if truncated:
+        # Cut off part-way, as when the model runs out of output tokens
+        content = content[:len(content) * 3 // 5]
+    tokens = [content[i:i + 4] for i in range(0, len(content), 4)]
+    chatter = (CHATTER * (chatter_tokens * 4 // len(CHATTER) + 1))[:chatter_tokens * 4]
+    return tokens + [chatter[i:i + 4] for i in range(0, len(chatter), 4)]
+
+class RateWindow:
+    """Sliding one-minute request counter used to emulate the gateway's quota"""
+
+    def __init__(self, limit_per_min):
+        self.limit = limit_per_min
+        self.times = deque()
+        self.lock = threading.Lock()
+
+    def admit(self):
+        """Record a request; returns None if admitted, else seconds until a slot frees up"""
+        with self.lock:
+            now = time.monotonic()
+            while self.times and now - self.times[0] >= 60:
+                self.times.popleft()
+            if len(self.times) >= self.limit:
+                return 60 - (now - self.times[0])
+            self.times.append(now)
+            return None
+
+class Uplink:
+    """Shared client-to-server link of a given speed: each request body queues behind the ones before it"""
+
+    def __init__(self, mbps):
+        self.bytes_per_sec = mbps * 1e6 / 8
+        self.free_at = 0.0
+        self.lock = threading.Lock()
+
+    def delay(self, n_bytes):
+        """Seconds until a body of n_bytes that arrived now would have finished crossing the link"""
+        with self.lock:
+            now = time.monotonic()
+            self.free_at = max(self.free_at, now) + n_bytes / self.bytes_per_sec
+            return self.free_at - now
+
+class ServerStats:
+    """Request and byte counters exposed at GET /stats for benchmarks"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.cancelled = 0
+        self.status = {}
+
+    def record(self, status, bytes_in, bytes_out):
+        with self.lock:
+            self.requests += 1
+            self.bytes_in += bytes_in
+            self.bytes_out += bytes_out
+            self.status[str(status)] = self.status.get(str(status), 0) + 1
+
+    def record_cancelled(self, bytes_in):
+        """A request whose client hung up before it was answered"""
+        with self.lock:
+            self.requests += 1
+            self.bytes_in += bytes_in
+            self.cancelled += 1
+
+    def snapshot(self):
+        with self.lock:
+            return {"requests": self.requests, "bytes_in": self.bytes_in,
+                    "bytes_out": self.bytes_out, "cancelled": self.cancelled, "status": dict(self.status)}
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    latency = 0.0
+    jitter = 0.0
+    latency_dist = "normal"
+    slow_rate = 0.0
+    slow_latency = 0.0
+    error_rate = 0.0
+    throttle_rate = 0.0
+    retry_after = 1.0
+    seconds_per_mb = 0.0
+    batch_drop_rate = 0.0
+    token_delay = 0.0
+    chatter_tokens = 0
+    broken_rate = 0.0
+    truncate_rate = 0.0
+    rate_window = None
+    uplink = None
+    stats = None
+
+    def read_body(self):
+        if self.headers.get("Transfer-Encoding", "").lower() != "chunked":
+            return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        chunks = []
+        while True:
+            size = int(self.rfile.readline().split(b";")[0], 16)
+            if size == 0:
+                self.rfile.readline()
+                return b"".join(chunks)
+            chunks.append(self.rfile.read(size))
+            self.rfile.readline()
+
+    def sample_latency(self):
+        latency = self.sample_base_latency()
+        if self.slow_rate and random.random() < self.slow_rate:
+            latency += self.slow_latency
+        return latency
+
+    def sample_base_latency(self):
+        if self.latency <= 0:
+            return 0.0
+        if self.latency_dist == "constant":
+            return self.latency
+        if self.latency_dist == "exponential":
+            return random.expovariate(1 / self.latency)
+        if self.latency_dist == "lognormal":
+            # jitter is the log-space sigma; mu is chosen so the mean stays at latency
+            return random.lognormvariate(math.log(self.latency) - self.jitter ** 2 / 2, self.jitter)
+        return max(0.0, random.gauss(self.latency, self.jitter))
+
+    def think(self, seconds):
+        """Sleep like a model working on the reply; False if the client hung up in the meantime"""
+        deadline = time.monotonic() + seconds
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return True
+            readable, _, _ = select.select([self.connection], [], [], remaining)
+            if readable:
+                # The client sends nothing while it waits, so a readable socket is normally a hang-up
+                if not self.connection.recv(1, socket.MSG_PEEK):
+                    return False
+                time.sleep(max(0.0, deadline - time.monotonic()))
+                return True
+
+    def do_GET(self):
+        if self.path.rstrip("/") == "/stats":
+            return self.send_json(200, self.stats.snapshot(), record=False)
+        self.send_json(404, {"error": {"message": "not found"}}, record=False)
+
+    def do_POST(self):
+        body = self.read_body()
+        self.request_bytes = len(self.requestline) + len(str(self.headers)) + len(body) + 4
+        if self.uplink:
+            time.sleep(self.uplink.delay(self.request_bytes))
+        wait = self.rate_window.admit() if self.rate_window else None
+        if wait is None and random.random() < self.throttle_rate:
+            wait = self.retry_after
+        if wait is not None:
+            return self.send_json(429, {"error": {"message": "rate limited"}},
+                                  {"Retry-After": str(max(1, math.ceil(wait)))})
+
+        try:
+            body = decode_body(body, self.headers.get("Content-Encoding", "").lower())
+            content_type = self.headers.get("Content-Type", "")
+            if content_type.startswith("multipart/form-data"):
+                payload = parse_multipart(body, content_type)
+            else:
+                payload = json.loads(body)
+            clips = extract_batch(payload)
+            _, audio, n_listeners = extract_request(payload)
+        except (ValueError, KeyError, IndexError, OSError, TypeError) as e:
+            return self.send_json(400, {"error": {"message": f"bad request: {e}"}})
+
+        start = time.perf_counter()
+        # Real models spend time per second of audio, so longer uploads take longer to answer
+        if not self.think(self.sample_latency() + self.seconds_per_mb * len(audio) * 3 / 4 / 1e6):
+            return self.client_gone()
+        if random.random() < self.error_rate:
+            return self.send_json(random.choice([500, 502, 503]), {"error": {"message": "injected failure"}})
+        if clips:
+            # Each clip gets the answer a single-clip request would, so batching doesn't change results
+            content = json.dumps({label: fake_gems(clip.encode(), n) for label, clip, n in clips
+                                  if random.random() >= self.batch_drop_rate})
+        else:
+            content = json.dumps(fake_gems(audio.encode(), n_listeners))
+        followup = payload["messages"][1:]
+        if followup:
+            # A re-ask names the emotions it still needs; answer just those, and cleanly
+            wanted = re.search(r"only these keys: ([\w, ]+)\.", followup[-1]["content"])
+            keys = wanted.group(1).split(", ") if wanted else EMOTIONS
+            content = json.dumps({key: value for key, value in json.loads(content).items() if key in keys})
+            tokens = generate(content)
+        else:
+            tokens = generate(content, self.chatter_tokens, random.random() < self.broken_rate,
+                              random.random() < self.truncate_rate)
+        if payload.get("stream"):
+            return self.send_stream(tokens, (time.perf_counter() - start) * 1000)
+        if not self.think(self.token_delay * len(tokens)):
+            return self.client_gone()
+        processing_ms = (time.perf_counter() - start) * 1000
+        self.send_json(200, {"choices": [{"message": {"role": "assistant", "content": "".join(tokens)}}]},
+                       {"openai-processing-ms": f"{processing_ms:.1f}"})
+
+    def send_stream(self, tokens, processing_ms):
+        """Server-sent chat-completion chunks, one token each, token_delay apart; stops if the client hangs up"""
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.send_header("openai-processing-ms", f"{processing_ms:.1f}")
+        self.end_headers()
+        sent = 0
+        try:
+            for token in tokens:
+                event = {"choices": [{"index": 0, "delta": {"content": token}}]}
+                sent += self.send_chunk(f"data: {json.dumps(event)}\n\n".encode())
+                time.sleep(self.token_delay)
+            sent += self.send_chunk(b"data: [DONE]\n\n")
+            self.send_chunk(b"")
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+        if self.stats:
+            self.stats.record(200, self.request_bytes, sent)
+
+    def client_gone(self):
+        self.close_connection = True
+        if self.stats:
+            self.stats.record_cancelled(self.request_bytes)
+
+    def send_chunk(self, data):
+        self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+        self.wfile.flush()
+        return len(data)
+
+    def send_json(self, status, obj, headers=None, record=True):
+        data = json.dumps(obj).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+        if record and self.stats:
+            self.stats.record(status, self.request_bytes, len(data))
+
+    def log_message(self, format, *args):
+        pass
+
+class MockServer(ThreadingHTTPServer):
+    # The default listen backlog of 5 drops connections when hundreds of clients connect at once
+    request_queue_size = 1024
+    daemon_threads = True
+
+def make_server(host="127.0.0.1", port=8000, rpm_limit=None, uplink_mbps=None, **options):
+    """ThreadingHTTPServer whose handler uses the given MockHandler attributes (latency, error_rate, ...)"""
+    attrs = {"stats": ServerStats(), "rate_window": RateWindow(rpm_limit) if rpm_limit else None,
+             "uplink": Uplink(uplink_mbps) if uplink_mbps else None, **options}
+    handler = type("ConfiguredMockHandler", (MockHandler,), attrs)
+    return MockServer((host, port), handler)
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in for the OpenRouter chat-completions endpoint")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--latency", type=float, default=0.0, help="mean response latency in seconds")
+    parser.add_argument("--jitter", type=float, default=0.0,
+                        help="latency spread: std dev in seconds for normal, log-space sigma for lognormal")
+    parser.add_argument("--latency-dist", choices=["constant", "normal", "lognormal", "exponential"],
+                        default="normal", help="latency distribution (default: normal)")
+    parser.add_argument("--slow-rate", type=float, default=0.0,
+                        help="fraction of requests that stall for --slow-latency extra seconds")
+    parser.add_argument("--slow-latency", type=float, default=0.0, help="extra seconds a stalled request takes")
+    parser.add_argument("--error-rate", type=float, default=0.0,
+                        help="fraction of requests failed with a random 500/502/503")
+    parser.add_argument("--throttle-rate", type=float, default=0.0,
+                        help="fraction of requests randomly rejected with 429")
+    parser.add_argument("--retry-after", type=float, default=1.0, help="Retry-After seconds sent with injected 429s")
+    parser.add_argument("--seconds-per-mb", type=float, default=0.0,
+                        help="extra latency per MB of decoded request audio")
+    parser.add_argument("--uplink-mbps", type=float,
+                        help="hold each request as if its body crossed a shared client uplink of this speed")
+    parser.add_argument("--token-delay", type=float, default=0.0,
+                        help="seconds per ~4-character output token, streamed or not")
+    parser.add_argument("--chatter-tokens", type=int, default=0,
+                        help="prose tokens the model appends after its JSON")
+    parser.add_argument("--broken-rate", type=float, default=0.0,
+                        help="fraction of replies that derail: an out-of-range value, then noise")
+    parser.add_argument("--truncate-rate", type=float, default=0.0,
+                        help="fraction of replies cut off part-way through the JSON")
+    parser.add_argument("--batch-drop-rate", type=float, default=0.0,
+                        help="fraction of clips left out of multi-clip responses")
+    parser.add_argument("--rpm-limit", type=int, help="reject requests beyond this many per minute with 429")
+    parser.add_argument("--seed", type=int, help="seed for injected latency and failures")
+    args = parser.parse_args()
+    if args.seed is not None:
+        random.seed(args.seed)
+
+    server = make_server(args.host, args.port, args.rpm_limit, args.uplink_mbps, latency=args.latency, jitter=args.jitter,
+                         latency_dist=args.latency_dist, slow_rate=args.slow_rate, slow_latency=args.slow_latency,
+                         error_rate=args.error_rate,
+                         throttle_rate=args.throttle_rate, retry_after=args.retry_after,
+                         seconds_per_mb=args.seconds_per_mb, batch_drop_rate=args.batch_drop_rate,
+                         token_delay=args.token_delay, chatter_tokens=args.chatter_tokens,
+                         broken_rate=args.broken_rate, truncate_rate=args.truncate_rate)
+    print(f"Mock OpenRouter listening on http://{args.host}:{args.port}/v1/chat/completions")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,35 @@
 import argparse
+import asyncio
+import bisect
+import collections
+import contextlib
+import contextvars
+import functools
+import hashlib
 import json
+import math
 import os
+import re
+import shutil
+import sqlite3
+import struct
+import subprocess
 import base64
+import email.utils
+import itertools
+import mmap
+import random
+import sys
+import threading
+import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, FIRST_COMPLETED, wait
 from pathlib import Path
+import numpy as np
 import pandas as pd
 import requests
 
-OPENROUTER_URL = "https://llmfoundry.straive.com/openrouter/v1/chat/completions"
+OPENROUTER_URL = os.environ.get("OPENROUTER_URL", "https://llmfoundry.straive.com/openrouter/v1/chat/completions")
 MODEL_NAME = "google/gemini-3-pro-preview"
 
 def get_gems_prompt(n_listeners):
@@ -52,14 +75,84 @@ Output JSON schema:
   "sadness": {{ "mean": 0.0, "std": 0.0 }}
 }}"""
 
-def analyze_audio(audio_path, n_listeners):
+def get_batch_prompt(labels):
+    """Instructions for a multi-clip request: the single-clip prompt, answered once per labelled clip"""
+    return (f"You will receive {len(labels)} music audio clips. Each clip follows a line with its label and its "
+            f"listener count N, like \"{labels[0]}: N = 20 listeners\". Analyze every clip on its own, as described below.\n\n"
+            + get_gems_prompt("<the clip's N>")
+            + "\n\nReturn a single JSON object with exactly these keys: " + ", ".join(labels)
+            + ". The value for each key is that clip's result in the schema above.")
+
+class APIError(Exception):
+    def __init__(self, status_code, retry_after=None):
+        super().__init__(f"API error: {status_code}")
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+def parse_retry_after(value):
+    """Seconds to wait from a Retry-After header (delta-seconds or HTTP-date), or None"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+# Timings for the song being analyzed in the current thread/task; None when not measuring
+_stage_timings = contextvars.ContextVar("stage_timings", default=None)
+_tracer = None
+
+def enable_tracing():
+    """Emit an OpenTelemetry span per song and per stage (exporters are configured the usual OTel way)"""
+    global _tracer
+    try:
+        from opentelemetry import trace
+    except ImportError:
+        raise RuntimeError("--otel requires opentelemetry-api (pip install opentelemetry-api opentelemetry-sdk)")
+    _tracer = trace.get_tracer("music")
+
+@contextlib.contextmanager
+def timed(stage, exclude=()):
+    """Add the block's wall time to `stage` for the current song.
+
+    Time recorded for `exclude` stages inside the block (e.g. encoding the body while the
+    request streams it) is subtracted so no time is counted twice.
+    """
+    timings = _stage_timings.get()
+    if timings is None:
+        yield
+        return
+    with _tracer.start_as_current_span(stage) if _tracer else contextlib.nullcontext():
+        excluded = sum(timings.get(name, 0.0) for name in exclude)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            elapsed -= sum(timings.get(name, 0.0) for name in exclude) - excluded
+            timings[stage] = timings.get(stage, 0.0) + elapsed
+
+def record_server_time(headers):
+    """Server-side processing time, for gateways that report it (OpenAI-style header)"""
+    timings = _stage_timings.get()
+    value = headers.get("openai-processing-ms")
+    if timings is not None and value:
+        try:
+            timings["server"] = timings.get("server", 0.0) + float(value) / 1000
+        except ValueError:
+            pass
+
+def get_api_headers():
     api_key = os.environ.get("OPENROUTER_API_KEY")
     if not api_key:
         raise RuntimeError("OPENROUTER_API_KEY not set")
-    
-    with open(audio_path, 'rb') as f:
-        audio_b64 = base64.b64encode(f.read()).decode('utf-8')
-    
+    return {"Authorization": f"Bearer {api_key}","Content-Type": "application/json"}
+
+def make_payload(n_listeners, audio_b64, stream=False, followup=()):
     payload = {
         "model": MODEL_NAME,
         "messages": [{
@@ -70,20 +163,2389 @@ def analyze_audio(audio_path, n_listeners):
             ]
         }]
     }
+    # A re-ask continues the conversation after the first answer
+    payload["messages"].extend(followup)
+    if stream:
+        payload["stream"] = True
+    return payload
+
+def make_batch_payload(clips):
+    """Chat-completions payload for several (label, n_listeners, audio_b64) clips in one request"""
+    content = [{"type": "text", "text": get_batch_prompt([label for label, _, _ in clips])}]
+    for label, n_listeners, audio_b64 in clips:
+        content.append({"type": "text", "text": f"{label}: N = {n_listeners} listeners"})
+        content.append({"type": "audio", "audio": {"data": audio_b64, "format": "audio/ogg"}})
+    return {"model": MODEL_NAME, "messages": [{"role": "user", "content": content}]}
+
+def build_payload(audio_path, n_listeners):
+    with open(audio_path, 'rb') as f:
+        audio_b64 = base64.b64encode(f.read()).decode('utf-8')
     
-    headers = {"Authorization": f"Bearer {api_key}","Content-Type": "application/json"}
-    response = requests.post(OPENROUTER_URL, headers=headers, json=payload)
+    return make_payload(n_listeners, audio_b64)
+
+def is_audio_path(audio):
+    return isinstance(audio, (str, os.PathLike))
+
+def audio_size(audio):
+    """Size in bytes of an audio source: a file path, bytes-like data or a PackedAudio slice"""
+    return os.path.getsize(audio) if is_audio_path(audio) else len(audio)
+
+@contextlib.contextmanager
+def audio_buffer(audio):
+    """Zero-copy buffer over an audio source; files are memory-mapped for the duration of the block"""
+    if not is_audio_path(audio):
+        yield memoryview(audio.data if isinstance(audio, PackedAudio) else audio)
+    elif os.path.getsize(audio) == 0:
+        yield memoryview(b"")
+    else:
+        with open(audio, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            yield mm
+
+def ffmpeg_source(audio):
+    """(-i argument, stdin bytes) for ffmpeg: paths are read directly, in-memory audio is piped in"""
+    if is_audio_path(audio):
+        return str(audio), None
+    with audio_buffer(audio) as data:
+        return "pipe:0", bytes(data)
+
+B64_CHUNK_SIZE = 3 * 64 * 1024  # multiple of 3 so chunks encode without '=' padding
+
+def _audio_placeholder(i):
+    return f"\x00audio{i}\x00"
+
+class PayloadBody:
+    """Request body for one song, generated piecewise instead of built in memory.
+
+    The audio (a file, memory-mapped, or an in-memory buffer such as a PackedAudio slice) is
+    base64-encoded B64_CHUNK_SIZE bytes at a time between the
+    pre-serialised JSON pieces around it, so a request holds one encoded chunk rather than the
+    whole file, its base64 text and the JSON dump. The bytes are identical to
+    json.dumps(build_payload(...)), and since base64 length is known up front the body is sent
+    with a Content-Length. PayloadBody.batch() streams a multi-song body the same way.
+    """
     
-    if response.status_code != 200:
-        raise Exception(f"API error: {response.status_code}")
+    content_type = "application/json"
+    
+    def __init__(self, audio_path, n_listeners, stream=False, followup=()):
+        self._split(make_payload(n_listeners, _audio_placeholder(0), stream, followup), [audio_path])
+    
+    @classmethod
+    def batch(cls, clips):
+        """Body for a multi-song request; clips are (label, audio_path, n_listeners)"""
+        body = cls.__new__(cls)
+        body._split(make_batch_payload([(label, n_listeners, _audio_placeholder(i))
+                                        for i, (label, _, n_listeners) in enumerate(clips)]),
+                    [audio_path for _, audio_path, _ in clips])
+        return body
+    
+    def _split(self, payload, audio_paths):
+        self.audio_paths = audio_paths
+        self.audio_sizes = [audio_size(audio_path) for audio_path in audio_paths]
+        with timed("serialize"):
+            rest = json.dumps(payload)
+            self.pieces = []
+            for i in range(len(audio_paths)):
+                before, rest = rest.split(json.dumps(_audio_placeholder(i)))
+                self.pieces.append((before + '"').encode('utf-8'))
+                rest = '"' + rest
+            self.pieces.append(rest.encode('utf-8'))
+    
+    def __len__(self):
+        return sum(map(len, self.pieces)) + sum(4 * ((size + 2) // 3) for size in self.audio_sizes)
+    
+    def __iter__(self):
+        for piece, audio_path, size in zip(self.pieces, self.audio_paths, self.audio_sizes):
+            yield piece
+            if size:
+                with audio_buffer(audio_path) as data:
+                    for start in range(0, len(data), B64_CHUNK_SIZE):
+                        with timed("read"):
+                            chunk = data[start:start + B64_CHUNK_SIZE]
+                        with timed("encode"):
+                            encoded = base64.b64encode(chunk)
+                        yield encoded
+        yield self.pieces[-1]
     
-    content = response.json()['choices'][0]['message']['content']
+    async def aiter(self):
+        for chunk in self:
+            yield chunk
+
+class MultipartBody:
+    """multipart/form-data body for gateways that take the audio as a raw file part.
+
+    The JSON request goes in a "payload" part with the audio's data replaced by a reference to
+    the "audio" part, which carries the file bytes as they are: no base64, so about 25% fewer
+    bytes than PayloadBody. The length is known up front, as for PayloadBody.
+    """
+    
+    def __init__(self, audio_path, n_listeners, stream=False, followup=()):
+        self.audio_path = audio_path
+        self.audio_size = audio_size(audio_path)
+        boundary = os.urandom(16).hex()
+        self.content_type = f"multipart/form-data; boundary={boundary}"
+        with timed("serialize"):
+            payload = make_payload(n_listeners, None, stream, followup)
+            audio = payload["messages"][0]["content"][1]["audio"]
+            del audio["data"]
+            audio["part"] = "audio"
+            self.head = (f'--{boundary}\r\nContent-Disposition: form-data; name="payload"\r\n'
+                         f'Content-Type: application/json\r\n\r\n{json.dumps(payload)}\r\n'
+                         f'--{boundary}\r\nContent-Disposition: form-data; name="audio"; filename="audio.ogg"\r\n'
+                         f'Content-Type: audio/ogg\r\n\r\n').encode('utf-8')
+            self.tail = f'\r\n--{boundary}--\r\n'.encode('utf-8')
+    
+    def __len__(self):
+        return len(self.head) + self.audio_size + len(self.tail)
+    
+    def __iter__(self):
+        yield self.head
+        if self.audio_size:
+            with audio_buffer(self.audio_path) as data:
+                for start in range(0, len(data), B64_CHUNK_SIZE):
+                    with timed("read"):
+                        chunk = bytes(data[start:start + B64_CHUNK_SIZE])
+                    yield chunk
+        yield self.tail
+    
+    async def aiter(self):
+        for chunk in self:
+            yield chunk
+
+def make_compressor(encoding):
+    """Streaming compressor for a Content-Encoding.
+
+    Base64 of compressed audio has almost no repeated strings, so the gain is the entropy
+    coding of its 64-symbol alphabet: gzip runs Huffman-only (level 6 compresses no better at
+    a quarter of the speed) and zstd runs at level 1.
+    """
+    if encoding == "gzip":
+        return zlib.compressobj(6, zlib.DEFLATED, 31, 8, zlib.Z_HUFFMAN_ONLY)
+    if encoding == "zstd":
+        try:
+            import zstandard
+        except ImportError:
+            raise RuntimeError("--compress zstd requires zstandard (pip install zstandard)")
+        return zstandard.ZstdCompressor(level=1).compressobj()
+    raise ValueError(f"unknown content encoding: {encoding}")
+
+class CompressedBody:
+    """Another body compressed chunk by chunk as it streams, for Content-Encoding: gzip or zstd.
+
+    Only one chunk of the body is held at a time, compressed or not. The compressed length
+    isn't known until the end, so the body goes out with chunked transfer encoding.
+    """
+    
+    def __init__(self, body, encoding):
+        self.body = body
+        self.encoding = encoding
+        self.content_type = body.content_type
+    
+    def __iter__(self):
+        compressor = make_compressor(self.encoding)
+        for chunk in self.body:
+            with timed("encode"):
+                compressed = compressor.compress(chunk)
+            if compressed:
+                yield compressed
+        with timed("encode"):
+            compressed = compressor.flush()
+        yield compressed
+    
+    async def aiter(self):
+        for chunk in self:
+            yield chunk
+
+def request_body(audio_path, n_listeners, upload="json", compress=None, stream=False, followup=()):
+    """(body, headers) for one request: the API headers plus the body's content headers"""
+    body_type = MultipartBody if upload == "multipart" else PayloadBody
+    return with_headers(body_type(audio_path, n_listeners, stream, followup), compress)
+
+def with_headers(body, compress=None):
+    """(body, headers) for a request body, compressed on the way out if compress names an encoding"""
+    headers = {**get_api_headers(), "Content-Type": body.content_type}
+    if compress:
+        body = CompressedBody(body, compress)
+        headers["Content-Encoding"] = compress
+    else:
+        headers["Content-Length"] = str(len(body))
+    return body, headers
+
+class OutputError(Exception):
+    """The model's answer is unusable: malformed, out of range or incomplete"""
+
+def max_std(n_listeners=None):
+    """Largest std N binary ratings can have.
+
+    That is 0.5 as a population std but 0.5 * sqrt(N / (N - 1)) as a sample std (0.524 at
+    N = 11), and models give either, rounded to 4 decimals. Without N, the bound for N = 2.
+    """
+    n = n_listeners if isinstance(n_listeners, int) and n_listeners >= 2 else 2
+    return 0.5 * math.sqrt(n / (n - 1)) + 5e-5
+
+def check_emotion(emotion, value, n_listeners=None):
+    """Raise OutputError unless value is a valid {"mean", "std"} result for emotion from n_listeners ratings"""
+    if not isinstance(value, dict):
+        raise OutputError(f"{emotion}: expected an object, got {value!r}")
+    for field, upper in (("mean", 1.0), ("std", max_std(n_listeners))):
+        number = value.get(field)
+        if isinstance(number, bool) or not isinstance(number, (int, float)) or not 0 <= number <= upper:
+            raise OutputError(f"{emotion}: {field} {number!r} is not a number in [0, {upper:.4g}]")
+
+Estimate = collections.namedtuple("Estimate", ["mean", "std"])
+
+class GemsAnswer:
+    """A model reply checked against the GEMS schema.
+
+    estimates holds an Estimate of floats for every valid emotion and problems the reason
+    each invalid one was rejected; keys outside the schema are ignored. errors are problems
+    that can't be pinned on one emotion, such as text that isn't JSON. content is the reply
+    itself, kept so a re-ask can quote it back. n_listeners bounds the std (see max_std).
+    """
+    
+    def __init__(self, content="", n_listeners=None):
+        self.content = content
+        self.n_listeners = n_listeners
+        self.estimates = {}
+        self.problems = {}
+        self.errors = []
+    
+    @classmethod
+    def from_object(cls, obj, content="", n_listeners=None):
+        answer = cls(content, n_listeners)
+        if isinstance(obj, dict):
+            for emotion, value in obj.items():
+                answer.add(emotion, value)
+        else:
+            answer.errors.append(f"expected a JSON object, got {type(obj).__name__}")
+        return answer
+    
+    def add(self, emotion, value):
+        if emotion not in EMOTIONS:
+            return
+        try:
+            check_emotion(emotion, value, self.n_listeners)
+        except OutputError as e:
+            self.problems[emotion] = str(e)
+            self.estimates.pop(emotion, None)
+            return
+        self.estimates[emotion] = Estimate(float(value["mean"]), float(value["std"]))
+        self.problems.pop(emotion, None)
+    
+    def missing(self):
+        return [emotion for emotion in EMOTIONS if emotion not in self.estimates]
+    
+    def merge(self, other):
+        """Fill this answer's gaps from a re-ask's answer"""
+        for emotion in self.missing():
+            if emotion in other.estimates:
+                self.estimates[emotion] = other.estimates[emotion]
+                self.problems.pop(emotion, None)
+            elif emotion in other.problems:
+                self.problems[emotion] = other.problems[emotion]
+    
+    def describe(self):
+        return "; ".join(self.errors + [self.problems.get(emotion, f"{emotion}: missing") for emotion in self.missing()])
+    
+    def prediction(self):
+        """The answer as gemini_output.json stores it; raises OutputError unless every emotion is valid"""
+        if self.missing():
+            raise OutputError(f"unusable reply ({self.describe()})")
+        return {emotion: {"mean": self.estimates[emotion].mean, "std": self.estimates[emotion].std}
+                for emotion in EMOTIONS}
+
+_JSON_OBJECT_START = re.compile(r'\{\s*["}]')
+_json_decoder = json.JSONDecoder()
+
+def decode_first_object(content):
+    """(object, start) for the first JSON object in content, bare or wrapped in a code fence or prose.
+
+    (None, start) if the object starts at start but doesn't decode, (None, None) if there is none.
+    """
+    match = _JSON_OBJECT_START.search(content)
+    if not match:
+        return None, None
     try:
-        return json.loads(content)
+        return _json_decoder.raw_decode(content, match.start())[0], match.start()
     except json.JSONDecodeError:
-        import re
-        json_match = re.search(r'\{.*\}', content, re.DOTALL)
-        return json.loads(json_match.group()) if json_match else {}
+        return None, match.start()
+
+def parse_gems(content, n_listeners=None):
+    """GemsAnswer for a reply, in one linear pass over the text.
+
+    The object is decoded in place from its opening brace, so fences and prose around it cost
+    nothing. If it doesn't decode (cut off, or broken part-way), the complete members before
+    the break are salvaged with EmotionStreamParser, so a re-ask only needs the rest.
+    """
+    obj, start = decode_first_object(content)
+    if obj is not None:
+        return GemsAnswer.from_object(obj, content, n_listeners)
+    answer = GemsAnswer(content, n_listeners)
+    if start is None:
+        answer.errors.append("no JSON object in the reply")
+    else:
+        EmotionStreamParser(answer, stop_on_error=False).feed(content[start:])
+    return answer
+
+class EmotionStreamParser:
+    """Incremental parser for the GEMS JSON object as its text streams in.
+
+    Anything before the opening brace (prose, a code fence) is skipped; as in parse_gems, only a
+    brace followed by a key or "}" opens the object, so a preamble such as "Format: {mean, std}"
+    isn't taken for it. Each top-level member
+    is decoded and checked into a GemsAnswer as soon as its value closes, so a broken
+    generation can be cut off at its first bad emotion (stop_on_error), and feed() reports
+    completion as soon as all nine emotions are in, without waiting for the closing brace or
+    whatever the model adds after it.
+    """
+    
+    def __init__(self, answer=None, stop_on_error=True):
+        self.answer = answer or GemsAnswer()
+        self.stop_on_error = stop_on_error
+        self.text = ""
+        self.pos = 0
+        self.depth = 0
+        self.in_string = self.escaped = self.closed = False
+        self.member_start = None
+    
+    def feed(self, delta):
+        """Consume more text; returns True once there is nothing more worth reading"""
+        self.text += delta
+        text = self.text
+        for i in range(self.pos, len(text)):
+            char = text[i]
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif char == "\\":
+                    self.escaped = True
+                elif char == '"':
+                    self.in_string = False
+            elif char == '"':
+                if self.depth > 0:
+                    self.in_string = True
+            elif char == "{" or (char == "[" and self.depth > 0):
+                if self.depth == 0 and not _JSON_OBJECT_START.match(text, i):
+                    if text[i + 1:].strip():
+                        continue
+                    # Can't tell yet what follows the brace; look at it again with the next delta
+                    self.pos = i
+                    return False
+                self.depth += 1
+                if self.depth == 1:
+                    self.member_start = i + 1
+            elif char in "}]" and self.depth > 0:
+                self.depth -= 1
+                if self.depth == 1:
+                    self._member(text[self.member_start:i + 1])
+                    self.member_start = None
+                elif self.depth == 0:
+                    self._member(text[self.member_start:i] if self.member_start is not None else "")
+                    self.closed = True
+                else:
+                    continue
+                if self._done():
+                    self.pos = i + 1
+                    return True
+            elif char == "," and self.depth == 1:
+                if self.member_start is not None:
+                    self._member(text[self.member_start:i])
+                self.member_start = i + 1
+                if self._done():
+                    self.pos = i + 1
+                    return True
+        self.pos = len(text)
+        return False
+    
+    def _done(self):
+        answer = self.answer
+        return (self.closed or len(answer.estimates) == len(EMOTIONS)
+                or (self.stop_on_error and bool(answer.problems or answer.errors)))
+    
+    def _member(self, member):
+        if not member.strip():
+            return
+        try:
+            (emotion, value), = json.loads("{" + member + "}").items()
+        except ValueError as e:
+            self.answer.errors.append(f"malformed JSON member {member.strip()[:60]!r}: {e}")
+            return
+        self.answer.add(emotion, value)
+
+class StreamedResult:
+    """Server-sent chat-completion events -> content deltas -> EmotionStreamParser"""
+    
+    def __init__(self, n_listeners=None):
+        self.pending = b""
+        self.parser = EmotionStreamParser(GemsAnswer(n_listeners=n_listeners))
+    
+    def feed(self, chunk):
+        """Consume bytes from the stream; returns True once there is nothing more worth reading"""
+        with timed("parse"):
+            self.pending += chunk
+            *lines, self.pending = self.pending.split(b"\n")
+            for line in lines:
+                line = line.strip()
+                if not line.startswith(b"data:"):
+                    continue
+                data = line[5:].strip()
+                if data == b"[DONE]":
+                    return True
+                try:
+                    event = json.loads(data)
+                except ValueError:
+                    # A garbled event means the stream can't be trusted; retry it like a bad gateway
+                    raise APIError(502)
+                if "error" in event:
+                    raise APIError(event["error"].get("code", 502))
+                # Usage-only and keep-alive events carry no choices
+                choices = event.get("choices") or [{}]
+                delta = choices[0].get("delta", {}).get("content")
+                if delta and self.parser.feed(delta):
+                    return True
+        return False
+    
+    def answer(self):
+        self.parser.answer.content = self.parser.text
+        return self.parser.answer
+
+def reask_messages(answer):
+    """Conversation turns asking again for only the emotions the first answer got wrong or left out"""
+    missing = answer.missing()
+    return [{"role": "assistant", "content": answer.content},
+            {"role": "user", "content": f"Your answer did not give valid results for: {answer.describe()}. "
+                                        f"Reply with a JSON object containing only these keys: {', '.join(missing)}. "
+                                        f"Each must contain \"mean\" (0 to 1) and \"std\" (0 to 0.5). Return JSON only."}]
+
+class ResponseStats:
+    """How replies turned out: complete, completed by a targeted re-ask, or rejected"""
+    
+    def __init__(self):
+        self.complete = self.repaired = self.rejected = self.reasked_emotions = 0
+        self._lock = threading.Lock()
+    
+    def record(self, answer, reasked):
+        with self._lock:
+            self.reasked_emotions += reasked
+            if answer.missing():
+                self.rejected += 1
+            elif reasked:
+                self.repaired += 1
+            else:
+                self.complete += 1
+    
+    def stats(self):
+        return (f"{self.complete} complete, {self.repaired} completed by re-asking for "
+                f"{self.reasked_emotions} emotions in all, {self.rejected} rejected")
+
+_thread_local = threading.local()
+
+def get_session():
+    """Per-thread requests session so worker threads keep their connections alive between songs"""
+    session = getattr(_thread_local, "session", None)
+    if session is None:
+        session = _thread_local.session = requests.Session()
+    return session
+
+def request_gems(audio_path, n_listeners, upload="json", compress=None, stream=False, followup=()):
+    """One request for the song; the reply as a GemsAnswer"""
+    body, headers = request_body(audio_path, n_listeners, upload, compress, stream, followup)
+    # The body is read and encoded while it streams, so those stages are carved out of network
+    with timed("network", exclude=("read", "encode", "parse")):
+        response = get_session().post(OPENROUTER_URL, headers=headers, data=body, stream=stream)
+        record_server_time(response.headers)
+        if response.status_code != 200:
+            response.close()
+            raise APIError(response.status_code, parse_retry_after(response.headers.get("Retry-After")))
+        if stream:
+            # Closing mid-stream drops the connection rather than reading the model's trailing text
+            result = StreamedResult(n_listeners)
+            with response:
+                for chunk in response.iter_content(chunk_size=None):
+                    if result.feed(chunk):
+                        break
+            return result.answer()
+    
+    with timed("parse"):
+        return parse_gems(response.json()['choices'][0]['message']['content'], n_listeners)
+
+def analyze_audio(audio_path, n_listeners, upload="json", compress=None, stream=False, responses=None):
+    answer = request_gems(audio_path, n_listeners, upload, compress, stream)
+    # A reply with some valid emotions only needs the rest, not a whole new answer
+    reasked = len(answer.missing()) if answer.estimates else 0
+    if reasked:
+        answer.merge(request_gems(audio_path, n_listeners, upload, compress, stream, reask_messages(answer)))
+    if responses:
+        responses.record(answer, reasked)
+    return {**answer.prediction(), "_meta": provenance(n_listeners)}
+
+def make_async_client(max_in_flight):
+    """Pooled httpx client shared by every in-flight request; HTTP/2 is used when h2 is installed"""
+    try:
+        import httpx
+    except ImportError:
+        raise RuntimeError("--async requires httpx (pip install httpx)")
+    try:
+        import h2  # noqa: F401
+        http2 = True
+    except ImportError:
+        http2 = False
+    
+    limits = httpx.Limits(max_connections=max_in_flight, max_keepalive_connections=max_in_flight)
+    return httpx.AsyncClient(http2=http2, limits=limits, timeout=httpx.Timeout(None, connect=30.0))
+
+async def request_gems_async(client, audio_path, n_listeners, upload="json", compress=None, stream=False,
+                             followup=()):
+    body, headers = request_body(audio_path, n_listeners, upload, compress, stream, followup)
+    if stream:
+        with timed("network", exclude=("read", "encode", "parse")):
+            async with client.stream("POST", OPENROUTER_URL, headers=headers, content=body.aiter()) as response:
+                record_server_time(response.headers)
+                if response.status_code != 200:
+                    raise APIError(response.status_code, parse_retry_after(response.headers.get("Retry-After")))
+                result = StreamedResult(n_listeners)
+                async for chunk in response.aiter_bytes():
+                    if result.feed(chunk):
+                        break
+        return result.answer()
+    
+    with timed("network", exclude=("read", "encode")):
+        response = await client.post(OPENROUTER_URL, headers=headers, content=body.aiter())
+    record_server_time(response.headers)
+    
+    if response.status_code != 200:
+        raise APIError(response.status_code, parse_retry_after(response.headers.get("Retry-After")))
+    
+    with timed("parse"):
+        return parse_gems(response.json()['choices'][0]['message']['content'], n_listeners)
+
+async def analyze_audio_async(client, audio_path, n_listeners, upload="json", compress=None, stream=False,
+                              responses=None):
+    answer = await request_gems_async(client, audio_path, n_listeners, upload, compress, stream)
+    reasked = len(answer.missing()) if answer.estimates else 0
+    if reasked:
+        answer.merge(await request_gems_async(client, audio_path, n_listeners, upload, compress, stream,
+                                              reask_messages(answer)))
+    if responses:
+        responses.record(answer, reasked)
+    return {**answer.prediction(), "_meta": provenance(n_listeners)}
+
+def split_batch_content(content, labels, clips, responses=None):
+    """Per-clip results from a batch response, in label order; None where a clip's result is missing or invalid.
+
+    Complete results are counted in responses; the others are counted by their single-song retry.
+    Each result records the batch prompt's hash as batch_prompt_hash. Its prompt_hash stays the
+    single-song prompt's for its listener count: the batch prompt embeds that prompt's text and
+    gives each clip's N next to it, and keeping the hash lets stale_reason treat batched and
+    single-song rows alike instead of re-predicting one kind whenever --batch-size changes.
+    """
+    results, _ = decode_first_object(content)
+    if not isinstance(results, dict):
+        results = {}
+    answers = [GemsAnswer.from_object(results.get(label), n_listeners=n_listeners)
+               for label, (_, n_listeners) in zip(labels, clips)]
+    if responses:
+        for answer in answers:
+            if not answer.missing():
+                responses.record(answer, 0)
+    batch_hash = hashlib.sha256(get_batch_prompt(labels).encode('utf-8')).hexdigest()
+    return [None if answer.missing() else
+            {**answer.prediction(), "_meta": {**provenance(n_listeners), "batch_prompt_hash": batch_hash}}
+            for answer, (_, n_listeners) in zip(answers, clips)]
+
+def split_batch_response(response, labels, clips, responses=None):
+    """split_batch_content for a batch HTTP response; a malformed envelope marks every clip to retry alone"""
+    try:
+        content = response.json()['choices'][0]['message']['content']
+    except (ValueError, KeyError, IndexError, TypeError):
+        content = None
+    if not isinstance(content, str):
+        return [None] * len(clips)
+    return split_batch_content(content, labels, clips, responses)
+
+def analyze_batch(clips, compress=None, responses=None):
+    """Predictions for several (audio_path, n_listeners) clips from one request; None marks a clip to retry alone"""
+    labels = [f"clip_{i + 1}" for i in range(len(clips))]
+    body, headers = with_headers(PayloadBody.batch([(label, *clip) for label, clip in zip(labels, clips)]), compress)
+    with timed("network", exclude=("read", "encode")):
+        response = get_session().post(OPENROUTER_URL, headers=headers, data=body)
+    record_server_time(response.headers)
+    
+    if response.status_code != 200:
+        raise APIError(response.status_code, parse_retry_after(response.headers.get("Retry-After")))
+    
+    with timed("parse"):
+        return split_batch_response(response, labels, clips, responses)
+
+async def analyze_batch_async(client, clips, compress=None, responses=None):
+    labels = [f"clip_{i + 1}" for i in range(len(clips))]
+    body, headers = with_headers(PayloadBody.batch([(label, *clip) for label, clip in zip(labels, clips)]), compress)
+    with timed("network", exclude=("read", "encode")):
+        response = await client.post(OPENROUTER_URL, headers=headers, content=body.aiter())
+    record_server_time(response.headers)
+    
+    if response.status_code != 200:
+        raise APIError(response.status_code, parse_retry_after(response.headers.get("Retry-After")))
+    
+    with timed("parse"):
+        return split_batch_response(response, labels, clips, responses)
+
+# (path, size, mtime_ns) -> sha256, so a file is hashed at most once per process (seeded by the manifest)
+_known_hashes = {}
+
+def file_sha256(path):
+    """sha256 of an audio source; files are memoized by size and mtime, pack slices carry their own"""
+    if not is_audio_path(path):
+        if isinstance(path, PackedAudio):
+            return path.sha256
+        return hashlib.sha256(path).hexdigest()
+    stat = os.stat(path)
+    memo_key = (str(path), stat.st_size, stat.st_mtime_ns)
+    if memo_key in _known_hashes:
+        return _known_hashes[memo_key]
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    _known_hashes[memo_key] = h.hexdigest()
+    return _known_hashes[memo_key]
+
+def prompt_hash(n_listeners):
+    return hashlib.sha256(get_gems_prompt(n_listeners).encode('utf-8')).hexdigest()
+
+def provenance(n_listeners):
+    """_meta for an API prediction: the model and rendered prompt that produced it"""
+    return {"model": MODEL_NAME, "prompt_hash": prompt_hash(n_listeners)}
+
+def mark_audio(pred, step):
+    """Copy of pred with step prepended to the audio preparation steps recorded in _meta["audio"].
+
+    Layers call this on the way out, so the outermost step (segments, then excerpt, then
+    transcode) comes first, as in audio_settings().
+    """
+    meta = pred.get("_meta", {})
+    return {**pred, "_meta": {**meta, "audio": "+".join(filter(None, [step, meta.get("audio")]))}}
+
+def audio_settings(args):
+    """_meta["audio"] for rows this run sends through the API, or None when it sends whole source files.
+
+    Settings are recorded rather than whether a song's audio was actually changed (a track
+    within the excerpt budget is sent as it is), so a row can be checked without the audio.
+    """
+    steps = []
+    if args.segments:
+        steps.append(f"segments-{Segmenter.settings(args.segments, args.segment_align)}")
+    if args.excerpt:
+        steps.append(f"excerpt-{Excerpter.settings(args.excerpt, args.excerpt_window)}")
+    if args.transcode:
+        steps.append(f"transcode-{Transcoder.settings(args.transcode_bitrate, args.transcode_rate)}")
+    return "+".join(steps) or None
+
+def stale_reason(pred, n_listeners, backend="api", audio=None):
+    """Why a saved prediction wouldn't come from this run's backend, model, prompt and audio settings
+    (see audio_settings), or None if it would.
+
+    An API run escalates rows that --backend route answered locally. Rows that don't record a
+    model, such as those saved before provenance was kept, are taken as current rather than
+    paid for again.
+    """
+    meta = pred.get("_meta", {})
+    if meta.get("backend") == "local":
+        if backend == "api":
+            return "answered locally"
+        return f"model {meta['model']}" if meta.get("model", LocalBackend.MODEL) != LocalBackend.MODEL else None
+    if "model" not in meta or n_listeners is None:
+        return None
+    if meta["model"] != MODEL_NAME:
+        return f"model {meta['model']}"
+    if meta.get("prompt_hash") != prompt_hash(n_listeners):
+        return "prompt changed"
+    if meta.get("audio") != audio:
+        return f"audio {meta['audio']}" if meta.get("audio") else "whole-track audio"
+    return None
+
+def request_key(audio_hash, n_listeners):
+    """What determines a song's answer: audio content, model, prompt and listener count"""
+    parts = [audio_hash, MODEL_NAME, prompt_hash(n_listeners), n_listeners]
+    return hashlib.sha256(json.dumps(parts).encode('utf-8')).hexdigest()
+
+class ResponseCache:
+    """On-disk cache of parsed predictions keyed by audio content, model, prompt and listener count.
+
+    Entries are evicted least-recently-used once the cache grows past max_bytes. Recency is
+    kept in an OrderedDict, seeded from file mtimes (refreshed on every hit) so it survives
+    restarts. Safe to share between worker threads.
+    """
+    
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+        self.hits = self.misses = self.evictions = 0
+        self._lock = threading.Lock()
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        stats = sorted(((path.stat(), path) for path in self.cache_dir.glob("*/*.json")),
+                       key=lambda item: item[0].st_mtime)
+        self._entries = collections.OrderedDict((path, stat.st_size) for stat, path in stats)  # oldest first
+        self._total = sum(self._entries.values())
+        self._evict()
+    
+    def key(self, audio_hash, n_listeners):
+        return request_key(audio_hash, n_listeners)
+    
+    def _path(self, key):
+        return self.cache_dir / key[:2] / f"{key}.json"
+    
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, 'r') as f:
+                pred = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            with self._lock:
+                self.misses += 1
+            return None
+        now = time.time()
+        os.utime(path, (now, now))
+        with self._lock:
+            self.hits += 1
+            if path in self._entries:
+                self._entries.move_to_end(path)
+        return pred
+    
+    def put(self, key, pred):
+        path = self._path(key)
+        path.parent.mkdir(exist_ok=True)
+        data = json.dumps(pred)
+        tmp_path = path.with_suffix(f".{threading.get_ident()}.tmp")
+        with open(tmp_path, 'w') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        with self._lock:
+            self._total += len(data) - self._entries.pop(path, 0)
+            self._entries[path] = len(data)
+            self._evict()
+    
+    def _evict(self):
+        while self._total > self.max_bytes and self._entries:
+            path, size = self._entries.popitem(last=False)
+            path.unlink(missing_ok=True)
+            self._total -= size
+            self.evictions += 1
+    
+    def stats(self):
+        lookups = self.hits + self.misses
+        hit_rate = self.hits / lookups if lookups else 0.0
+        return (f"{self.hits} hits, {self.misses} misses ({hit_rate:.1%} hit rate), "
+                f"{self.evictions} evictions, {len(self._entries)} entries / {self._total / 1e6:.1f} MB")
+
+def analyze_audio_cached(cache, audio_path, n_listeners, analyze=analyze_audio):
+    with timed("cache"):
+        key = cache.key(file_sha256(audio_path), n_listeners)
+        pred = cache.get(key)
+    if pred is None:
+        # analyze raises OutputError for an unusable reply, so only complete predictions are cached
+        pred = analyze(audio_path, n_listeners)
+        cache.put(key, pred)
+    else:
+        # Entries cached before predictions recorded their provenance; the key vouches for it
+        pred.setdefault("_meta", provenance(n_listeners))
+    return pred
+
+async def analyze_audio_cached_async(cache, client, audio_path, n_listeners, analyze=analyze_audio_async):
+    with timed("cache"):
+        key = cache.key(await asyncio.to_thread(file_sha256, audio_path), n_listeners)
+        pred = await asyncio.to_thread(cache.get, key)
+    if pred is None:
+        pred = await analyze(client, audio_path, n_listeners)
+        await asyncio.to_thread(cache.put, key, pred)
+    else:
+        pred.setdefault("_meta", provenance(n_listeners))
+    return pred
+
+class _Flight:
+    def __init__(self, event_type):
+        self.done = event_type()
+        self.result = self.error = None
+
+class SingleFlight:
+    """Shares one in-flight call among concurrent songs with identical audio.
+    
+    Calls are keyed by request_key(), like response-cache entries. The first caller for a key
+    makes the call; callers arriving while it runs wait for its result (or its error) instead
+    of sending their own. Nothing is kept once the call returns, so only duplicates that
+    overlap in time are caught; the response cache covers later ones.
+    """
+    
+    def __init__(self):
+        self.calls = self.coalesced = 0
+        self._flights = {}
+        self._lock = threading.Lock()
+    
+    def _join(self, key, event_type):
+        """(flight, is_leader) for the call in flight under key, starting one if there is none"""
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None:
+                self.coalesced += 1
+                return flight, False
+            self.calls += 1
+            flight = self._flights[key] = _Flight(event_type)
+            return flight, True
+    
+    def _land(self, key, flight):
+        with self._lock:
+            del self._flights[key]
+        flight.done.set()
+    
+    def _shared(self, flight):
+        if flight.error is not None:
+            raise flight.error
+        # Every song gets its own row, so layers above can annotate one without touching the others
+        return dict(flight.result)
+    
+    def analyze(self, audio_path, n_listeners, analyze=analyze_audio):
+        with timed("coalesce"):
+            key = request_key(file_sha256(audio_path), n_listeners)
+        flight, leader = self._join(key, threading.Event)
+        if not leader:
+            with timed("network"):
+                flight.done.wait()
+            return self._shared(flight)
+        try:
+            flight.result = analyze(audio_path, n_listeners)
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            self._land(key, flight)
+        return flight.result
+    
+    async def analyze_async(self, client, audio_path, n_listeners, analyze=analyze_audio_async):
+        with timed("coalesce"):
+            key = request_key(await asyncio.to_thread(file_sha256, audio_path), n_listeners)
+        flight, leader = self._join(key, asyncio.Event)
+        if not leader:
+            with timed("network"):
+                await flight.done.wait()
+            return self._shared(flight)
+        try:
+            flight.result = await analyze(client, audio_path, n_listeners)
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            self._land(key, flight)
+        return flight.result
+    
+    def stats(self):
+        songs = self.calls + self.coalesced
+        return (f"{self.coalesced} of {songs} songs shared a call already in flight for identical audio "
+                f"({self.coalesced / max(songs, 1):.1%} fewer calls)")
+
+class Transcoder:
+    """Re-encodes audio to low-bitrate Opus with ffmpeg before upload, caching results on disk.
+
+    Outputs are keyed by the source's sha256 and the encoder settings, so each source is
+    transcoded once per setting. Metadata is stripped and bit-exact flags are set so the same
+    input gives the same bytes (and the same response-cache key) on every run.
+    """
+    
+    def __init__(self, cache_dir, bitrate="16k", sample_rate=16000, channels=1):
+        self.ffmpeg = shutil.which("ffmpeg")
+        if not self.ffmpeg:
+            raise RuntimeError("--transcode requires ffmpeg on PATH")
+        self.cache_dir = Path(cache_dir)
+        self.args = ["-ac", str(channels), "-ar", str(sample_rate), "-c:a", "libopus", "-b:a", bitrate,
+                     "-application", "audio"]
+        self.tag = self.settings(bitrate, sample_rate, channels)
+        self.transcoded = self.reused = self.kept_original = 0
+        self.bytes_in = self.bytes_out = 0
+        self._lock = threading.Lock()
+    
+    @staticmethod
+    def settings(bitrate="16k", sample_rate=16000, channels=1):
+        """Tag for the encoder settings, used in cache file names and in _meta["audio"]"""
+        return f"{channels}ch-{sample_rate}hz-{bitrate}"
+    
+    def prepare(self, audio_path):
+        """Path to upload for audio_path: its transcoded copy, or the original if that is already smaller"""
+        sha = file_sha256(audio_path)
+        out_path = self.cache_dir / sha[:2] / f"{sha}-{self.tag}.opus"
+        reused = out_path.exists()
+        if not reused:
+            out_path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = out_path.with_suffix(f".{threading.get_ident()}.tmp")
+            source, stdin = ffmpeg_source(audio_path)
+            cmd = [self.ffmpeg, "-nostdin", "-v", "error", "-y", "-i", source, *self.args,
+                   "-map_metadata", "-1", "-fflags", "+bitexact", "-flags:a", "+bitexact", "-f", "ogg", str(tmp_path)]
+            result = subprocess.run(cmd, capture_output=True, input=stdin)
+            if result.returncode != 0:
+                tmp_path.unlink(missing_ok=True)
+                raise RuntimeError(f"ffmpeg failed on {audio_path}: {result.stderr.decode(errors='replace').strip()}")
+            os.replace(tmp_path, out_path)
+        source_size, out_size = audio_size(audio_path), os.path.getsize(out_path)
+        keep_original = out_size >= source_size
+        with self._lock:
+            if reused:
+                self.reused += 1
+            else:
+                self.transcoded += 1
+            self.kept_original += keep_original
+            self.bytes_in += source_size
+            self.bytes_out += min(source_size, out_size)
+        return audio_path if keep_original else out_path
+    
+    def stats(self):
+        saved = 1 - self.bytes_out / self.bytes_in if self.bytes_in else 0.0
+        return (f"{self.transcoded} transcoded, {self.reused} reused, {self.kept_original} already smaller "
+                f"than {self.tag}; upload {self.bytes_in / 1e6:.1f} MB -> {self.bytes_out / 1e6:.1f} MB "
+                f"({saved:.0%} smaller)")
+
+def analyze_audio_transcoded(transcoder, audio_path, n_listeners, analyze=analyze_audio):
+    with timed("transcode"):
+        audio_path = transcoder.prepare(audio_path)
+    return mark_audio(analyze(audio_path, n_listeners), f"transcode-{transcoder.tag}")
+
+async def analyze_audio_transcoded_async(transcoder, client, audio_path, n_listeners, analyze=analyze_audio_async):
+    with timed("transcode"):
+        audio_path = await asyncio.to_thread(transcoder.prepare, audio_path)
+    return mark_audio(await analyze(client, audio_path, n_listeners), f"transcode-{transcoder.tag}")
+
+def decode_audio(path, sample_rate=16000, ffmpeg="ffmpeg"):
+    """Mono float32 samples in [-1, 1) decoded with ffmpeg"""
+    source, stdin = ffmpeg_source(path)
+    cmd = [ffmpeg, "-nostdin", "-v", "error", "-i", source, "-f", "s16le", "-ac", "1", "-ar", str(sample_rate), "-"]
+    result = subprocess.run(cmd, capture_output=True, input=stdin)
+    if result.returncode != 0:
+        raise RuntimeError(f"ffmpeg failed on {path}: {result.stderr.decode(errors='replace').strip()}")
+    return np.frombuffer(result.stdout, dtype=np.int16).astype(np.float32) / 32768
+
+def frame_features(samples, frame=1024, hop=512, block=2048):
+    """Per-frame RMS energy and spectral flux (onset novelty), computed block-wise to bound memory"""
+    if len(samples) < frame:
+        samples = np.pad(samples, (0, frame - len(samples)))
+    frames = np.lib.stride_tricks.sliding_window_view(samples, frame)[::hop]
+    window = np.hanning(frame).astype(np.float32)
+    rms = np.empty(len(frames))
+    flux = np.zeros(len(frames))
+    previous = None
+    for start in range(0, len(frames), block):
+        chunk = frames[start:start + block]
+        rms[start:start + len(chunk)] = np.sqrt(np.mean(chunk ** 2, axis=1))
+        spectrum = np.log1p(np.abs(np.fft.rfft(chunk * window, axis=1)))
+        if previous is not None:
+            spectrum = np.vstack([previous, spectrum])
+        rise = np.maximum(np.diff(spectrum, axis=0), 0).sum(axis=1)
+        flux[start + (previous is None):start + len(chunk)] = rise
+        previous = spectrum[-1:]
+    return rms, flux
+
+def select_excerpts(samples, sample_rate, budget, window, hop=512):
+    """Pick up to budget seconds of non-overlapping windows that score highest on energy plus novelty.
+
+    Returns sorted (start, end) pairs in seconds, or None when the whole track fits the budget.
+    """
+    duration = len(samples) / sample_rate
+    if duration <= budget:
+        return None
+    window = min(window, budget)
+    rms, flux = frame_features(samples, hop=hop)
+    score = sum((x - x.mean()) / (x.std() or 1) for x in (rms, flux))
+    width = max(1, min(len(score), round(window * sample_rate / hop)))
+    window_scores = np.convolve(score, np.ones(width) / width, mode='valid')
+    starts = []
+    for _ in range(int(budget // window)):
+        i = int(np.argmax(window_scores))
+        if window_scores[i] == -np.inf:
+            break
+        starts.append(i)
+        window_scores[max(0, i - width + 1):i + width] = -np.inf
+    return [(i * hop / sample_rate, min(duration, i * hop / sample_rate + window)) for i in sorted(starts)]
+
+class Excerpter:
+    """Cuts tracks longer than a duration budget down to their most representative windows before upload.
+
+    Windows are scored locally (see select_excerpts) and joined with short fades into one Opus
+    file at the source's own bitrate, so bytes shrink in proportion to seconds. Excerpts and
+    a JSON sidecar with the chosen windows are cached by source sha256 and settings.
+    """
+    
+    ANALYSIS_RATE = 16000
+    FADE = 0.02
+    
+    def __init__(self, cache_dir, budget=30.0, window=10.0):
+        self.ffmpeg = shutil.which("ffmpeg")
+        if not self.ffmpeg:
+            raise RuntimeError("--excerpt requires ffmpeg on PATH")
+        self.cache_dir = Path(cache_dir)
+        self.budget, self.window = budget, window
+        self.tag = self.settings(budget, window)
+        self.excerpted = self.reused = self.within_budget = 0
+        self.seconds_in = self.seconds_out = self.seconds_local = 0.0
+        self.bytes_in = self.bytes_out = 0
+        self._lock = threading.Lock()
+    
+    @staticmethod
+    def settings(budget=30.0, window=10.0):
+        return f"{budget:g}s-{window:g}w"
+    
+    def prepare(self, audio_path):
+        """Path to upload for audio_path: a cached or fresh excerpt, or the original if it fits the budget"""
+        duration = ogg_opus_duration(audio_path)
+        windows = None
+        reused = False
+        if duration is None or duration > self.budget:
+            sha = file_sha256(audio_path)
+            out_path = self.cache_dir / sha[:2] / f"{sha}-{self.tag}.opus"
+            sidecar = out_path.with_suffix(".json")
+            reused = sidecar.exists()
+            if reused:
+                with open(sidecar, 'r') as f:
+                    info = json.load(f)
+            else:
+                start = time.perf_counter()
+                info = self._excerpt(audio_path, out_path)
+                with self._lock:
+                    self.seconds_local += time.perf_counter() - start
+                out_path.parent.mkdir(parents=True, exist_ok=True)
+                tmp_path = sidecar.with_name(f"{sidecar.name}.{threading.get_ident()}.tmp")
+                with open(tmp_path, 'w') as f:
+                    json.dump(info, f)
+                os.replace(tmp_path, sidecar)
+            duration, windows = info["duration"], info["windows"]
+        
+        source_size = audio_size(audio_path)
+        out_size = os.path.getsize(out_path) if windows else source_size
+        with self._lock:
+            if not windows:
+                self.within_budget += 1
+            elif reused:
+                self.reused += 1
+            else:
+                self.excerpted += 1
+            self.seconds_in += duration
+            self.seconds_out += sum(end - start for start, end in windows) if windows else duration
+            self.bytes_in += source_size
+            self.bytes_out += out_size
+        return out_path if windows else audio_path
+    
+    def _excerpt(self, audio_path, out_path):
+        samples = decode_audio(audio_path, self.ANALYSIS_RATE, self.ffmpeg)
+        duration = len(samples) / self.ANALYSIS_RATE
+        windows = select_excerpts(samples, self.ANALYSIS_RATE, self.budget, self.window)
+        if windows is None:
+            return {"duration": duration, "windows": None}
+        
+        # Trim each window, fade its edges so the joins don't click, and concatenate
+        graph = []
+        for i, (start, end) in enumerate(windows):
+            fade_out = max(0.0, end - start - self.FADE)
+            graph.append(f"[0:a]atrim=start={start:.4f}:end={end:.4f},asetpts=PTS-STARTPTS,"
+                         f"afade=t=in:d={self.FADE},afade=t=out:st={fade_out:.4f}:d={self.FADE}[a{i}]")
+        graph.append("".join(f"[a{i}]" for i in range(len(windows))) + f"concat=n={len(windows)}:v=0:a=1[out]")
+        # Keep the source's bitrate so the excerpt costs what its seconds cost in the original
+        bitrate = min(256000, max(6000, round(audio_size(audio_path) * 8 / max(duration, 1e-3))))
+        
+        out_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = out_path.with_suffix(f".{threading.get_ident()}.tmp")
+        source, stdin = ffmpeg_source(audio_path)
+        cmd = [self.ffmpeg, "-nostdin", "-v", "error", "-y", "-i", source,
+               "-filter_complex", ";".join(graph), "-map", "[out]", "-c:a", "libopus", "-b:a", str(bitrate),
+               "-map_metadata", "-1", "-fflags", "+bitexact", "-flags:a", "+bitexact", "-f", "ogg", str(tmp_path)]
+        result = subprocess.run(cmd, capture_output=True, input=stdin)
+        if result.returncode != 0:
+            tmp_path.unlink(missing_ok=True)
+            raise RuntimeError(f"ffmpeg failed on {audio_path}: {result.stderr.decode(errors='replace').strip()}")
+        os.replace(tmp_path, out_path)
+        return {"duration": duration, "windows": [[round(start, 4), round(end, 4)] for start, end in windows]}
+    
+    def stats(self):
+        saved = 1 - self.bytes_out / self.bytes_in if self.bytes_in else 0.0
+        local = self.seconds_local / self.excerpted if self.excerpted else 0.0
+        return (f"{self.excerpted} excerpted, {self.reused} reused, {self.within_budget} within {self.budget:g}s; "
+                f"audio {self.seconds_in:.0f}s -> {self.seconds_out:.0f}s, upload {self.bytes_in / 1e6:.1f} MB -> "
+                f"{self.bytes_out / 1e6:.1f} MB ({saved:.0%} smaller), {local:.2f}s wall time per new excerpt "
+                f"(longer while other workers excerpt or transcode at the same time)")
+
+def analyze_audio_excerpted(excerpter, audio_path, n_listeners, analyze=analyze_audio):
+    with timed("excerpt"):
+        audio_path = excerpter.prepare(audio_path)
+    return mark_audio(analyze(audio_path, n_listeners), f"excerpt-{excerpter.tag}")
+
+async def analyze_audio_excerpted_async(excerpter, client, audio_path, n_listeners, analyze=analyze_audio_async):
+    with timed("excerpt"):
+        audio_path = await asyncio.to_thread(excerpter.prepare, audio_path)
+    return mark_audio(await analyze(client, audio_path, n_listeners), f"excerpt-{excerpter.tag}")
+
+def beat_grid(flux, frame_rate, min_bpm=60, max_bpm=180):
+    """(tempo in BPM, beat positions in frames) from the autocorrelation of an onset envelope"""
+    # Light smoothing so a period that falls between two frames still forms one peak
+    onset = np.convolve(flux - flux.mean(), np.hanning(5)[1:-1] / 2, mode='same')
+    acf = np.fft.irfft(np.abs(np.fft.rfft(onset, 2 * len(onset))) ** 2)[:len(onset)]
+    lags = np.arange(max(1, int(frame_rate * 60 / max_bpm)), min(len(onset) - 1, int(frame_rate * 60 / min_bpm) + 1))
+    if len(lags) == 0:
+        return 0.0, np.array([])
+    # A log-normal tempo prior centred on 120 BPM resolves the half/double-tempo ambiguity
+    prior = np.exp(-0.5 * np.log2(60 * frame_rate / lags / 120) ** 2)
+    period = float(lags[np.argmax(acf[lags] * prior)])
+    # Refine the period from the peak near its highest multiple that fits, then sub-frame interpolate
+    multiple = max(1, min(4, (len(onset) - 2) // int(period + 1)))
+    lo, hi = int(multiple * period) - multiple, int(multiple * period) + multiple + 1
+    peak = max(1, min(len(acf) - 2, lo + int(np.argmax(acf[lo:hi]))))
+    left, centre, right = acf[peak - 1:peak + 2]
+    curvature = left - 2 * centre + right
+    period = (peak + (0.5 * (left - right) / curvature if curvature < 0 else 0.0)) / multiple
+    # Phase: the grid offset that collects the most onset strength
+    grid = np.arange(0, len(onset) - 1, period)
+    phase = max(range(int(period)), key=lambda p: onset[np.minimum((grid + p).astype(int), len(onset) - 1)].sum())
+    return 60 * frame_rate / period, grid + phase
+
+def estimate_beats(samples, sample_rate, hop=512, min_bpm=60, max_bpm=180):
+    """(tempo in BPM, beat times in seconds) of mono samples"""
+    _, flux = frame_features(samples, hop=hop)
+    tempo, beats = beat_grid(flux, sample_rate / hop, min_bpm, max_bpm)
+    # Frame i is centred 1024 / 2 samples after its start
+    return tempo, beats * hop / sample_rate + 512 / sample_rate
+
+def segment_bounds(duration, length, beats=()):
+    """Boundaries every `length` seconds, each snapped to the nearest beat when beats are given.
+
+    A remainder shorter than half a segment is merged into the last segment.
+    """
+    count = max(1, int(duration // length) + (duration % length >= length / 2))
+    cuts = [length * i for i in range(1, count)]
+    if len(beats):
+        beats = np.asarray(beats)
+        cuts = sorted({float(beats[np.argmin(np.abs(beats - cut))]) for cut in cuts})
+    return [0.0, *(round(cut, 4) for cut in cuts if 0 < cut < duration), duration]
+
+class Segmenter:
+    """Splits tracks into fixed-length or beat-aligned segments for map-reduce analysis.
+
+    Segments are cut with ffmpeg's segment muxer using stream copy, so there is no re-encode and
+    the bytes per second match the source. Each split is cached in a directory keyed by source
+    sha256 and settings, with a segments.json index of the boundaries.
+    """
+    
+    ANALYSIS_RATE = 16000
+    
+    def __init__(self, cache_dir, length=30.0, align="fixed"):
+        self.ffmpeg = shutil.which("ffmpeg")
+        if not self.ffmpeg:
+            raise RuntimeError("--segments requires ffmpeg on PATH")
+        self.cache_dir = Path(cache_dir)
+        self.length, self.align = length, align
+        self.tag = self.settings(length, align)
+        self.split_count = self.reused = self.segments = 0
+        self.seconds = 0.0
+        self._lock = threading.Lock()
+    
+    @staticmethod
+    def settings(length=30.0, align="fixed"):
+        return f"{length:g}s-{align}"
+    
+    def split(self, audio_path):
+        """[(start, end, path)] covering audio_path; a track that fits in one segment is its own segment"""
+        sha = file_sha256(audio_path)
+        out_dir = self.cache_dir / sha[:2] / f"{sha}-{self.tag}"
+        index = out_dir / "segments.json"
+        reused = index.exists()
+        if reused:
+            with open(index, 'r') as f:
+                info = json.load(f)
+        else:
+            info = self._split(audio_path, out_dir)
+        bounds, files = info["bounds"], info["files"]
+        with self._lock:
+            self.split_count += not reused
+            self.reused += reused
+            self.segments += len(bounds) - 1
+            self.seconds += bounds[-1]
+        if files is None:
+            return [(bounds[0], bounds[-1], audio_path)]
+        return [(start, end, out_dir / name) for start, end, name in zip(bounds, bounds[1:], files)]
+    
+    def _split(self, audio_path, out_dir):
+        duration = ogg_opus_duration(audio_path) if self.align == "fixed" else None
+        beats = ()
+        if duration is None:
+            samples = decode_audio(audio_path, self.ANALYSIS_RATE, self.ffmpeg)
+            duration = len(samples) / self.ANALYSIS_RATE
+            if self.align == "beats":
+                beats = estimate_beats(samples, self.ANALYSIS_RATE)[1]
+        bounds = segment_bounds(duration, self.length, beats)
+        info = {"bounds": bounds, "files": None}
+        
+        tmp_dir = out_dir.with_name(f"{out_dir.name}.{threading.get_ident()}.tmp")
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        tmp_dir.mkdir(parents=True)
+        if len(bounds) > 2:
+            source, stdin = ffmpeg_source(audio_path)
+            cmd = [self.ffmpeg, "-nostdin", "-v", "error", "-i", source, "-map", "0:a", "-c", "copy",
+                   "-map_metadata", "-1", "-fflags", "+bitexact", "-f", "segment", "-segment_format", "ogg",
+                   "-segment_times", ",".join(f"{cut:.4f}" for cut in bounds[1:-1]), "-reset_timestamps", "1",
+                   str(tmp_dir / "%03d.opus")]
+            result = subprocess.run(cmd, capture_output=True, input=stdin)
+            files = sorted(path.name for path in tmp_dir.glob("*.opus"))
+            if result.returncode != 0 or len(files) != len(bounds) - 1:
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+                raise RuntimeError(f"ffmpeg failed to split {audio_path}: {result.stderr.decode(errors='replace').strip()}")
+            info["files"] = files
+        with open(tmp_dir / "segments.json", 'w') as f:
+            json.dump(info, f)
+        try:
+            os.rename(tmp_dir, out_dir)
+        except OSError:
+            # Another worker finished the same split first
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        return info
+    
+    def stats(self):
+        mean = self.seconds / self.segments if self.segments else 0.0
+        return (f"{self.split_count} split, {self.reused} reused ({self.tag}); {self.segments} segments, "
+                f"mean {mean:.1f}s")
+
+def reduce_segments(segments, preds):
+    """Duration-weighted GEMS aggregate of per-segment predictions.
+
+    The segments' listeners are pooled as one mixture: the mean is the weighted mean, and the
+    variance is the weighted mean of std² + mean² minus the pooled mean squared.
+    """
+    durations = np.array([end - start for start, end, _ in segments])
+    result = {}
+    for emotion in EMOTIONS:
+        found = [(weight, pred[emotion]["mean"], pred[emotion]["std"])
+                 for weight, pred in zip(durations, preds) if emotion in pred]
+        if not found:
+            continue
+        weights, means, stds = (np.array(column, dtype=float) for column in zip(*found))
+        weights /= weights.sum()
+        mean = weights @ means
+        variance = weights @ (stds ** 2 + means ** 2) - mean ** 2
+        result[emotion] = {"mean": round(float(mean), 4), "std": round(float(np.sqrt(max(variance, 0.0))), 4)}
+    if preds and "_meta" in preds[0]:
+        result["_meta"] = preds[0]["_meta"]
+    return result
+
+def segment_jobs(jobs, segmenter, on_result, on_segments=None, use_async=False):
+    """Map step: expand song jobs into per-segment jobs that run through the normal client stack.
+
+    Returns (segment jobs, per-segment callback). Once every segment of a song is in, the
+    callback reduces them and calls on_segments(song_id, series) then on_result(song_id,
+    aggregate, None); if any segment failed, on_result gets that error instead. With
+    use_async the segment jobs are an async iterator that splits in a worker thread, so
+    ffmpeg (and the decode for --segment-align) doesn't stall the event loop.
+    """
+    songs = {}
+    
+    def add(song_id, segments, n_listeners):
+        songs[song_id] = {"segments": segments, "preds": [None] * len(segments),
+                          "remaining": len(segments), "error": None}
+        return [(f"{song_id}@{i}", path, n_listeners) for i, (_, _, path) in enumerate(segments)]
+    
+    def expand():
+        for song_id, audio_file, n_listeners in jobs:
+            try:
+                segments = segmenter.split(audio_file)
+            except Exception as e:
+                on_result(song_id, None, e)
+                continue
+            yield from add(song_id, segments, n_listeners)
+    
+    async def expand_async():
+        for song_id, audio_file, n_listeners in jobs:
+            try:
+                segments = await asyncio.to_thread(segmenter.split, audio_file)
+            except Exception as e:
+                on_result(song_id, None, e)
+                continue
+            for job in add(song_id, segments, n_listeners):
+                yield job
+    
+    def on_segment_result(segment_id, pred, error):
+        song_id, i = segment_id.rsplit("@", 1)
+        song = songs[song_id]
+        song["preds"][int(i)] = pred
+        song["error"] = song["error"] or error
+        song["remaining"] -= 1
+        if song["remaining"]:
+            return
+        del songs[song_id]
+        if song["error"] is not None:
+            on_result(song_id, None, song["error"])
+            return
+        if on_segments:
+            on_segments(song_id, [{"start": start, "end": end, **{emotion: pred[emotion] for emotion in EMOTIONS}}
+                                  for (start, end, _), pred in zip(song["segments"], song["preds"])])
+        on_result(song_id, mark_audio(reduce_segments(song["segments"], song["preds"]), f"segments-{segmenter.tag}"),
+                  None)
+    
+    return expand_async() if use_async else expand(), on_segment_result
+
+def spectral_peaks(samples, frame=1024, hop=256, time_radius=8, freq_radius=6, peaks_per_frame=2.0, block=2048):
+    """(frame, bin) pairs of log-spectrogram local maxima, keeping the strongest peaks_per_frame on average"""
+    if len(samples) < frame:
+        samples = np.pad(samples, (0, frame - len(samples)))
+    frames = np.lib.stride_tricks.sliding_window_view(samples, frame)[::hop]
+    window = np.hanning(frame).astype(np.float32)
+    spectrum = np.concatenate([np.log1p(np.abs(np.fft.rfft(frames[start:start + block] * window, axis=1)))
+                               .astype(np.float32) for start in range(0, len(frames), block)])
+    # Separable max filter: a point is a peak if nothing in its time x frequency neighbourhood is louder
+    neighbourhood = spectrum.copy()
+    for axis, radius in ((0, time_radius), (1, freq_radius)):
+        source = neighbourhood.copy()
+        for shift in range(1, radius + 1):
+            for lo, hi in ((slice(shift, None), slice(None, -shift)), (slice(None, -shift), slice(shift, None))):
+                target = neighbourhood[(lo, slice(None)) if axis == 0 else (slice(None), lo)]
+                np.maximum(target, source[(hi, slice(None)) if axis == 0 else (slice(None), hi)], out=target)
+    times, bins = np.nonzero((spectrum == neighbourhood) & (spectrum > 0))
+    strength = spectrum[times, bins]
+    keep = min(len(times), int(peaks_per_frame * len(spectrum)))
+    chosen = np.sort(np.argsort(strength)[::-1][:keep])
+    return times[chosen], bins[chosen]
+
+def landmark_hashes(times, bins, fan_out=4, max_dt=63):
+    """Pair each peak with the next fan_out peaks: (uint32 hash of f1, f2, dt; anchor frame) arrays"""
+    order = np.lexsort((bins, times))
+    times, bins = times[order].astype(np.int64), bins[order].astype(np.int64)
+    hashes, anchors = [], []
+    for k in range(1, fan_out + 1):
+        dt = times[k:] - times[:-k]
+        ok = (dt > 0) & (dt <= max_dt)
+        hashes.append((bins[:-k][ok] << 15) | (bins[k:][ok] << 6) | dt[ok])
+        anchors.append(times[:-k][ok])
+    return np.concatenate(hashes).astype(np.uint32), np.concatenate(anchors).astype(np.uint32)
+
+
+class FingerprintIndex:
+    """Finds near-duplicate recordings (re-encodes, edits, re-uploads) from landmark fingerprints.
+
+    Each source is fingerprinted once and cached by sha256. duplicates() then matches every
+    song against every other in one sorted pass over all hashes. Two songs are linked when
+    enough of their shared hashes agree on one time offset, as a fraction of the shorter
+    fingerprint. Unrelated songs score around 0.001; re-encodes and trims score 0.05-0.5.
+    """
+    
+    SAMPLE_RATE = 8000
+    MAX_SONGS_PER_HASH = 32  # hashes shared more widely than this carry no identity
+    MIN_MATCHES = 20
+    
+    def __init__(self, cache_dir, threshold=0.03):
+        self.ffmpeg = shutil.which("ffmpeg")
+        if not self.ffmpeg:
+            raise RuntimeError("--dedupe requires ffmpeg on PATH")
+        self.cache_dir = Path(cache_dir)
+        self.threshold = threshold
+        self.computed = self.reused = self.songs = self.duplicates_found = self.groups = 0
+        self._lock = threading.Lock()
+    
+    def fingerprint(self, audio):
+        """(hashes, anchor frames) for audio, computed on first use"""
+        sha = file_sha256(audio)
+        path = self.cache_dir / sha[:2] / f"{sha}.npy"
+        if path.exists():
+            with self._lock:
+                self.reused += 1
+            hashes, anchors = np.load(path)
+            return hashes, anchors
+        hashes, anchors = landmark_hashes(*spectral_peaks(decode_audio(audio, self.SAMPLE_RATE, self.ffmpeg)))
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_suffix(f".{threading.get_ident()}.tmp")
+        with open(tmp_path, 'wb') as f:
+            np.save(f, np.stack([hashes, anchors]))
+        os.replace(tmp_path, path)
+        with self._lock:
+            self.computed += 1
+        return hashes, anchors
+    
+    def duplicates(self, songs, prefer=(), workers=8):
+        """Map each redundant song_id to (canonical song_id, similarity).
+
+        songs is an ordered list of (song_id, audio). In each group the canonical member is
+        the first song in prefer (e.g. already predicted), else the first in order. similarity
+        is the strongest link that put the song in its group.
+        """
+        songs = list(songs)
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            prints = list(pool.map(lambda song: self.fingerprint(song[1]), songs))
+        lengths = np.array([len(hashes) for hashes, _ in prints], dtype=np.int64)
+        hashes = np.concatenate([hashes for hashes, _ in prints] or [np.array([], np.uint32)])
+        anchors = np.concatenate([anchors for _, anchors in prints] or [np.array([], np.uint32)]).astype(np.int64)
+        owners = np.repeat(np.arange(len(songs)), lengths)
+        
+        order = np.argsort(hashes, kind='stable')
+        hashes, anchors, owners = hashes[order], anchors[order], owners[order]
+        _, counts = np.unique(hashes, return_counts=True)
+        informative = np.repeat(counts <= self.MAX_SONGS_PER_HASH, counts)
+        hashes, anchors, owners = hashes[informative], anchors[informative], owners[informative]
+        
+        # Equal hashes are adjacent after sorting, so comparing each entry with the one d places
+        # ahead, for every d below the largest group, yields every matching pair exactly once
+        firsts, seconds, offsets = [], [], []
+        for d in range(1, self.MAX_SONGS_PER_HASH):
+            same = np.flatnonzero(hashes[d:] == hashes[:-d])
+            if not len(same):
+                break
+            a, b = owners[same], owners[same + d]
+            offset = anchors[same + d] - anchors[same]
+            swap = a > b
+            keep = a != b
+            firsts.append(np.where(swap, b, a)[keep])
+            seconds.append(np.where(swap, a, b)[keep])
+            offsets.append(np.where(swap, -offset, offset)[keep])
+        
+        links = []
+        if firsts:
+            a, b, offset = (np.concatenate(column) for column in (firsts, seconds, offsets))
+            # Count matches per (pair, offset), letting each match count for offsets within one
+            # frame so trims that aren't a whole number of frames still line up
+            a, b = np.tile(a, 3), np.tile(b, 3)
+            offset = np.concatenate([offset - 1, offset, offset + 1])
+            order = np.lexsort((offset, b, a))
+            a, b, offset = a[order], b[order], offset[order]
+            starts = np.flatnonzero(np.r_[True, (a[1:] != a[:-1]) | (b[1:] != b[:-1]) | (offset[1:] != offset[:-1])])
+            run_counts = np.diff(np.r_[starts, len(a)])
+            run_a, run_b = a[starts], b[starts]
+            pair_starts = np.flatnonzero(np.r_[True, (run_a[1:] != run_a[:-1]) | (run_b[1:] != run_b[:-1])])
+            best = np.maximum.reduceat(run_counts, pair_starts)
+            pair_a, pair_b = run_a[pair_starts], run_b[pair_starts]
+            similarity = best / np.maximum(1, np.minimum(lengths[pair_a], lengths[pair_b]))
+            linked = (similarity >= self.threshold) & (best >= self.MIN_MATCHES)
+            links = zip(pair_a[linked].tolist(), pair_b[linked].tolist(), similarity[linked].tolist())
+        
+        parent = list(range(len(songs)))
+        strongest = [0.0] * len(songs)
+        
+        def root(i):
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+        
+        for i, j, score in links:
+            parent[root(i)] = root(j)
+            strongest[i], strongest[j] = max(strongest[i], score), max(strongest[j], score)
+        
+        prefer = set(prefer)
+        groups = {}
+        for i, (song_id, _) in enumerate(songs):
+            groups.setdefault(root(i), []).append(i)
+        duplicates = {}
+        for members in groups.values():
+            if len(members) < 2:
+                continue
+            canonical = next((i for i in members if songs[i][0] in prefer), members[0])
+            for i in members:
+                if i != canonical:
+                    duplicates[songs[i][0]] = (songs[canonical][0], round(strongest[i], 4))
+        with self._lock:
+            self.songs += len(songs)
+            self.duplicates_found += len(duplicates)
+            self.groups += sum(len(members) > 1 for members in groups.values())
+        return duplicates
+    
+    def stats(self):
+        return (f"{self.songs} songs ({self.computed} fingerprinted, {self.reused} cached), "
+                f"{self.duplicates_found} near-duplicates in {self.groups} groups")
+
+def link_duplicate(pred, canonical, similarity, n_listeners):
+    """Copy of canonical's prediction for a near-duplicate, with the linkage recorded under _meta.
+
+    An API row's prompt hash is swapped for the one for the duplicate's own listener count,
+    since the copy stands in for that prompt's answer; otherwise every later run would find
+    it stale.
+    """
+    meta = dict(pred.get("_meta", {}))
+    if "prompt_hash" in meta:
+        meta["prompt_hash"] = prompt_hash(n_listeners)
+    return {**pred, "_meta": {**meta, "duplicate_of": canonical, "similarity": similarity}}
+
+FEATURES = ["duration", "rms_mean", "rms_std", "tempo", "centroid_mean", "centroid_std", "flux_mean", "flux_std",
+            "key", "key_strength", "mode_strength", "onset_density"]
+FEATURE_VERSION = "1"
+
+# Krumhansl-Kessler key profiles, C first
+MAJOR_PROFILE = np.array([6.35, 2.23, 3.48, 2.33, 4.38, 4.09, 2.52, 5.19, 2.39, 3.66, 2.29, 2.88])
+MINOR_PROFILE = np.array([6.33, 2.68, 3.52, 5.38, 2.60, 3.53, 2.54, 4.75, 3.98, 2.69, 3.34, 3.17])
+
+def extract_features(samples, sample_rate=22050, frame=2048, hop=512, block=1024):
+    """Song-level descriptors (FEATURES order) from one block-wise pass over the magnitude spectrogram.
+
+    key is the best-matching pitch class (C=0), key_strength its profile correlation and
+    mode_strength the best major minus the best minor correlation (positive leans major).
+    """
+    duration = len(samples) / sample_rate
+    if len(samples) < frame:
+        samples = np.pad(samples, (0, frame - len(samples)))
+    frames = np.lib.stride_tricks.sliding_window_view(samples, frame)[::hop]
+    window = np.hanning(frame).astype(np.float32)
+    freqs = np.fft.rfftfreq(frame, 1 / sample_rate)
+    pitched = np.flatnonzero((freqs >= 55) & (freqs <= 5000))
+    pitch_class = (np.round(12 * np.log2(freqs[pitched] / 440)).astype(int) + 9) % 12
+    chroma_map = np.zeros((len(pitched), 12))
+    chroma_map[np.arange(len(pitched)), pitch_class] = 1
+    
+    rms = np.empty(len(frames))
+    centroid = np.empty(len(frames))
+    flux = np.zeros(len(frames))
+    chroma = np.zeros(12)
+    previous = None
+    for start in range(0, len(frames), block):
+        chunk = frames[start:start + block]
+        magnitude = np.abs(np.fft.rfft(chunk * window, axis=1))
+        rows = slice(start, start + len(chunk))
+        rms[rows] = np.sqrt(np.mean(chunk ** 2, axis=1))
+        total = magnitude.sum(axis=1)
+        centroid[rows] = np.divide(magnitude @ freqs, total, out=np.zeros(len(chunk)), where=total > 0)
+        log_magnitude = np.log1p(magnitude)
+        if previous is not None:
+            log_magnitude = np.vstack([previous, log_magnitude])
+        flux[start + (previous is None):start + len(chunk)] = np.maximum(np.diff(log_magnitude, axis=0), 0).sum(axis=1)
+        previous = log_magnitude[-1:]
+        chroma += (magnitude[:, pitched] ** 2).sum(axis=0) @ chroma_map
+    
+    # Correlate the chroma profile with all 24 rotated key profiles at once
+    profiles = np.stack([np.roll(profile, shift) for profile in (MAJOR_PROFILE, MINOR_PROFILE) for shift in range(12)])
+    profiles = (profiles - profiles.mean(axis=1, keepdims=True)) / profiles.std(axis=1, keepdims=True)
+    spread = chroma.std()
+    correlation = profiles @ ((chroma - chroma.mean()) / spread) / 12 if spread > 0 else np.zeros(24)
+    best = int(np.argmax(correlation))
+    
+    frame_rate = sample_rate / hop
+    tempo = beat_grid(flux, frame_rate)[0] if len(flux) > 3 else 0.0
+    # Onsets: local maxima of the flux that stand half a standard deviation above its mean
+    peaks = (flux[1:-1] > flux[:-2]) & (flux[1:-1] >= flux[2:]) & (flux[1:-1] > flux.mean() + 0.5 * flux.std())
+    values = [duration, rms.mean(), rms.std(), tempo, centroid.mean(), centroid.std(), flux.mean(), flux.std(),
+              best % 12, correlation[best], correlation[:12].max() - correlation[12:].max(),
+              peaks.sum() / max(duration, 1e-3)]
+    return np.array(values, dtype=float)
+
+def _features_for(source):
+    # Runs in a worker process; source is a path or the audio bytes
+    return extract_features(decode_audio(source, 22050))
+
+class FeatureStore:
+    """Columnar (Arrow IPC) cache of extract_features() rows keyed by audio sha256.
+
+    Features are computed once per distinct audio, in a process pool, and appended to the
+    store; later runs, and songs that share audio, only look them up. The store is rebuilt if
+    FEATURE_VERSION changes.
+    """
+    
+    def __init__(self, path):
+        self.pa = require_pyarrow()
+        if not shutil.which("ffmpeg"):
+            raise RuntimeError("feature extraction requires ffmpeg on PATH")
+        self.path = Path(path)
+        self.hashes, self.values = [], np.zeros((0, len(FEATURES)))
+        self.computed = self.cached = 0
+        self._lock = threading.Lock()
+        if self.path.exists():
+            with self.pa.memory_map(str(self.path), 'r') as source:
+                table = self.pa.ipc.open_file(source).read_all()
+            if (table.schema.metadata or {}).get(b"version") == FEATURE_VERSION.encode():
+                self.hashes = table.column("sha256").to_pylist()
+                self.values = np.stack([table.column(name).to_numpy() for name in FEATURES], axis=1)
+        self.index = {sha: i for i, sha in enumerate(self.hashes)}
+    
+    def compute(self, songs, workers=None):
+        """Features for (song_id, audio) pairs as a (songs, FEATURES) array, computing and saving missing rows"""
+        songs = list(songs)
+        hashes = [file_sha256(audio) for _, audio in songs]
+        with self._lock:
+            return self._compute(songs, hashes, workers)
+    
+    def _compute(self, songs, hashes, workers):
+        missing = {}
+        for sha, (_, audio) in zip(hashes, songs):
+            if sha not in self.index and sha not in missing:
+                # Pack slices can't be pickled, so worker processes get their bytes
+                missing[sha] = audio if is_audio_path(audio) else bytes(audio.data if isinstance(audio, PackedAudio) else audio)
+        if missing:
+            if len(missing) == 1:
+                rows = [_features_for(source) for source in missing.values()]
+            else:
+                with ProcessPoolExecutor(max_workers=workers) as pool:
+                    rows = list(pool.map(_features_for, missing.values()))
+            for sha, row in zip(missing, rows):
+                self.index[sha] = len(self.hashes)
+                self.hashes.append(sha)
+            self.values = np.vstack([self.values, rows])
+            self.save()
+        self.computed += len(missing)
+        self.cached += len(songs) - len(missing)
+        return self.values[[self.index[sha] for sha in hashes]].reshape(len(songs), len(FEATURES))
+    
+    def save(self):
+        pa = self.pa
+        columns = {"sha256": pa.array(self.hashes, pa.string())}
+        columns.update({name: pa.array(self.values[:, i], pa.float64()) for i, name in enumerate(FEATURES)})
+        table = pa.table(columns).replace_schema_metadata({"version": FEATURE_VERSION})
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with pa.OSFile(tmp_path, 'wb') as sink, pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+        os.replace(tmp_path, self.path)
+    
+    def stats(self):
+        return f"{self.computed} computed, {self.cached} cached; {len(self.hashes)} in {self.path}"
+
+def feature_matrix(X):
+    """Model inputs from FEATURES rows: the circular key column becomes its cosine and sine"""
+    key = FEATURES.index("key")
+    angle = X[:, key] * (2 * np.pi / 12)
+    return np.column_stack([np.delete(X, key, axis=1), np.cos(angle), np.sin(angle)])
+
+class RidgeModel:
+    """Multi-output ridge regression from standardized features to the nine GEMS means.
+
+    The penalty is chosen from ALPHAS by closed-form leave-one-out error, and the
+    leave-one-out predictions for the training rows are kept for honest comparisons.
+    """
+    
+    ALPHAS = 10.0 ** np.arange(-2, 4.5, 0.5)
+    
+    def fit(self, X, Y):
+        X = feature_matrix(X)
+        self.center, self.scale = X.mean(axis=0), X.std(axis=0)
+        self.scale[self.scale == 0] = 1
+        Z = np.column_stack([np.ones(len(X)), (X - self.center) / self.scale])
+        penalty = np.eye(Z.shape[1])
+        penalty[0, 0] = 0  # the intercept isn't shrunk
+        best = None
+        for alpha in self.ALPHAS:
+            inverse = np.linalg.pinv(Z.T @ Z + alpha * penalty)
+            hat = Z @ inverse @ Z.T
+            # Leave-one-out residual of a linear smoother: residual / (1 - leverage)
+            loo_residuals = (Y - hat @ Y) / np.maximum(1 - np.diag(hat), 1e-9)[:, None]
+            error = np.mean(loo_residuals ** 2)
+            if best is None or error < best[0]:
+                best = (error, alpha, inverse @ Z.T @ Y, Y - loo_residuals)
+        error, self.alpha, self.weights, loo = best
+        self.loo_rmse = math.sqrt(error)
+        # Leave-one-out residuals of the column means are the plain residuals scaled by n / (n - 1)
+        self.baseline_rmse = float(np.sqrt(np.mean((Y - Y.mean(axis=0)) ** 2))) * len(Y) / max(len(Y) - 1, 1)
+        self.loo_predictions = np.clip(loo, 0, 1)
+        return self
+    
+    def predict(self, X):
+        Z = np.column_stack([np.ones(len(X)), (feature_matrix(X) - self.center) / self.scale])
+        return np.clip(Z @ self.weights, 0, 1)
+
+class KNNModel:
+    """Distance-weighted k-nearest-neighbour regression in the standardized feature space.
+
+    Used beside RidgeModel as a second, differently biased estimator: where the two disagree,
+    the local prediction is not to be trusted. Leave-one-out predictions exclude each row
+    from its own neighbours.
+    """
+    
+    def __init__(self, k=5):
+        self.k = k
+    
+    def fit(self, X, Y):
+        X = feature_matrix(X)
+        self.center, self.scale = X.mean(axis=0), X.std(axis=0)
+        self.scale[self.scale == 0] = 1
+        self.points, self.targets = (X - self.center) / self.scale, Y
+        distances = self._distances(self.points)
+        np.fill_diagonal(distances, np.inf)
+        self.loo_predictions = self._blend(distances)
+        return self
+    
+    def _distances(self, points):
+        return np.sqrt(((points[:, None, :] - self.points[None, :, :]) ** 2).sum(axis=2))
+    
+    def _blend(self, distances):
+        k = min(self.k, np.isfinite(distances).sum(axis=1).min())
+        nearest = np.argpartition(distances, k - 1, axis=1)[:, :k]
+        weights = 1 / (np.take_along_axis(distances, nearest, axis=1) + 1e-9)
+        weights /= weights.sum(axis=1, keepdims=True)
+        return (weights[..., None] * self.targets[nearest]).sum(axis=1)
+    
+    def predict(self, X):
+        return self._blend(self._distances((feature_matrix(X) - self.center) / self.scale))
+
+def gems_from_means(means):
+    """GEMS JSON for predicted means; each listener's rating is binary, so std = sqrt(mean * (1 - mean))"""
+    return {emotion: {"mean": round(float(mean), 4), "std": round(math.sqrt(mean * (1 - mean)), 4)}
+            for emotion, mean in zip(EMOTIONS, means)}
+
+class LocalBackend:
+    """--backend local: GEMS predictions in milliseconds from a RidgeModel over local features.
+
+    Trained on every catalog song with ground truth. Those songs get their leave-one-out
+    prediction, so comparison CSVs against truth.json aren't flattered by the song having been
+    in the training set; other songs get the full model's prediction. A KNNModel trained
+    alongside gives estimate() a disagreement score for routing. Predictions record MODEL as
+    their model under _meta.
+    """
+    
+    MODEL = f"local/ridge-features-v{FEATURE_VERSION}"
+    
+    def __init__(self, store, truth_data, catalog):
+        self.store = store
+        train = [(song_id, audio) for song_id, audio in catalog if song_id in truth_data]
+        if len(train) < 3:
+            raise RuntimeError("--backend local needs truth.json entries for at least 3 songs in the catalog")
+        X = store.compute(train)
+        Y = emotion_array(truth_data, [song_id for song_id, _ in train])[..., 0]
+        self.model = RidgeModel().fit(X, Y)
+        self.knn = KNNModel().fit(X, Y)
+        self.loo = {file_sha256(audio): pair for (_, audio), pair
+                    in zip(train, zip(self.model.loo_predictions, self.knn.loo_predictions))}
+        self.trained_on = len(train)
+    
+    def estimate(self, audio_path):
+        """(ridge means, RMS disagreement between the ridge and kNN means)"""
+        pair = self.loo.get(file_sha256(audio_path))
+        if pair is None:
+            X = self.store.compute([(None, audio_path)])
+            pair = self.model.predict(X)[0], self.knn.predict(X)[0]
+        ridge, knn = pair
+        return ridge, float(np.sqrt(np.mean((ridge - knn) ** 2)))
+    
+    def prediction(self, means):
+        return {**gems_from_means(means), "_meta": {"backend": "local", "model": self.MODEL}}
+    
+    def analyze(self, audio_path, n_listeners):
+        with timed("local"):
+            means, _ = self.estimate(audio_path)
+            return self.prediction(means)
+    
+    def stats(self):
+        return (f"ridge (alpha {self.model.alpha:g}) on {self.trained_on} truth songs, leave-one-out RMSE "
+                f"{self.model.loo_rmse:.4f} vs {self.model.baseline_rmse:.4f} for the mean-only baseline")
+
+class Router:
+    """--backend route: answer from the local model where it's confident, escalate the rest to the API.
+
+    A song stays local when its ridge and kNN estimates disagree by at most threshold (RMS
+    over the nine means). Every row records which backend produced it under _meta.
+    """
+    
+    def __init__(self, local, threshold):
+        self.local = local
+        self.threshold = threshold
+        self.answered = 0
+        self.escalated = 0
+    
+    def _local(self, audio_path):
+        """Local prediction, or None with the disagreement if the song should be escalated"""
+        with timed("local"):
+            means, disagreement = self.local.estimate(audio_path)
+        if disagreement <= self.threshold:
+            self.answered += 1
+            return self.local.prediction(means), disagreement
+        self.escalated += 1
+        return None, disagreement
+    
+    def analyze(self, audio_path, n_listeners, analyze=analyze_audio):
+        pred, disagreement = self._local(audio_path)
+        backend = "local" if pred else "api"
+        if pred is None:
+            pred = dict(analyze(audio_path, n_listeners))
+        pred["_meta"] = {**pred.get("_meta", {}), "backend": backend, "disagreement": round(disagreement, 4)}
+        return pred
+    
+    async def analyze_async(self, client, audio_path, n_listeners, analyze=analyze_audio_async):
+        pred, disagreement = self._local(audio_path)
+        backend = "local" if pred else "api"
+        if pred is None:
+            pred = dict(await analyze(client, audio_path, n_listeners))
+        pred["_meta"] = {**pred.get("_meta", {}), "backend": backend, "disagreement": round(disagreement, 4)}
+        return pred
+    
+    def stats(self):
+        total = self.answered + self.escalated
+        return (f"{self.answered} answered locally, {self.escalated} escalated to the API "
+                f"({self.answered / max(total, 1):.0%} fewer API calls) at disagreement <= {self.threshold:g}")
+
+# Rough request cost used for tokens/min limiting: Gemini bills audio at ~32 tokens/s,
+# which for these ~18 kbps Opus clips is about one token per 70 bytes
+AUDIO_BYTES_PER_TOKEN = 70
+RESPONSE_TOKENS = 400
+RETRYABLE_STATUS = {408, 409, 425, 429, 500, 502, 503, 504}
+
+def estimate_tokens(audio_path, n_listeners):
+    prompt_tokens = len(get_gems_prompt(n_listeners)) // 4
+    return prompt_tokens + audio_size(audio_path) // AUDIO_BYTES_PER_TOKEN + RESPONSE_TOKENS
+
+def estimate_batch_tokens(clips):
+    """Like estimate_tokens for a multi-song request, which carries the prompt once"""
+    prompt_tokens = len(get_batch_prompt([f"clip_{i + 1}" for i in range(len(clips))])) // 4
+    return prompt_tokens + sum(audio_size(audio_path) // AUDIO_BYTES_PER_TOKEN + RESPONSE_TOKENS
+                               for audio_path, _ in clips)
+
+def is_retryable(error):
+    if isinstance(error, APIError):
+        return error.status_code in RETRYABLE_STATUS
+    if isinstance(error, (requests.ConnectionError, requests.Timeout)):
+        return True
+    httpx = sys.modules.get("httpx")
+    return httpx is not None and isinstance(error, httpx.TransportError)
+
+class TokenBucket:
+    """Token bucket refilled at rate_per_min, holding at most one minute's worth of tokens.
+
+    reserve() debits immediately and returns how long the caller must wait before the
+    tokens are really available, so waiting happens outside the lock (and works for asyncio).
+    """
+    
+    def __init__(self, rate_per_min):
+        self.rate = rate_per_min / 60.0
+        self.capacity = float(rate_per_min)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+    
+    def reserve(self, amount):
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= amount
+            return max(0.0, -self.tokens / self.rate)
+
+class AIMDController:
+    """Additive-increase/multiplicative-decrease limit on concurrent API calls.
+
+    Every success raises the limit by ~1/limit (about +1 per window of successes); a throttled
+    call multiplies it by `decrease`, at most once per `cooldown` seconds so a burst of 429s
+    from requests already in flight counts as a single congestion event. A cancelled call
+    leaves the limit as it was.
+    """
+    
+    def __init__(self, maximum, minimum=1, decrease=0.5, cooldown=1.0):
+        self.maximum = maximum
+        self.minimum = minimum
+        self.decrease = decrease
+        self.cooldown = cooldown
+        self.limit = float(maximum)
+        self.in_flight = 0
+        self._last_decrease = 0.0
+        self._cond = threading.Condition()
+        self._released = None  # asyncio.Event, made on first use so it belongs to the running loop
+    
+    def try_acquire(self):
+        with self._cond:
+            if self.in_flight >= int(self.limit):
+                return False
+            self.in_flight += 1
+            return True
+    
+    def acquire(self):
+        with self._cond:
+            while self.in_flight >= int(self.limit):
+                self._cond.wait()
+            self.in_flight += 1
+    
+    async def acquire_async(self):
+        while not self.try_acquire():
+            if self._released is None:
+                self._released = asyncio.Event()
+            self._released.clear()
+            await self._released.wait()
+    
+    def release(self, throttled=False, cancelled=False):
+        with self._cond:
+            self.in_flight -= 1
+            now = time.monotonic()
+            if throttled:
+                if now - self._last_decrease >= self.cooldown:
+                    self.limit = max(self.minimum, self.limit * self.decrease)
+                    self._last_decrease = now
+            elif not cancelled:
+                self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+            self._cond.notify_all()
+        if self._released is not None:
+            self._released.set()
+
+class RequestScheduler:
+    """Rate limiting, AIMD concurrency control and retries around an API call.
+
+    Retryable failures (429, 5xx, connection errors) are retried up to max_retries times,
+    waiting for the server's Retry-After when given, else exponential backoff with full jitter.
+    Calls are fn(audio_path, n_listeners) unless other args and their token estimate are given.
+    """
+    
+    def __init__(self, max_concurrency, requests_per_min=None, tokens_per_min=None,
+                 max_retries=5, base_delay=1.0, max_delay=60.0):
+        self.request_bucket = TokenBucket(requests_per_min) if requests_per_min else None
+        self.token_bucket = TokenBucket(tokens_per_min) if tokens_per_min else None
+        self.concurrency = AIMDController(max_concurrency)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.retries = self.throttled = self.failures = 0
+        self.rate_wait = 0.0
+        self._stats_lock = threading.Lock()
+    
+    def _rate_delay(self, tokens):
+        delay = 0.0
+        if self.request_bucket:
+            delay = max(delay, self.request_bucket.reserve(1))
+        if self.token_bucket:
+            delay = max(delay, self.token_bucket.reserve(tokens))
+        with self._stats_lock:
+            self.rate_wait += delay
+        return delay
+    
+    def _retry_delay(self, attempt, error):
+        give_up = attempt >= self.max_retries or not is_retryable(error)
+        with self._stats_lock:
+            if isinstance(error, APIError) and error.status_code == 429:
+                self.throttled += 1
+            if give_up:
+                self.failures += 1
+            else:
+                self.retries += 1
+        if give_up:
+            return None
+        if isinstance(error, APIError) and error.retry_after is not None:
+            return error.retry_after
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+    
+    def call(self, fn, *args, tokens=None):
+        tokens = estimate_tokens(*args) if tokens is None else tokens
+        for attempt in itertools.count():
+            with timed("wait"):
+                time.sleep(self._rate_delay(tokens))
+                self.concurrency.acquire()
+            try:
+                result = fn(*args)
+            except Exception as e:
+                self.concurrency.release(throttled=isinstance(e, APIError) and e.status_code == 429)
+                delay = self._retry_delay(attempt, e)
+                if delay is None:
+                    raise
+                with timed("wait"):
+                    time.sleep(delay)
+            else:
+                self.concurrency.release()
+                return result
+    
+    async def call_async(self, fn, client, *args, tokens=None):
+        tokens = estimate_tokens(*args) if tokens is None else tokens
+        for attempt in itertools.count():
+            with timed("wait"):
+                await asyncio.sleep(self._rate_delay(tokens))
+                await self.concurrency.acquire_async()
+            try:
+                result = await fn(client, *args)
+            except asyncio.CancelledError:
+                # A hedged copy that lost; give its slot back without counting a success or a failure
+                self.concurrency.release(cancelled=True)
+                raise
+            except Exception as e:
+                self.concurrency.release(throttled=isinstance(e, APIError) and e.status_code == 429)
+                delay = self._retry_delay(attempt, e)
+                if delay is None:
+                    raise
+                with timed("wait"):
+                    await asyncio.sleep(delay)
+            else:
+                self.concurrency.release()
+                return result
+    
+    def stats(self):
+        return (f"{self.retries} retries, {self.throttled} throttled (429), {self.failures} gave up, "
+                f"{self.rate_wait:.1f}s rate-limit wait, concurrency limit {self.concurrency.limit:.1f}")
+
+class _Batch:
+    def __init__(self, event_type):
+        self.clips = []
+        self.bytes = 0
+        self.closed = event_type()
+        self.done = event_type()
+        self.results = self.error = None
+
+class RequestBatcher:
+    """Groups concurrent single-song calls into multi-song requests sent through the scheduler.
+
+    Each caller adds its clip to the open batch and blocks until the batch is answered. The
+    caller that opened a batch sends it once it holds max_songs clips, once the next clip
+    would take its audio past max_bytes, or linger seconds after opening, whichever comes
+    first. Clips that come back missing or malformed are retried as single-song requests by
+    their own caller. A failed batch request fails every clip in it, and each is retried
+    (and regrouped) by the scheduler layer above as usual.
+    """
+    
+    def __init__(self, scheduler, single, batch, max_songs, max_bytes, linger=0.05):
+        self.scheduler = scheduler
+        self.single = single
+        self.batch = batch
+        self.max_songs = max_songs
+        self.max_bytes = max_bytes
+        self.linger = linger
+        self.songs = self.requests = self.fallbacks = 0
+        self._open = None
+        self._lock = threading.Lock()
+    
+    def _join(self, audio_path, n_listeners, event_type):
+        """(batch, index, is_leader) after adding the clip to the open batch, or to a new one"""
+        size = audio_size(audio_path)
+        with self._lock:
+            batch = self._open
+            leader = batch is None or batch.bytes + size > self.max_bytes
+            if leader:
+                if batch:
+                    self._close(batch)
+                batch = self._open = _Batch(event_type)
+            batch.clips.append((audio_path, n_listeners))
+            batch.bytes += size
+            if len(batch.clips) == self.max_songs:
+                self._close(batch)
+            return batch, len(batch.clips) - 1, leader
+    
+    def _close(self, batch):
+        if self._open is batch:
+            self._open = None
+        batch.closed.set()
+    
+    def _record(self, batch):
+        with self._lock:
+            self.requests += 1
+            self.songs += len(batch.clips)
+    
+    def _result(self, batch, index):
+        if batch.error is not None:
+            raise batch.error
+        return batch.results[index]
+    
+    def analyze(self, audio_path, n_listeners):
+        batch, index, leader = self._join(audio_path, n_listeners, threading.Event)
+        if leader:
+            with timed("wait"):
+                batch.closed.wait(self.linger)
+            with self._lock:
+                self._close(batch)
+            self._record(batch)
+            try:
+                if len(batch.clips) == 1:
+                    batch.results = [self.scheduler.call(self.single, audio_path, n_listeners)]
+                else:
+                    batch.results = self.scheduler.call(self.batch, batch.clips,
+                                                        tokens=estimate_batch_tokens(batch.clips))
+            except Exception as e:
+                batch.error = e
+            finally:
+                batch.done.set()
+        else:
+            with timed("network"):
+                batch.done.wait()
+        pred = self._result(batch, index)
+        if pred is None:
+            with self._lock:
+                self.fallbacks += 1
+            pred = self.scheduler.call(self.single, audio_path, n_listeners)
+        return pred
+    
+    async def analyze_async(self, client, audio_path, n_listeners):
+        batch, index, leader = self._join(audio_path, n_listeners, asyncio.Event)
+        if leader:
+            with timed("wait"):
+                try:
+                    await asyncio.wait_for(batch.closed.wait(), self.linger)
+                except asyncio.TimeoutError:
+                    pass
+            self._close(batch)
+            self._record(batch)
+            try:
+                if len(batch.clips) == 1:
+                    batch.results = [await self.scheduler.call_async(self.single, client, audio_path, n_listeners)]
+                else:
+                    batch.results = await self.scheduler.call_async(self.batch, client, batch.clips,
+                                                                    tokens=estimate_batch_tokens(batch.clips))
+            except Exception as e:
+                batch.error = e
+            finally:
+                batch.done.set()
+        else:
+            with timed("network"):
+                await batch.done.wait()
+        pred = self._result(batch, index)
+        if pred is None:
+            self.fallbacks += 1
+            pred = await self.scheduler.call_async(self.single, client, audio_path, n_listeners)
+        return pred
+    
+    def stats(self):
+        return (f"{self.songs} songs in {self.requests} requests ({self.songs / max(self.requests, 1):.1f} "
+                f"per request; at most {self.max_songs} songs and {self.max_bytes / 1e6:g} MB of audio), "
+                f"{self.fallbacks} retried alone after a malformed batch result")
+
+class LatencyTracker:
+    """Quantiles of the last `window` latencies, kept sorted so a lookup is one index"""
+    
+    def __init__(self, window=500):
+        self.window = window
+        self._recent = collections.deque()
+        self._sorted = []
+        self._lock = threading.Lock()
+    
+    def __len__(self):
+        return len(self._recent)
+    
+    def observe(self, seconds):
+        with self._lock:
+            self._recent.append(seconds)
+            bisect.insort(self._sorted, seconds)
+            if len(self._recent) > self.window:
+                del self._sorted[bisect.bisect_left(self._sorted, self._recent.popleft())]
+    
+    def quantile(self, q):
+        with self._lock:
+            return self._sorted[min(len(self._sorted) - 1, int(q * len(self._sorted)))] if self._sorted else None
+
+class RequestHedger:
+    """Sends a second copy of a call that is still running past a percentile of recent latencies.
+    
+    The delay is the `percentile` of the last calls' latencies; no call is hedged until
+    min_samples of them have been seen. Hedges are capped at `budget` times the number of
+    calls. Both copies go through the scheduler, and the first valid answer wins: a copy that
+    fails leaves the other to finish. The loser is cancelled in asyncio mode; a thread can't be
+    interrupted mid-request, so there its reply is just dropped. Latencies are tracked for
+    first copies only, and a cancelled one counts with the time it had run.
+    """
+    
+    min_samples = 20
+    
+    def __init__(self, scheduler, single, percentile, budget, max_threads=None):
+        self.scheduler = scheduler
+        self.single = single
+        self.percentile = percentile
+        self.budget = budget
+        self.tracker = LatencyTracker()
+        self.calls = self.hedges = self.hedge_wins = self.cancelled = self.abandoned = self.censored = 0
+        self.latencies = []
+        self.first_latencies = []
+        self._pool = ThreadPoolExecutor(max_workers=max_threads)
+        self._lock = threading.Lock()
+    
+    def _delay(self):
+        """Count a new call; seconds to wait for its first copy before hedging, or None while there is too little history"""
+        with self._lock:
+            self.calls += 1
+        if len(self.tracker) < self.min_samples:
+            return None
+        return self.tracker.quantile(self.percentile / 100)
+    
+    def _take_hedge(self):
+        with self._lock:
+            if self.hedges + 1 > self.budget * self.calls:
+                return False
+            self.hedges += 1
+            return True
+    
+    def _observe_first(self, seconds, censored=False):
+        self.tracker.observe(seconds)
+        with self._lock:
+            self.first_latencies.append(seconds)
+            self.censored += censored
+    
+    def _won(self, start, hedge_start, timings):
+        """Book-keeping for the winning copy; its stage timings become the song's"""
+        with self._lock:
+            self.latencies.append(time.perf_counter() - start)
+            self.hedge_wins += hedge_start is not None
+        song_timings = _stage_timings.get()
+        if song_timings is not None and timings is not None:
+            for stage, seconds in timings.items():
+                song_timings[stage] = song_timings.get(stage, 0.0) + seconds
+            if hedge_start is not None:
+                song_timings["wait"] = song_timings.get("wait", 0.0) + hedge_start - start
+    
+    def _attempt(self, audio_path, n_listeners):
+        # Each copy times its own stages; only the winner's are kept
+        timings = {} if _stage_timings.get() is not None else None
+        _stage_timings.set(timings)
+        return self.scheduler.call(self.single, audio_path, n_listeners), timings
+    
+    async def _attempt_async(self, client, audio_path, n_listeners):
+        timings = {} if _stage_timings.get() is not None else None
+        _stage_timings.set(timings)
+        return await self.scheduler.call_async(self.single, client, audio_path, n_listeners), timings
+    
+    def _submit(self, audio_path, n_listeners):
+        return self._pool.submit(contextvars.copy_context().run, self._attempt, audio_path, n_listeners)
+    
+    def analyze(self, audio_path, n_listeners):
+        start = time.perf_counter()
+        first = self._submit(audio_path, n_listeners)
+        
+        def observe(future):
+            # A thread's first copy always runs to the end, so its latency is known even when it lost
+            if future.exception() is None:
+                self._observe_first(time.perf_counter() - start)
+        
+        first.add_done_callback(observe)
+        delay = self._delay()
+        hedge = hedge_start = None
+        if delay is not None and not wait([first], timeout=delay).done and self._take_hedge():
+            hedge_start = time.perf_counter()
+            hedge = self._submit(audio_path, n_listeners)
+    
+        pending = {first} if hedge is None else {first, hedge}
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in sorted(done, key=lambda future: future is hedge):
+                try:
+                    pred, timings = future.result()
+                except Exception as e:
+                    error = error or e
+                    continue
+                if pending:
+                    with self._lock:
+                        self.abandoned += 1
+                self._won(start, hedge_start if future is hedge else None, timings)
+                return pred
+        raise error
+    
+    async def analyze_async(self, client, audio_path, n_listeners):
+        start = time.perf_counter()
+        first = asyncio.create_task(self._attempt_async(client, audio_path, n_listeners))
+        pending = {first}
+        hedge = hedge_start = error = None
+        try:
+            delay = self._delay()
+            if delay is not None:
+                await asyncio.wait(pending, timeout=delay)
+                if not first.done() and self._take_hedge():
+                    hedge_start = time.perf_counter()
+                    hedge = asyncio.create_task(self._attempt_async(client, audio_path, n_listeners))
+                    pending.add(hedge)
+            
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in sorted(done, key=lambda task: task is hedge):
+                    try:
+                        pred, timings = task.result()
+                    except Exception as e:
+                        error = error or e
+                        continue
+                    if task is first:
+                        self._observe_first(time.perf_counter() - start)
+                    elif first in pending:
+                        self._observe_first(time.perf_counter() - start, censored=True)
+                    if pending:
+                        with self._lock:
+                            self.cancelled += 1
+                    self._won(start, hedge_start if task is hedge else None, timings)
+                    return pred
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+    
+    def close(self):
+        self._pool.shutdown(wait=False)
+    
+    def stats(self):
+        if not self.latencies:
+            return f"no calls answered; {self.hedges} hedged of {self.calls} calls"
+        p99 = np.percentile(self.latencies, 99)
+        first_p99 = np.percentile(self.first_latencies, 99) if self.first_latencies else float("nan")
+        if len(self.tracker) < self.min_samples:
+            trigger = f"fewer than {self.min_samples} latencies seen, so no hedging yet"
+        else:
+            trigger = f"hedging after {self.tracker.quantile(self.percentile / 100):.2f}s (p{self.percentile:g})"
+        return (f"{self.hedges} hedged of {self.calls} calls ({self.hedges / max(self.calls, 1):.1%} extra requests, "
+                f"budget {self.budget:.0%}), {self.hedge_wins} won by the hedge, {self.cancelled} losers cancelled, "
+                f"{self.abandoned} left to finish; p99 {p99:.2f}s vs {'at least ' if self.censored else ''}"
+                f"{first_p99:.2f}s for first copies alone; {trigger}")
+
+STAGES = ["coalesce", "excerpt", "transcode", "cache", "wait", "serialize", "read", "encode", "network", "server", "parse", "local", "total"]
+
+class StageMetrics:
+    """Per-stage timing histograms for every analyzed song, plus optional per-song JSONL records.
+
+    Buckets are log-spaced at 10 per decade from 0.1 ms to 1000 s, so reported percentiles are
+    within ~25% of the true value. "network" is time on the wire including the server's own
+    time; "server" is only present when the gateway reports it.
+    """
+    
+    BUCKETS = [10 ** (k / 10) for k in range(-40, 31)]
+    
+    def __init__(self, jsonl_path=None):
+        self.counts = {stage: [0] * (len(self.BUCKETS) + 1) for stage in STAGES}
+        self.sums = {stage: 0.0 for stage in STAGES}
+        self._lock = threading.Lock()
+        self._jsonl = open(jsonl_path, 'a') if jsonl_path else None
+    
+    def record(self, audio_path, timings):
+        with self._lock:
+            for stage, seconds in timings.items():
+                self.counts[stage][bisect.bisect_left(self.BUCKETS, seconds)] += 1
+                self.sums[stage] += seconds
+            if self._jsonl:
+                record = {"audio": str(audio_path), "time": time.time(),
+                          "stages": {stage: round(seconds, 6) for stage, seconds in timings.items()}}
+                self._jsonl.write(json.dumps(record) + "\n")
+    
+    def quantile(self, stage, q):
+        counts = self.counts[stage]
+        target = q * sum(counts)
+        seen = 0
+        for i, count in enumerate(counts):
+            seen += count
+            if count and seen >= target:
+                return self.BUCKETS[min(i, len(self.BUCKETS) - 1)]
+        return 0.0
+    
+    def stats(self):
+        lines = [f"{'stage':<10}{'count':>8}{'mean s':>10}{'p50 s':>10}{'p95 s':>10}{'p99 s':>10}"]
+        for stage in STAGES:
+            n = sum(self.counts[stage])
+            if n:
+                lines.append(f"{stage:<10}{n:>8}{self.sums[stage] / n:>10.4f}"
+                             + "".join(f"{self.quantile(stage, q):>10.4f}" for q in (0.5, 0.95, 0.99)))
+        return "\n" + "\n".join(lines)
+    
+    def prometheus(self):
+        """Prometheus text exposition; every 5th bucket boundary (half-decade steps) is exported"""
+        lines = ["# HELP music_stage_seconds Time spent in each analyze_audio stage per song",
+                 "# TYPE music_stage_seconds histogram"]
+        for stage in STAGES:
+            counts = self.counts[stage]
+            if not sum(counts):
+                continue
+            cumulative = list(itertools.accumulate(counts))
+            for i in range(0, len(self.BUCKETS), 5):
+                lines.append(f'music_stage_seconds_bucket{{stage="{stage}",le="{self.BUCKETS[i]:.6g}"}} {cumulative[i]}')
+            lines.append(f'music_stage_seconds_bucket{{stage="{stage}",le="+Inf"}} {cumulative[-1]}')
+            lines.append(f'music_stage_seconds_sum{{stage="{stage}"}} {self.sums[stage]:.6f}')
+            lines.append(f'music_stage_seconds_count{{stage="{stage}"}} {cumulative[-1]}')
+        return "\n".join(lines) + "\n"
+    
+    def close(self):
+        if self._jsonl:
+            self._jsonl.close()
+            self._jsonl = None
+
+def measure_stages(metrics, analyze, audio_path, n_listeners):
+    timings = {}
+    token = _stage_timings.set(timings)
+    start = time.perf_counter()
+    try:
+        with _tracer.start_as_current_span("analyze_audio") if _tracer else contextlib.nullcontext():
+            return analyze(audio_path, n_listeners)
+    finally:
+        timings["total"] = time.perf_counter() - start
+        _stage_timings.reset(token)
+        metrics.record(audio_path, timings)
+
+async def measure_stages_async(metrics, analyze, client, audio_path, n_listeners):
+    timings = {}
+    token = _stage_timings.set(timings)
+    start = time.perf_counter()
+    try:
+        with _tracer.start_as_current_span("analyze_audio") if _tracer else contextlib.nullcontext():
+            return await analyze(client, audio_path, n_listeners)
+    finally:
+        timings["total"] = time.perf_counter() - start
+        _stage_timings.reset(token)
+        metrics.record(audio_path, timings)
 
 def load_ground_truth_and_listeners():
     truth_path = Path("truth.json")
@@ -97,71 +2559,870 @@ def load_ground_truth_and_listeners():
     
     return truth_data, listeners
 
-def create_comparison_csvs(emotify_data, gemini_data):
-    """Create two CSV files comparing emotify and gemini data"""
-    emotions = ['amazement', 'solemnity', 'tenderness', 'nostalgia', 'calmness', 
-                'power', 'joyful_activation', 'tension', 'sadness']
+EMOTIONS = ['amazement', 'solemnity', 'tenderness', 'nostalgia', 'calmness',
+            'power', 'joyful_activation', 'tension', 'sadness']
+
+def emotion_array(data, song_ids):
+    """Dense (songs, emotions, [mean, std]) float array from the nested per-song JSON shape"""
+    return np.array([[(data[song][emotion]['mean'], data[song][emotion]['std']) for emotion in EMOTIONS]
+                     for song in song_ids], dtype=float).reshape(len(song_ids), len(EMOTIONS), 2)
+
+def round_like_python(values, ndigits):
+    """Vectorised round() that matches Python's built-in bit for bit.
+
+    np.round scales by 10**ndigits before rounding, so values whose scaled form lands within
+    a hair of a .5 tie can round the other way from Python's exact decimal rounding; those
+    few are redone with round().
+    """
+    rounded = np.round(values, ndigits)
+    scaled = values * 10.0 ** ndigits
+    near_tie = np.abs(scaled - np.floor(scaled) - 0.5) < 1e-6
+    for idx in np.flatnonzero(near_tie):
+        rounded.flat[idx] = round(float(values.flat[idx]), ndigits)
+    return rounded
+
+class EmotionTable:
+    """Predictions (or ground truth) as parallel columns instead of nested per-song dicts.
+
+    values has shape (songs, emotions, [mean, std]). models, prompt_hashes and audio hold the
+    provenance each row's "_meta" recorded (None where it recorded none), and meta the rest of
+    its "_meta" object as JSON text (or None). Supports `in`, keys() and [song_id] so it can
+    stand in for the JSON dict shape in main() and create_comparison_csvs().
+    """
+    
+    def __init__(self, song_ids, values, models, prompt_hashes, meta=None, audio=None):
+        self.song_ids = list(song_ids)
+        self.values = values
+        self.models = np.asarray(models, dtype=object)
+        self.prompt_hashes = np.asarray(prompt_hashes, dtype=object)
+        self.meta = np.asarray(meta if meta is not None else [None] * len(self.song_ids), dtype=object)
+        self.audio = np.asarray(audio if audio is not None else [None] * len(self.song_ids), dtype=object)
+        self._index = None
+    
+    @property
+    def index(self):
+        # Built on first lookup so loading a large file doesn't pay for it up front
+        if self._index is None:
+            self._index = {song: i for i, song in enumerate(self.song_ids)}
+        return self._index
+    
+    @classmethod
+    def from_json(cls, data):
+        """Build from the gemini_output.json/truth.json shape; missing emotions become NaN"""
+        song_ids = list(data)
+        values = np.array([[(data[song].get(emotion, {}).get('mean', np.nan),
+                             data[song].get(emotion, {}).get('std', np.nan)) for emotion in EMOTIONS]
+                           for song in song_ids], dtype=float).reshape(len(song_ids), len(EMOTIONS), 2)
+        models, hashes, meta, audio = [], [], [], []
+        for song in song_ids:
+            rest = dict(data[song].get("_meta", {}))
+            models.append(rest.pop("model", None))
+            hashes.append(rest.pop("prompt_hash", None))
+            audio.append(rest.pop("audio", None))
+            meta.append(json.dumps(rest, sort_keys=True) if rest else None)
+        return cls(song_ids, values, models, hashes, meta, audio)
+    
+    def _row(self, i):
+        row = {emotion: {"mean": mean, "std": std} for emotion, (mean, std) in zip(EMOTIONS, self.values[i].tolist())
+               if not (math.isnan(mean) or math.isnan(std))}
+        meta = {key: value for key, value in (("model", self.models[i]), ("prompt_hash", self.prompt_hashes[i]),
+                                              ("audio", self.audio[i])) if value}
+        if self.meta[i] is not None:
+            meta.update(json.loads(self.meta[i]))
+        if meta:
+            row["_meta"] = meta
+        return row
     
-    means_data = []
-    stds_data = []
+    def to_json(self):
+        return {song: self._row(i) for i, song in enumerate(self.song_ids)}
     
+    def update(self, data):
+        """Copy with data's rows (gemini_output.json shape) replacing this table's or appended after them"""
+        if not data:
+            return self
+        new = EmotionTable.from_json(data)
+        index = self.index
+        at = [index.get(song) for song in new.song_ids]
+        replaced = [j for j, i in enumerate(at) if i is not None]
+        appended = [j for j, i in enumerate(at) if i is None]
+        columns = []
+        for column, added in ((self.values, new.values), (self.models, new.models),
+                              (self.prompt_hashes, new.prompt_hashes), (self.meta, new.meta), (self.audio, new.audio)):
+            column = column.copy()
+            column[[at[j] for j in replaced]] = added[replaced]
+            columns.append(np.concatenate([column, added[appended]]))
+        return EmotionTable(self.song_ids + [new.song_ids[j] for j in appended], *columns)
+    
+    def invalid_rows(self, listeners):
+        """Song ids of rows with a missing or out-of-range emotion, i.e. those GemsAnswer would reject"""
+        limits = {n: max_std(n) for n in set(listeners.values())}
+        limit = np.array([limits.get(listeners.get(song), max_std()) for song in self.song_ids])
+        means, stds = self.values[..., 0], self.values[..., 1]
+        with np.errstate(invalid='ignore'):
+            valid = (means >= 0) & (means <= 1) & (stds >= 0) & (stds <= limit.reshape(-1, 1))
+        return [self.song_ids[i] for i in np.flatnonzero(~valid.all(axis=1))]
+    
+    def changed_rows(self, listeners, with_meta=False, audio=None):
+        """Song ids whose recorded model, prompt hash or audio settings aren't the current ones (and,
+        with_meta, any row with other _meta), i.e. the only rows stale_reason can flag
+        """
+        hashes = {n: prompt_hash(n) for n in set(listeners.values())}
+        expected = np.array([hashes.get(listeners.get(song)) for song in self.song_ids], dtype=object)
+        changed = self.models.astype(bool) & ((self.models != MODEL_NAME) | (self.prompt_hashes != expected)
+                                              | (self.audio != audio))
+        if with_meta:
+            changed |= np.array([meta is not None for meta in self.meta], dtype=bool)
+        return [self.song_ids[i] for i in np.flatnonzero(changed)]
+    
+    def __getitem__(self, song_id):
+        return self._row(self.index[song_id])
+    
+    def __len__(self):
+        return len(self.song_ids)
+    
+    def __contains__(self, song_id):
+        return song_id in self.index
+    
+    def keys(self):
+        return list(self.song_ids)
+    
+    def select(self, song_ids):
+        index = self.index
+        return self.values[[index[song] for song in song_ids]]
+
+def require_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.ipc  # noqa: F401
+    except ImportError:
+        raise RuntimeError("columnar results require pyarrow (pip install pyarrow)")
+    return pyarrow
+
+def is_parquet(path):
+    return Path(path).suffix.lower() in ('.parquet', '.pq')
+
+def write_columnar(path, table):
+    """Write an EmotionTable as Arrow IPC (.arrow/.feather) or Parquet (.parquet), replacing atomically"""
+    pa = require_pyarrow()
+    columns = {
+        "song_id": pa.array(table.song_ids, pa.string()),
+        "model": pa.array(list(table.models), pa.string()),
+        "prompt_hash": pa.array(list(table.prompt_hashes), pa.string()),
+        "meta": pa.array(list(table.meta), pa.string()),
+        "audio": pa.array(list(table.audio), pa.string()),
+    }
+    for i, emotion in enumerate(EMOTIONS):
+        columns[f"{emotion}_mean"] = pa.array(table.values[:, i, 0], pa.float64())
+    for i, emotion in enumerate(EMOTIONS):
+        columns[f"{emotion}_std"] = pa.array(table.values[:, i, 1], pa.float64())
+    arrow_table = pa.table(columns)
+    
+    tmp_path = f"{path}.tmp"
+    if is_parquet(path):
+        import pyarrow.parquet as pq
+        pq.write_table(arrow_table, tmp_path)
+    else:
+        with pa.OSFile(tmp_path, 'wb') as sink, pa.ipc.new_file(sink, arrow_table.schema) as writer:
+            writer.write_table(arrow_table)
+    os.replace(tmp_path, path)
+
+def read_columnar(path):
+    """Load an EmotionTable; Arrow IPC files are memory-mapped rather than read"""
+    pa = require_pyarrow()
+    
+    def to_table(arrow_table):
+        values = np.stack([arrow_table.column(f"{emotion}_{metric}").to_numpy()
+                           for emotion in EMOTIONS for metric in ('mean', 'std')], axis=1)
+        # Files written before the meta and audio columns existed have nothing to restore from them
+        meta, audio = (arrow_table.column(name).to_numpy(zero_copy_only=False)
+                       if name in arrow_table.column_names else None for name in ("meta", "audio"))
+        return EmotionTable(arrow_table.column("song_id").to_pylist(),
+                            values.reshape(len(arrow_table), len(EMOTIONS), 2),
+                            arrow_table.column("model").to_numpy(zero_copy_only=False),
+                            arrow_table.column("prompt_hash").to_numpy(zero_copy_only=False), meta, audio)
+    
+    if is_parquet(path):
+        import pyarrow.parquet as pq
+        return to_table(pq.read_table(path, memory_map=True))
+    with pa.memory_map(str(path), 'r') as source:
+        return to_table(pa.ipc.open_file(source).read_all())
+
+def load_results(path):
+    """Load gemini_output.json-style data from JSON or a columnar file, as an EmotionTable"""
+    if Path(path).suffix.lower() == '.json':
+        with open(path, 'r') as f:
+            return EmotionTable.from_json(json.load(f))
+    return read_columnar(path)
+
+def convert_results(src, dst):
+    """Convert between the JSON result format and a columnar file, picked by file extension"""
+    table = load_results(src)
+    if Path(dst).suffix.lower() == '.json':
+        save_gemini_data(table.to_json(), dst)
+    else:
+        write_columnar(dst, table)
+    return table
+
+def merge_results(saved, new):
+    """saved results (a dict or an EmotionTable) with new rows replacing or added to them"""
+    if isinstance(saved, EmotionTable):
+        return saved.update(new)
+    return {**saved, **new}
+
+def saved_problems(data, listeners):
+    """{song_id: description} for saved rows (a dict or an EmotionTable) with a missing or out-of-range emotion"""
+    songs = data.invalid_rows(listeners) if isinstance(data, EmotionTable) else data.keys()
+    problems = {}
+    for song_id in songs:
+        answer = GemsAnswer.from_object(data[song_id], n_listeners=listeners.get(song_id))
+        if answer.missing():
+            problems[song_id] = answer.describe()
+    return problems
+
+def stale_rows(data, listeners, backend="api", audio=None):
+    """{song_id: reason} for saved rows (a dict or an EmotionTable) that this run wouldn't reproduce"""
+    songs = (data.changed_rows(listeners, backend == "api", audio) if isinstance(data, EmotionTable)
+             else data.keys())
+    reasons = {}
+    for song_id in songs:
+        reason = stale_reason(data[song_id], listeners.get(song_id), backend, audio)
+        if reason:
+            reasons[song_id] = reason
+    return reasons
+
+def select_emotions(data, song_ids):
+    if isinstance(data, EmotionTable):
+        return data.select(song_ids)
+    return emotion_array(data, song_ids)
+
+def write_comparison_csv(path, songs, metric, sources, values):
+    """Write rows exactly as DataFrame.to_csv(index=False) would, without its per-cell formatting overhead.
+
+    Floats are written with repr(), which is what pandas produces for float64 columns.
+    """
+    with open(path, 'w', newline='') as f:
+        f.write(','.join(['song', 'metric', 'source'] + EMOTIONS) + os.linesep)
+        for song, source, row in zip(songs.tolist(), sources.tolist(), values.tolist()):
+            f.write(f"{song},{metric},{source},{','.join(map(repr, row))}{os.linesep}")
+
+def create_comparison_csvs(emotify_data, gemini_data, paths=('means_comparison.csv', 'stds_comparison.csv'),
+                           labels=('gemini', 'emotify')):
+    """Create two CSV files comparing emotify and gemini data (JSON-shaped dicts or EmotionTables).
+
+    paths and labels let other pairs share the format, e.g. excerpt vs full-track predictions,
+    with emotify_data as the reference and diff = gemini_data - emotify_data.
+    """
     # Sort songs by number
     sorted_songs = sorted(emotify_data.keys(), key=lambda x: int(x.split('_')[1]))
+    song_ids = [song for song in sorted_songs if song in gemini_data]
+    if not song_ids:
+        means_df, stds_df = pd.DataFrame(), pd.DataFrame()
+        means_df.to_csv(paths[0], index=False)
+        stds_df.to_csv(paths[1], index=False)
+        return means_df, stds_df
     
-    for song in sorted_songs:
-        if song not in gemini_data:
-            continue
-            
-        # Means - Gemini
-        gemini_mean_row = {'song': song, 'metric': 'mean', 'source': 'gemini'}
-        for emotion in emotions:
-            gemini_mean_row[emotion] = gemini_data[song][emotion]['mean']
-        means_data.append(gemini_mean_row)
-        
-        # Means - Emotify
-        emotify_mean_row = {'song': song, 'metric': 'mean', 'source': 'emotify'}
-        for emotion in emotions:
-            emotify_mean_row[emotion] = emotify_data[song][emotion]['mean']
-        means_data.append(emotify_mean_row)
-        
-        # Means - Diff (Gemini - Emotify)
-        diff_mean_row = {'song': song, 'metric': 'mean', 'source': 'diff'}
-        for emotion in emotions:
-            diff = gemini_data[song][emotion]['mean'] - emotify_data[song][emotion]['mean']
-            diff_mean_row[emotion] = round(diff, 4)
-        means_data.append(diff_mean_row)
-        
-        # Stds - Gemini
-        gemini_std_row = {'song': song, 'metric': 'std', 'source': 'gemini'}
-        for emotion in emotions:
-            gemini_std_row[emotion] = gemini_data[song][emotion]['std']
-        stds_data.append(gemini_std_row)
-        
-        # Stds - Emotify
-        emotify_std_row = {'song': song, 'metric': 'std', 'source': 'emotify'}
-        for emotion in emotions:
-            emotify_std_row[emotion] = emotify_data[song][emotion]['std']
-        stds_data.append(emotify_std_row)
-        
-        # Stds - Diff (Gemini - Emotify)
-        diff_std_row = {'song': song, 'metric': 'std', 'source': 'diff'}
-        for emotion in emotions:
-            diff = gemini_data[song][emotion]['std'] - emotify_data[song][emotion]['std']
-            diff_std_row[emotion] = round(diff, 4)
-        stds_data.append(diff_std_row)
-    
-    # Create DataFrames and save to CSV
-    means_df = pd.DataFrame(means_data)
-    stds_df = pd.DataFrame(stds_data)
-    
-    means_df.to_csv('means_comparison.csv', index=False)
-    stds_df.to_csv('stds_comparison.csv', index=False)
+    gemini = select_emotions(gemini_data, song_ids)
+    emotify = select_emotions(emotify_data, song_ids)
+    # Diff (Gemini - Emotify) for every song, emotion and metric in one subtraction
+    diff = round_like_python(gemini - emotify, 4)
+    
+    # Rows per song are gemini, emotify, diff
+    rows = np.stack([gemini, emotify, diff], axis=1).reshape(-1, len(EMOTIONS), 2)
+    songs = np.repeat(song_ids, 3)
+    sources = np.tile([*labels, 'diff'], len(song_ids))
+    
+    frames = []
+    for i, (metric, csv_path) in enumerate(zip(['mean', 'std'], paths)):
+        write_comparison_csv(csv_path, songs, metric, sources, rows[..., i])
+        df = pd.DataFrame(rows[..., i], columns=EMOTIONS)
+        df.insert(0, 'song', songs)
+        df.insert(1, 'metric', metric)
+        df.insert(2, 'source', sources)
+        frames.append(df)
+    means_df, stds_df = frames
     
     return means_df, stds_df
 
-def main():
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Estimate GEMS emotions with Gemini and compare against Emotify")
+    parser.add_argument("--backend", choices=["api", "local", "route"], default="api",
+                        help="'api' asks Gemini; 'local' uses a ridge model over local audio features trained on "
+                             "truth.json; 'route' answers locally where the local estimators agree and asks "
+                             "Gemini otherwise (default: api)")
+    parser.add_argument("--route-threshold", type=float, default=0.08,
+                        help="with --backend route, escalate songs whose local estimators disagree by more than "
+                             "this RMS difference in means (default: 0.08)")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of songs analyzed concurrently (default: 1)")
+    parser.add_argument("--async", dest="use_async", action="store_true",
+                        help="use the asyncio client with one pooled connection set instead of threads")
+    parser.add_argument("--max-in-flight", type=int, default=64,
+                        help="maximum concurrent requests in --async mode (default: 64)")
+    parser.add_argument("--excerpt", type=float, metavar="SECONDS",
+                        help="send at most this many seconds of each track, picked by energy and novelty")
+    parser.add_argument("--excerpt-window", type=float, default=10.0,
+                        help="length of each excerpt window in seconds (default: 10)")
+    parser.add_argument("--excerpt-dir", default=".cache/excerpts",
+                        help="where excerpts are cached (default: .cache/excerpts)")
+    parser.add_argument("--segments", type=float, metavar="SECONDS",
+                        help="analyze each song as segments of about this length, concurrently, and aggregate them")
+    parser.add_argument("--segment-align", choices=["fixed", "beats"], default="fixed",
+                        help="cut segments at fixed times or at the nearest estimated beat (default: fixed)")
+    parser.add_argument("--segment-dir", default=".cache/segments",
+                        help="where segments are cached (default: .cache/segments)")
+    parser.add_argument("--transcode", action="store_true",
+                        help="re-encode audio to low-bitrate mono Opus with ffmpeg before uploading")
+    parser.add_argument("--transcode-bitrate", default="16k", help="Opus bitrate for --transcode (default: 16k)")
+    parser.add_argument("--transcode-rate", type=int, default=16000, choices=[8000, 12000, 16000, 24000, 48000],
+                        help="sample rate for --transcode (default: 16000)")
+    parser.add_argument("--transcode-dir", default=".cache/transcoded",
+                        help="where transcoded audio is cached (default: .cache/transcoded)")
+    parser.add_argument("--upload", choices=["json", "multipart"], default="json",
+                        help="send audio base64-encoded in the JSON body, or as a raw multipart file part for "
+                             "gateways that accept one (default: json)")
+    parser.add_argument("--compress", choices=["gzip", "zstd"],
+                        help="compress request bodies with this Content-Encoding while they stream")
+    parser.add_argument("--stream", action="store_true",
+                        help="stream responses and stop reading once all nine emotions have arrived and validated")
+    parser.add_argument("--batch-size", type=int, default=1,
+                        help="send up to this many songs per request, answered as one keyed JSON object; needs "
+                             "--workers (or --max-in-flight) of at least this many to fill batches (default: 1)")
+    parser.add_argument("--batch-mb", type=float, default=15,
+                        help="cap on the audio in one batched request, in MB; base64 makes the body a third "
+                             "larger (default: 15)")
+    parser.add_argument("--hedge", type=float, metavar="PERCENTILE",
+                        help="send a second copy of a request still unanswered after this percentile of recent "
+                             "request latencies (e.g. 95) and keep the first valid answer")
+    parser.add_argument("--hedge-budget", type=float, default=0.1,
+                        help="cap on the extra requests --hedge sends, as a fraction of calls (default: 0.1)")
+    parser.add_argument("--rpm", type=float, help="client-side limit on requests per minute")
+    parser.add_argument("--tpm", type=float, help="client-side limit on estimated tokens per minute")
+    parser.add_argument("--max-retries", type=int, default=5,
+                        help="retries for 429/5xx/connection errors per song (default: 5)")
+    parser.add_argument("--cache-dir", default=".cache/responses",
+                        help="directory for cached API responses (default: .cache/responses)")
+    parser.add_argument("--cache-max-mb", type=float, default=512,
+                        help="evict least-recently-used cache entries beyond this size (default: 512)")
+    parser.add_argument("--no-cache", action="store_true", help="always call the API")
+    parser.add_argument("--no-coalesce", action="store_true",
+                        help="send songs with identical audio separately even while one of them is in flight")
+    parser.add_argument("--rerun", action="store_true",
+                        help="re-predict songs already in the output file (cached responses are still used)")
+    parser.add_argument("--output",
+                        help="where predictions are saved (default: gemini_output.json, or local_output.json "
+                             "with --backend local)")
+    parser.add_argument("--compare", nargs=2, metavar=("REFERENCE", "OTHER"),
+                        help="write comparison CSVs of two result files (JSON or columnar) and exit")
+    parser.add_argument("--columnar", metavar="PATH",
+                        help="also keep results in a columnar file (.arrow or .parquet); loaded instead of "
+                             "the --output file when it exists")
+    parser.add_argument("--convert", nargs=2, metavar=("SRC", "DST"),
+                        help="convert results between JSON and .arrow/.parquet (by extension) and exit")
+    parser.add_argument("--metrics-jsonl", metavar="PATH", help="append per-song stage timings as JSON lines")
+    parser.add_argument("--metrics-prom", metavar="PATH",
+                        help="write stage timing histograms in Prometheus text format at the end of the run")
+    parser.add_argument("--otel", action="store_true", help="emit OpenTelemetry spans per song and stage")
+    parser.add_argument("--pack", metavar="PATH",
+                        help="read audio from a pack file built with --build-pack instead of data/raw")
+    parser.add_argument("--build-pack", nargs=2, metavar=("DIR", "PACK"),
+                        help="pack the song_*.opus files in DIR into one indexed file and exit")
+    parser.add_argument("--dedupe", action="store_true",
+                        help="fingerprint the catalog and reuse one prediction per group of near-duplicate recordings")
+    parser.add_argument("--dedupe-threshold", type=float, default=0.03,
+                        help="minimum fingerprint similarity for --dedupe to link two songs (default: 0.03)")
+    parser.add_argument("--fingerprint-dir", default=".cache/fingerprints",
+                        help="where fingerprints are cached (default: .cache/fingerprints)")
+    parser.add_argument("--features", action="store_true",
+                        help="compute local acoustic features for every song that doesn't have them yet")
+    parser.add_argument("--feature-store", default=".cache/features.arrow",
+                        help="columnar feature cache keyed by audio hash (default: .cache/features.arrow)")
+    parser.add_argument("--manifest", default=".cache/manifest.sqlite",
+                        help="index of data/raw kept between runs (default: .cache/manifest.sqlite)")
+    parser.add_argument("--fsync-every", type=int, default=16,
+                        help="fsync the result journal after this many predictions (default: 16)")
+    args = parser.parse_args(argv)
+    if args.output is None:
+        args.output = "local_output.json" if args.backend == "local" else "gemini_output.json"
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+    if args.max_in_flight < 1:
+        parser.error("--max-in-flight must be at least 1")
+    if args.max_retries < 0:
+        parser.error("--max-retries must not be negative")
+    if args.fsync_every < 1:
+        parser.error("--fsync-every must be at least 1")
+    if args.route_threshold < 0:
+        parser.error("--route-threshold must not be negative")
+    if args.batch_size < 1 or args.batch_mb <= 0:
+        parser.error("--batch-size must be at least 1 and --batch-mb positive")
+    if args.batch_size > 1 and args.upload != "json":
+        parser.error("--batch-size needs --upload json")
+    if args.batch_size > 1 and args.stream:
+        parser.error("--stream can't be combined with --batch-size")
+    if args.hedge is not None and not (0 < args.hedge < 100 and args.hedge_budget > 0):
+        parser.error("--hedge must be between 0 and 100 and --hedge-budget positive")
+    if args.hedge is not None and args.batch_size > 1:
+        parser.error("--hedge can't be combined with --batch-size")
+    if args.excerpt is not None and (args.excerpt <= 0 or args.excerpt_window <= 0):
+        parser.error("--excerpt and --excerpt-window must be positive")
+    if args.segments is not None and args.segments <= 0:
+        parser.error("--segments must be positive")
+    if args.segments and args.excerpt:
+        parser.error("--segments and --excerpt can't be combined")
+    return args
+
+def predict_songs(jobs, workers, on_result, analyze=analyze_audio):
+    """Run analyze (analyze_audio by default) over (song_id, audio_file, n_listeners) jobs with at most `workers` in flight.
+
+    on_result(song_id, pred, error) is called from the calling thread as each song finishes,
+    so callers can update shared state without locking.
+    """
+    jobs = iter(jobs)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = {}
+
+        def submit_next():
+            job = next(jobs, None)
+            if job is None:
+                return False
+            song_id, audio_file, n_listeners = job
+            print(f"Processing {song_id}...")
+            pending[pool.submit(analyze, audio_file, n_listeners)] = song_id
+            return True
+
+        while len(pending) < workers and submit_next():
+            pass
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                song_id = pending.pop(future)
+                try:
+                    on_result(song_id, future.result(), None)
+                except Exception as e:
+                    on_result(song_id, None, e)
+                submit_next()
+
+async def predict_songs_async(jobs, max_in_flight, on_result, analyze=analyze_audio_async, max_connections=None):
+    """Asyncio counterpart of predict_songs: max_in_flight tasks share one pooled client.
+
+    analyze is awaited as analyze(client, audio_file, n_listeners). The client holds
+    max_connections connections (default: max_in_flight). jobs may be an async iterator,
+    e.g. one that does blocking work off the event loop.
+    """
+    if hasattr(jobs, "__anext__"):
+        lock = asyncio.Lock()
+        
+        async def next_job():
+            # One task at a time may advance an async generator
+            async with lock:
+                try:
+                    return await jobs.__anext__()
+                except StopAsyncIteration:
+                    return None
+    else:
+        jobs = iter(jobs)
+        
+        async def next_job():
+            return next(jobs, None)
+    
+    async def worker(client):
+        while True:
+            job = await next_job()
+            if job is None:
+                return
+            song_id, audio_file, n_listeners = job
+            print(f"Processing {song_id}...")
+            try:
+                pred = await analyze(client, audio_file, n_listeners)
+            except Exception as e:
+                on_result(song_id, None, e)
+            else:
+                on_result(song_id, pred, None)
+    
+    async with make_async_client(max_connections or max_in_flight) as client:
+        await asyncio.gather(*(worker(client) for _ in range(max_in_flight)))
+
+def run_predictions(jobs, args, on_result, on_segments=None, local_backend=None):
+    """Predict jobs through the client stack selected by the command-line args.
+
+    With --segments, each job is split and its segments go through the stack as separate
+    jobs; on_segments(song_id, series) receives the per-segment predictions. local_backend
+    (a LocalBackend) replaces the API call, scheduler and response cache for --backend local,
+    and sits in front of them as a Router for --backend route.
+    Returns (label, component) pairs for every component with a stats() summary.
+    """
+    local_only = args.backend == "local"
+    cache = None if args.no_cache or local_only else ResponseCache(args.cache_dir, int(args.cache_max_mb * 1e6))
+    router = Router(local_backend, args.route_threshold) if args.backend == "route" else None
+    concurrency = args.max_in_flight if args.use_async else args.workers
+    # Hedges are requests on top of the one per song in flight, so they get slots of their own. A
+    # thread can't cancel the copy that lost, which holds its slot until answered, so there every
+    # song may have two copies in flight; otherwise new songs would queue behind stalled losers
+    hedge_slots = 0
+    if args.hedge:
+        hedge_slots = math.ceil(concurrency * args.hedge_budget) + 1 if args.use_async else concurrency
+    scheduler = RequestScheduler(concurrency + hedge_slots, args.rpm, args.tpm, args.max_retries)
+    coalescer = None if args.no_coalesce or local_only else SingleFlight()
+    excerpter = transcoder = segmenter = batcher = hedger = None
+    responses = ResponseStats()
+    if args.segments:
+        segmenter = Segmenter(args.segment_dir, args.segments, args.segment_align)
+        jobs, on_result = segment_jobs(jobs, segmenter, on_result, on_segments, args.use_async)
+    if args.excerpt:
+        excerpter = Excerpter(args.excerpt_dir, args.excerpt, args.excerpt_window)
+    if args.transcode:
+        transcoder = Transcoder(args.transcode_dir, args.transcode_bitrate, args.transcode_rate)
+    metrics = StageMetrics(args.metrics_jsonl)
+    if args.otel:
+        enable_tracing()
+    try:
+        # Layers from the outside in: timing, routing, coalescing, excerpting, transcoding, response cache,
+        # hedging or batching, scheduler, API call
+        if args.use_async and not local_only:
+            api = functools.partial(analyze_audio_async, upload=args.upload, compress=args.compress, stream=args.stream,
+                                    responses=responses)
+            if args.batch_size > 1:
+                batch = functools.partial(analyze_batch_async, compress=args.compress, responses=responses)
+                batcher = RequestBatcher(scheduler, api, batch, args.batch_size, int(args.batch_mb * 1e6))
+                analyze = batcher.analyze_async
+            elif args.hedge:
+                hedger = RequestHedger(scheduler, api, args.hedge, args.hedge_budget)
+                analyze = hedger.analyze_async
+            else:
+                analyze = functools.partial(scheduler.call_async, api)
+            if cache:
+                analyze = functools.partial(analyze_audio_cached_async, cache, analyze=analyze)
+            if transcoder:
+                analyze = functools.partial(analyze_audio_transcoded_async, transcoder, analyze=analyze)
+            if excerpter:
+                analyze = functools.partial(analyze_audio_excerpted_async, excerpter, analyze=analyze)
+            if coalescer:
+                analyze = functools.partial(coalescer.analyze_async, analyze=analyze)
+            if router:
+                analyze = functools.partial(router.analyze_async, analyze=analyze)
+            analyze = functools.partial(measure_stages_async, metrics, analyze)
+            asyncio.run(predict_songs_async(jobs, args.max_in_flight, on_result, analyze, concurrency + hedge_slots))
+        else:
+            if local_only:
+                analyze = local_backend.analyze
+            else:
+                api = functools.partial(analyze_audio, upload=args.upload, compress=args.compress, stream=args.stream,
+                                        responses=responses)
+                if args.batch_size > 1:
+                    batch = functools.partial(analyze_batch, compress=args.compress, responses=responses)
+                    batcher = RequestBatcher(scheduler, api, batch, args.batch_size, int(args.batch_mb * 1e6))
+                    analyze = batcher.analyze
+                elif args.hedge:
+                    hedger = RequestHedger(scheduler, api, args.hedge, args.hedge_budget, args.workers + hedge_slots)
+                    analyze = hedger.analyze
+                else:
+                    analyze = functools.partial(scheduler.call, api)
+                if cache:
+                    analyze = functools.partial(analyze_audio_cached, cache, analyze=analyze)
+            if transcoder:
+                analyze = functools.partial(analyze_audio_transcoded, transcoder, analyze=analyze)
+            if excerpter:
+                analyze = functools.partial(analyze_audio_excerpted, excerpter, analyze=analyze)
+            if coalescer:
+                analyze = functools.partial(coalescer.analyze, analyze=analyze)
+            if router:
+                analyze = functools.partial(router.analyze, analyze=analyze)
+            analyze = functools.partial(measure_stages, metrics, analyze)
+            predict_songs(jobs, args.workers, on_result, analyze)
+    finally:
+        metrics.close()
+        if hedger:
+            hedger.close()
+        if args.metrics_prom:
+            with open(args.metrics_prom, 'w') as f:
+                f.write(metrics.prometheus())
+    
+    # The local model's training summary was printed when it was trained
+    components = [] if local_only else [("Scheduler", scheduler), ("Responses", responses)]
+    if router:
+        components.insert(0, ("Router", router))
+    if batcher:
+        components.append(("Batcher", batcher))
+    if hedger:
+        components.append(("Hedger", hedger))
+    if excerpter:
+        components.append(("Excerpter", excerpter))
+    if segmenter:
+        components.append(("Segmenter", segmenter))
+    if transcoder:
+        components.append(("Transcoder", transcoder))
+    if cache:
+        components.append(("Response cache", cache))
+    if coalescer:
+        components.append(("Coalescing", coalescer))
+    components.append(("Stage timings", metrics))
+    return components
+
+def save_gemini_data(gemini_data, gemini_output_file):
+    """Atomically replace gemini_output_file; keys are sorted so output doesn't depend on completion order"""
+    tmp_file = f"{gemini_output_file}.tmp"
+    with open(tmp_file, 'w') as f:
+        json.dump(dict(sorted(gemini_data.items())), f, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_file, gemini_output_file)
+
+class ResultJournal:
+    """Append-only JSONL log of predictions that is compacted into gemini_output.json.
+
+    Each prediction costs one appended line instead of a rewrite of every result so far.
+    Lines are fsynced in batches of fsync_every. On replay, lines that don't decode (a torn
+    write from a crash) are skipped and counted in dropped; the records around them are kept.
+    """
+    
+    def __init__(self, path, fsync_every=16):
+        self.path = Path(path)
+        self.fsync_every = fsync_every
+        self.dropped = 0
+        self._file = None
+        self._unsynced = 0
+    
+    def replay(self):
+        records = {}
+        if not self.path.exists():
+            return records
+        with open(self.path, 'rb') as f:
+            lines = f.read().splitlines(keepends=True)
+        good = []
+        for line in lines:
+            try:
+                record = json.loads(line)
+                records[record["song_id"]] = record["prediction"]
+            except (json.JSONDecodeError, UnicodeDecodeError, TypeError, KeyError):
+                self.dropped += 1
+                continue
+            good.append(line if line.endswith(b"\n") else line + b"\n")
+        # Rewrite without the bad lines, and with a final newline, so new appends start on a clean line
+        if self.dropped or (lines and not lines[-1].endswith(b"\n")):
+            tmp_path = self.path.with_suffix(".tmp")
+            with open(tmp_path, 'wb') as f:
+                f.writelines(good)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+        return records
+    
+    def append(self, song_id, pred):
+        if self._file is None:
+            self._file = open(self.path, 'a')
+        self._file.write(json.dumps({"song_id": song_id, "prediction": pred}) + "\n")
+        self._file.flush()
+        self._unsynced += 1
+        if self._unsynced >= self.fsync_every:
+            self.sync()
+    
+    def sync(self):
+        if self._file is not None and self._unsynced:
+            os.fsync(self._file.fileno())
+            self._unsynced = 0
+    
+    def close(self):
+        if self._file is not None:
+            self.sync()
+            self._file.close()
+            self._file = None
+    
+    def compact(self, gemini_data, gemini_output_file):
+        """Write the merged results atomically, then drop the journal they came from"""
+        self.close()
+        save_gemini_data(gemini_data, gemini_output_file)
+        self.path.unlink(missing_ok=True)
+
+def ogg_opus_duration(path):
+    """Duration in seconds from the Ogg page headers (last granule position minus pre-skip), or None"""
+    with audio_buffer(path) as data:
+        head = bytes(data[:64])
+        if not head.startswith(b"OggS") or b"OpusHead" not in head:
+            return None
+        pre_skip = int.from_bytes(head[head.index(b"OpusHead") + 10:][:2], 'little')
+        tail = bytes(data[max(0, len(data) - 65536):])
+    last_page = tail.rfind(b"OggS")
+    if last_page < 0 or len(tail) < last_page + 14:
+        return None
+    granule = int.from_bytes(tail[last_page + 6:last_page + 14], 'little')
+    return max(0, granule - pre_skip) / 48000
+
+PACK_MAGIC = b"GEMSPAK1"
+PACK_INDEX_DTYPE = np.dtype([("song_id", "S48"), ("offset", "<u8"), ("length", "<u8"), ("sha256", "S32")])
+PACK_FOOTER = struct.Struct("<QQ8s")  # index offset, record count, magic
+
+class PackedAudio:
+    """One song's audio inside an AudioPack: a zero-copy slice of the mapped file plus its sha256"""
+    
+    __slots__ = ("pack_path", "song_id", "data", "sha256")
+    
+    def __init__(self, pack_path, song_id, data, sha256):
+        self.pack_path, self.song_id, self.data, self.sha256 = pack_path, song_id, data, sha256
+    
+    def __len__(self):
+        return len(self.data)
+    
+    def __str__(self):
+        return f"{self.pack_path}#{self.song_id}"
+
+def song_number(song_id):
+    match = re.fullmatch(r"song_(\d+)", song_id)
+    return int(match.group(1)) if match else None
+
+def write_pack(data_dir, pack_path):
+    """Pack every song_*.opus in data_dir into one file; returns (songs, bytes of audio).
+
+    Layout: magic, the audio files back to back in song number order, an index of fixed-size
+    (song_id, offset, length, sha256) records sorted by song_id, then a footer pointing at the
+    index. The file is written beside pack_path and renamed into place.
+    """
+    sources = sorted((path for path in Path(data_dir).glob("song_*.opus")),
+                     key=lambda path: (song_number(path.stem) is None, song_number(path.stem) or 0, path.stem))
+    index = np.zeros(len(sources), dtype=PACK_INDEX_DTYPE)
+    tmp_path = f"{pack_path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(PACK_MAGIC)
+        for record, source in zip(index, sources):
+            song_id = source.stem.encode('utf-8')
+            if len(song_id) > PACK_INDEX_DTYPE["song_id"].itemsize:
+                raise ValueError(f"song id too long for the pack index: {source.stem}")
+            data = source.read_bytes()
+            record["song_id"], record["offset"], record["length"] = song_id, f.tell(), len(data)
+            record["sha256"] = hashlib.sha256(data).digest()
+            f.write(data)
+        index.sort(order="song_id")
+        index_offset = f.tell()
+        f.write(index.tobytes())
+        f.write(PACK_FOOTER.pack(index_offset, len(index), PACK_MAGIC))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, pack_path)
+    return len(index), int(index["length"].sum())
+
+class AudioPack:
+    """Read side of a pack file written by write_pack.
+
+    The whole file is memory-mapped once and its index is viewed in place, so a lookup is a
+    binary search over song ids and get() returns a slice of the mapping: no open, read or
+    copy per song. Slices stay valid while they are referenced.
+    """
+    
+    def __init__(self, path):
+        self.path = Path(path)
+        with open(self.path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        index_offset, count, magic = PACK_FOOTER.unpack(self._mmap[-PACK_FOOTER.size:])
+        if self._mmap[:len(PACK_MAGIC)] != PACK_MAGIC or magic != PACK_MAGIC:
+            self._mmap.close()
+            raise ValueError(f"{path} is not an audio pack")
+        self._view = memoryview(self._mmap)
+        self.index = np.frombuffer(self._mmap, dtype=PACK_INDEX_DTYPE, count=count, offset=index_offset)
+    
+    def __len__(self):
+        return len(self.index)
+    
+    def _find(self, song_id):
+        key = song_id.encode('utf-8')
+        i = int(np.searchsorted(self.index["song_id"], key))
+        if i == len(self.index) or self.index["song_id"][i] != key:
+            return None
+        return self.index[i]
+    
+    def __contains__(self, song_id):
+        return self._find(song_id) is not None
+    
+    def get(self, song_id):
+        record = self._find(song_id)
+        if record is None:
+            raise KeyError(song_id)
+        offset, length = int(record["offset"]), int(record["length"])
+        return PackedAudio(self.path, song_id, self._view[offset:offset + length], record["sha256"].hex())
+    
+    def song_ids(self):
+        """Every song id, in song number order like SongManifest.todo"""
+        ids = [song_id.decode('utf-8') for song_id in self.index["song_id"]]
+        return sorted(ids, key=lambda song_id: (song_number(song_id) is None, song_number(song_id) or 0, song_id))
+    
+    def close(self):
+        self.index = None
+        self._view.release()
+        try:
+            self._mmap.close()
+        except BufferError:
+            # Slices handed out by get() are still alive; the mapping goes when they do
+            pass
+
+class SongManifest:
+    """SQLite index of the audio files in a data directory: song_id, path, size, mtime, sha256, duration.
+
+    refresh() makes one os.scandir pass and only hashes and probes files whose size or mtime
+    changed, so a run over an unchanged catalog costs a stat per file instead of a read.
+    """
+    
+    def __init__(self, db_path):
+        Path(db_path).parent.mkdir(parents=True, exist_ok=True)
+        self.db = sqlite3.connect(db_path)
+        self.db.execute("""CREATE TABLE IF NOT EXISTS songs (
+            song_id TEXT PRIMARY KEY, song_num INTEGER, path TEXT NOT NULL, size INTEGER NOT NULL,
+            mtime_ns INTEGER NOT NULL, sha256 TEXT NOT NULL, duration REAL)""")
+        self.db.execute("CREATE INDEX IF NOT EXISTS songs_order ON songs (song_num, song_id)")
+    
+    def refresh(self, data_dir, workers=16):
+        """Sync the index with data_dir; returns (added, changed, removed) counts"""
+        known = {row[0]: row[1:] for row in self.db.execute("SELECT song_id, path, size, mtime_ns FROM songs")}
+        seen, stale = set(), []
+        with os.scandir(data_dir) as entries:
+            for entry in entries:
+                if not (entry.name.startswith("song_") and entry.name.endswith(".opus")):
+                    continue
+                song_id = entry.name[:-len(".opus")]
+                stat = entry.stat()
+                seen.add(song_id)
+                if known.get(song_id) != (entry.path, stat.st_size, stat.st_mtime_ns):
+                    stale.append((song_id, entry.path, stat.st_size, stat.st_mtime_ns))
+        
+        def probe(item):
+            song_id, path, size, mtime_ns = item
+            return (song_id, song_number(song_id), path, size, mtime_ns,
+                    file_sha256(path), ogg_opus_duration(path))
+        
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            rows = list(pool.map(probe, stale))
+        removed = [(song_id,) for song_id in known if song_id not in seen]
+        with self.db:
+            self.db.executemany("INSERT OR REPLACE INTO songs VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+            self.db.executemany("DELETE FROM songs WHERE song_id = ?", removed)
+        
+        for path, size, mtime_ns, sha in self.db.execute("SELECT path, size, mtime_ns, sha256 FROM songs"):
+            _known_hashes[(path, size, mtime_ns)] = sha
+        added = sum(1 for song_id, *_ in stale if song_id not in known)
+        return added, len(stale) - added, len(removed)
+    
+    def count(self):
+        return self.db.execute("SELECT COUNT(*) FROM songs").fetchone()[0]
+    
+    def todo(self, done_ids=()):
+        """(song_id, path) for every indexed song not in done_ids, in song number order"""
+        self.db.execute("CREATE TEMP TABLE IF NOT EXISTS done (song_id TEXT PRIMARY KEY)")
+        self.db.execute("DELETE FROM done")
+        self.db.executemany("INSERT OR IGNORE INTO done VALUES (?)", ((song_id,) for song_id in done_ids))
+        return [(song_id, Path(path)) for song_id, path in self.db.execute(
+            """SELECT s.song_id, s.path FROM songs s LEFT JOIN done d ON d.song_id = s.song_id
+               WHERE d.song_id IS NULL ORDER BY s.song_num, s.song_id""")]
+    
+    def close(self):
+        self.db.close()
+
+def main(argv=None):
+    args = parse_args(argv)
     data_dir = Path("data/raw")
-    gemini_output_file = "gemini_output.json"
+    gemini_output_file = args.output
+    journal = ResultJournal(Path(gemini_output_file).with_suffix(".journal.jsonl"), args.fsync_every)
+    
+    if args.build_pack:
+        count, size = write_pack(*args.build_pack)
+        print(f"Packed {count} songs ({size / 1e6:.1f} MB) from {args.build_pack[0]} into {args.build_pack[1]}")
+        return
     
     try:
         truth_data, listeners = load_ground_truth_and_listeners()
@@ -170,46 +3431,186 @@ def main():
         print(f"Error: {e}")
         return
     
-    # Load existing Gemini data if available
-    gemini_data = {}
-    if Path(gemini_output_file).exists():
+    if args.convert:
+        table = convert_results(*args.convert)
+        print(f"Converted {len(table)} songs from {args.convert[0]} to {args.convert[1]}")
+        return
+    
+    if args.compare:
+        reference, other = (load_results(path) for path in args.compare)
+        labels = [Path(path).stem for path in reversed(args.compare)]
+        paths = [f"{metric}_{labels[0]}_vs_{labels[1]}.csv" for metric in ("means", "stds")]
+        means_df, stds_df = create_comparison_csvs(reference, other, paths, labels)
+        print(f"Created {paths[0]} with {len(means_df)} rows")
+        print(f"Created {paths[1]} with {len(stds_df)} rows")
+        return
+    
+    # Load existing Gemini data if available. A columnar file stays an EmotionTable, so only
+    # the rows main() looks at are turned into dicts
+    saved = {}
+    if args.columnar and Path(args.columnar).exists():
+        saved = read_columnar(args.columnar)
+        print(f"Loaded existing Gemini data for {len(saved)} songs from {args.columnar}")
+    elif Path(gemini_output_file).exists():
         with open(gemini_output_file, 'r') as f:
-            gemini_data = json.load(f)
-        print(f"Loaded existing Gemini data for {len(gemini_data)} songs")
+            saved = json.load(f)
+        print(f"Loaded existing Gemini data for {len(saved)} songs")
     
-    # Process audio files and get Gemini predictions
-    for audio_file in data_dir.glob("song_*.opus"):
-        song_id = audio_file.stem
-        
+    # Recover predictions from a run that stopped before compacting its journal
+    replayed = journal.replay()
+    if replayed:
+        saved = merge_results(saved, replayed)
+        print(f"Replayed {len(replayed)} predictions from {journal.path}")
+    if journal.dropped:
+        print(f"Warning: skipped {journal.dropped} unreadable lines in {journal.path}")
+    
+    # Rows saved before replies were validated may be incomplete or out of range. They are kept,
+    # since they may be paid-for answers that are only slightly off; --rerun predicts them again
+    invalid = saved_problems(saved, listeners)
+    if invalid:
+        print(f"Warning: {len(invalid)} saved songs have incomplete or out-of-range results (kept; --rerun "
+              f"predicts every song again):")
+        for song_id, problems in invalid.items():
+            print(f"  {song_id}: {problems}")
+    
+    # Per-segment time series live next to the output file, with their own journal
+    segment_data, segment_journal, segments_replayed = {}, None, {}
+    if args.segments:
+        segments_file = Path(gemini_output_file).with_suffix(".segments.json")
+        segment_journal = ResultJournal(segments_file.with_suffix(".journal.jsonl"), args.fsync_every)
+        if segments_file.exists():
+            with open(segments_file, 'r') as f:
+                segment_data = json.load(f)
+        segments_replayed = segment_journal.replay()
+        segment_data.update(segments_replayed)
+    
+    # Rows from another model, prompt or audio preparation are predicted again, as the cache
+    # would miss on them; an API run also escalates rows that --backend route answered locally
+    stale = {} if args.rerun else stale_rows(saved, listeners, args.backend, audio_settings(args))
+    if stale:
+        print(f"Re-predicting {len(stale)} saved songs from another model, prompt, backend or audio settings:")
+        for song_id, reason in stale.items():
+            print(f"  {song_id}: {reason}")
+    
+    # Collect audio files that still need Gemini predictions
+    done = set() if args.rerun else set(saved.keys()) - stale.keys()
+    if args.pack:
+        pack = AudioPack(args.pack)
+        n_songs = len(pack)
+        print(f"Pack: {n_songs} songs in {args.pack}")
+        catalog = [(song_id, pack.get(song_id)) for song_id in pack.song_ids()]
+        todo = [(song_id, audio) for song_id, audio in catalog if song_id not in done]
+    else:
+        manifest = SongManifest(args.manifest)
+        added, changed, removed = manifest.refresh(data_dir)
+        n_songs = manifest.count()
+        print(f"Manifest: {n_songs} songs ({added} new, {changed} changed, {removed} removed)")
+        todo = manifest.todo(done)
+        catalog = manifest.todo() if args.dedupe or args.features or args.backend != "api" else []
+        manifest.close()
+    if n_songs > len(todo):
+        print(f"Skipping {n_songs - len(todo)} songs: already processed")
+    
+    local_backend = None
+    if args.features or args.backend != "api":
+        store = FeatureStore(args.feature_store)
+        store.compute(catalog)
+        print(f"Features: {store.stats()}")
+        if args.backend != "api":
+            local_backend = LocalBackend(store, truth_data, catalog)
+            print(f"Local model: {local_backend.stats()}")
+    
+    # Near-duplicates of a song that is already predicted, or about to be, reuse its prediction
+    duplicates = {}
+    if args.dedupe:
+        fingerprints = FingerprintIndex(args.fingerprint_dir, args.dedupe_threshold)
+        duplicates = fingerprints.duplicates(catalog, prefer=saved.keys())
+        print(f"Fingerprints: {fingerprints.stats()}")
+    
+    jobs, deferred = [], []
+    for song_id, audio_file in todo:
         if song_id not in truth_data or song_id not in listeners:
             print(f"Skipping {song_id}: no truth data or listener count")
             continue
-            
-        if song_id in gemini_data:
-            print(f"Skipping {song_id}: already processed")
-            continue
         
-        print(f"Processing {song_id}...")
-        try:
-            n_listeners = listeners[song_id]
-            pred = analyze_audio(audio_file, n_listeners)
-            gemini_data[song_id] = pred
-            
-            # Save after each successful prediction
-            with open(gemini_output_file, 'w') as f:
-                json.dump(gemini_data, f, indent=2)
-            
-            print(f"  Successfully processed {song_id}")
-            
-        except Exception as e:
-            print(f"  Error processing {song_id}: {e}")
+        if song_id in duplicates:
+            deferred.append((song_id, audio_file, listeners[song_id]))
+        else:
+            jobs.append((song_id, audio_file, listeners[song_id]))
+    
+    # Predictions made in this run; merged with saved ones when the output is written
+    gemini_data = {}
+    queued = {song_id for song_id, _, _ in jobs}
+    waiting, linked, sent, orphaned = {}, 0, 0, []
+    for job in deferred:
+        song_id = job[0]
+        canonical, similarity = duplicates[song_id]
+        if canonical in queued:
+            waiting.setdefault(canonical, []).append(song_id)
+        elif canonical in saved:
+            gemini_data[song_id] = link_duplicate(saved[canonical], canonical, similarity, listeners[song_id])
+            journal.append(song_id, gemini_data[song_id])
+            linked += 1
+        else:
+            # The canonical member can't be predicted in this run, so this one is sent itself
+            jobs.append(job)
+            sent += 1
+    if deferred:
+        print(f"Reusing predictions for {len(deferred) - sent} near-duplicates "
+              f"({linked} now, the rest once their canonical song is predicted)")
+    
+    def on_result(song_id, pred, error):
+        if error is not None:
+            print(f"  Error processing {song_id}: {error}")
+            # Near-duplicates waiting on this song stay unpredicted, so the next run picks them up
+            for duplicate in waiting.pop(song_id, ()):
+                orphaned.append(duplicate)
+                print(f"  Skipped near-duplicate {duplicate}: its canonical song {song_id} failed")
+            return
+        gemini_data[song_id] = pred
+        
+        # Journal each successful prediction; the output file is rewritten once at the end
+        journal.append(song_id, pred)
+        print(f"  Successfully processed {song_id}")
+        for duplicate in waiting.pop(song_id, ()):
+            gemini_data[duplicate] = link_duplicate(pred, song_id, duplicates[duplicate][1], listeners[duplicate])
+            journal.append(duplicate, gemini_data[duplicate])
+            print(f"  Reused {song_id} for near-duplicate {duplicate}")
+    
+    def on_segments(song_id, series):
+        segment_data[song_id] = series
+        segment_journal.append(song_id, series)
+    
+    components = []
+    try:
+        components = run_predictions(jobs, args, on_result, on_segments, local_backend)
+    finally:
+        gemini_data = merge_results(saved, gemini_data)
+        if jobs or replayed or linked:
+            journal.compact(gemini_data.to_json() if isinstance(gemini_data, EmotionTable) else gemini_data,
+                            gemini_output_file)
+        if segment_journal and (jobs or segments_replayed):
+            segment_journal.compact(segment_data, segments_file)
+        if args.columnar and (jobs or replayed or linked or not Path(args.columnar).exists()):
+            write_columnar(args.columnar, gemini_data if isinstance(gemini_data, EmotionTable)
+                           else EmotionTable.from_json(gemini_data))
+    if jobs:
+        for label, component in components:
+            print(f"{label}: {component.stats()}")
+    if orphaned:
+        print(f"Skipped {len(orphaned)} near-duplicates whose canonical song failed ({', '.join(orphaned)}); "
+              f"the next run tries them again")
     
     # Create comparison CSV files
     if gemini_data:
         print(f"\nCreating comparison files with {len(gemini_data)} songs...")
-        means_df, stds_df = create_comparison_csvs(truth_data, gemini_data)
-        print(f"Created means_comparison.csv with {len(means_df)} rows")
-        print(f"Created stds_comparison.csv with {len(stds_df)} rows")
+        # Results saved elsewhere get their own CSVs instead of overwriting the default pair
+        suffix = "" if gemini_output_file == "gemini_output.json" else f"_{Path(gemini_output_file).stem}"
+        paths = [f"means_comparison{suffix}.csv", f"stds_comparison{suffix}.csv"]
+        labels = ({"local": "local", "route": "routed"}.get(args.backend, "gemini"), "emotify")
+        means_df, stds_df = create_comparison_csvs(truth_data, gemini_data, paths, labels)
+        print(f"Created {paths[0]} with {len(means_df)} rows")
+        print(f"Created {paths[1]} with {len(stds_df)} rows")
     else:
         print("No Gemini data available to create comparison files")
 
@@ -0,0 +1,77 @@
+import random
+import shutil
+import sys
+import threading
+from pathlib import Path
+
+import pytest
+
+REPO = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(REPO))
+
+import mock_server  # noqa: E402
+import music  # noqa: E402
+
+
+@pytest.fixture
+def mock(monkeypatch):
+    """Start an in-process mock server and point music.py at it; returns a function taking MockHandler options"""
+    servers = []
+
+    def start(**options):
+        random.seed(0)
+        server = mock_server.make_server(port=0, **options)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        monkeypatch.setattr(music, "OPENROUTER_URL", f"http://127.0.0.1:{server.server_address[1]}/v1/chat/completions")
+        return server
+
+    monkeypatch.setenv("OPENROUTER_API_KEY", "test")
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+@pytest.fixture
+def run_main(tmp_path, monkeypatch):
+    """Run music.main() in a fresh directory holding the sample clips (or only songs) and truth.json;
+    returns that directory
+    """
+    runs = iter(range(1000))
+
+    def run(*argv, songs=None):
+        workdir = tmp_path / f"run{next(runs)}"
+        (workdir / "data").mkdir(parents=True)
+        if songs is None:
+            (workdir / "data" / "raw").symlink_to(REPO / "data" / "raw")
+        else:
+            (workdir / "data" / "raw").mkdir()
+            for song_id in songs:
+                shutil.copy(REPO / "data" / "raw" / f"{song_id}.opus", workdir / "data" / "raw")
+        shutil.copy(REPO / "truth.json", workdir)
+        monkeypatch.chdir(workdir)
+        music.main(["--no-cache", *argv])
+        return workdir
+
+    return run
+
+
+def request_count(server):
+    """Requests the mock server has answered (or seen cancelled) so far"""
+    return server.RequestHandlerClass.stats.snapshot()["requests"]
+
+
+@pytest.fixture(scope="session")
+def catalog():
+    """(song_id, path) for every sample clip, in song number order"""
+    paths = (REPO / "data" / "raw").glob("song_*.opus")
+    return sorted(((path.stem, path) for path in paths), key=lambda song: music.song_number(song[0]))
+
+
+@pytest.fixture(scope="session")
+def feature_store_path(tmp_path_factory, catalog):
+    """A feature store holding every sample clip, computed once per session; copy it before writing"""
+    path = tmp_path_factory.mktemp("features") / "features.arrow"
+    music.FeatureStore(path).compute(catalog)
+    return path
@@ -0,0 +1,62 @@
+import json
+
+import music
+from conftest import request_count
+
+SONGS = ["song_1", "song_2", "song_3"]
+
+
+def run_again(workdir, *argv):
+    music.main(["--no-cache", *argv])
+    return json.loads((workdir / "gemini_output.json").read_text())
+
+
+def test_audio_settings_follow_the_layer_order():
+    args = music.parse_args(["--segments", "20", "--transcode"])
+    assert music.audio_settings(args) == "segments-20s-fixed+transcode-1ch-16000hz-16k"
+    assert music.audio_settings(music.parse_args(["--excerpt", "30"])) == "excerpt-30s-10w"
+    assert music.audio_settings(music.parse_args([])) is None
+    pred = music.mark_audio(music.mark_audio({"_meta": music.provenance(20)}, "transcode-x"), "excerpt-y")
+    assert pred["_meta"]["audio"] == "excerpt-y+transcode-x"
+
+
+def test_stale_reason_compares_audio_settings():
+    pred = music.mark_audio({"_meta": music.provenance(20)}, "excerpt-20s-10w")
+    assert music.stale_reason(pred, 20, audio="excerpt-20s-10w") is None
+    assert music.stale_reason(pred, 20) == "audio excerpt-20s-10w"
+    assert music.stale_reason({"_meta": music.provenance(20)}, 20, audio="excerpt-20s-10w") == "whole-track audio"
+    data = {"song_1": pred, "song_2": {"_meta": music.provenance(20)}}
+    table = music.EmotionTable.from_json(data)
+    listeners = {"song_1": 20, "song_2": 20}
+    for audio in (None, "excerpt-20s-10w", "transcode-1ch-16000hz-16k"):
+        assert music.stale_rows(table, listeners, audio=audio) == music.stale_rows(data, listeners, audio=audio)
+
+
+def test_excerpt_rows_are_replaced_by_a_whole_track_run(mock, run_main):
+    server = mock()
+    workdir = run_main("--excerpt", "20", songs=SONGS)
+    rows = json.loads((workdir / "gemini_output.json").read_text())
+    assert {row["_meta"]["audio"] for row in rows.values()} == {"excerpt-20s-10w"}
+    before = request_count(server)
+    run_again(workdir, "--excerpt", "20")
+    assert request_count(server) == before
+    rows = run_again(workdir)
+    assert request_count(server) == before + len(SONGS)
+    assert not any("audio" in row["_meta"] for row in rows.values())
+    run_again(workdir)
+    assert request_count(server) == before + len(SONGS)
+
+
+def test_segment_and_transcode_settings_are_recorded(mock, run_main):
+    server = mock()
+    workdir = run_main("--segments", "20", "--transcode", songs=SONGS)
+    rows = json.loads((workdir / "gemini_output.json").read_text())
+    assert {row["_meta"]["audio"] for row in rows.values()} == {"segments-20s-fixed+transcode-1ch-16000hz-16k"}
+    before = request_count(server)
+    run_again(workdir, "--segments", "20", "--transcode")
+    assert request_count(server) == before
+    run_again(workdir, "--segments", "20")
+    segments = request_count(server) - before
+    assert segments > len(SONGS)
+    run_again(workdir, "--segments", "20", "--columnar", "out.arrow")
+    assert request_count(server) == before + segments
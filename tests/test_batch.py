@@ -0,0 +1,48 @@
+import json
+
+import pytest
+
+import music
+from conftest import request_count
+
+
+def emotions(rows):
+    return {song_id: {emotion: row[emotion] for emotion in music.EMOTIONS} for song_id, row in rows.items()}
+
+
+def test_split_batch_content():
+    value = music.gems_from_means([0.5] * 9)
+    clips = [("a.opus", 20), ("b.opus", 30), ("c.opus", 40)]
+    labels = ["clip_1", "clip_2", "clip_3"]
+    content = json.dumps({"clip_1": value, "clip_2": {"power": value["power"]}})
+    first, second, third = music.split_batch_content(content, labels, clips)
+    assert second is None and third is None
+    assert first["_meta"]["prompt_hash"] == music.prompt_hash(20)
+    assert first["_meta"]["batch_prompt_hash"] != first["_meta"]["prompt_hash"]
+    assert music.split_batch_content("no JSON here", labels, clips) == [None] * 3
+
+
+@pytest.mark.parametrize("use_async", [False, True])
+def test_batches_answer_like_single_requests(mock, run_main, use_async, capsys):
+    server = mock()
+    single = json.loads((run_main("--workers", "8") / "gemini_output.json").read_text())
+    before = request_count(server)
+    argv = ["--async", "--max-in-flight", "16"] if use_async else ["--workers", "16"]
+    workdir = run_main("--batch-size", "4", *argv)
+    batched = json.loads((workdir / "gemini_output.json").read_text())
+    assert emotions(batched) == emotions(single)
+    assert request_count(server) - before < 40
+    assert all("batch_prompt_hash" in row["_meta"] for row in batched.values())
+    assert "Responses: 40 complete" in capsys.readouterr().out
+    # Rows from batches stay current for single-song runs
+    music.main(["--no-cache", "--workers", "8"])
+    assert "Re-predicting" not in capsys.readouterr().out
+
+
+def test_dropped_clips_are_retried_alone(mock, run_main):
+    mock()
+    single = json.loads((run_main("--workers", "8") / "gemini_output.json").read_text())
+    mock(batch_drop_rate=0.3)
+    batched = json.loads((run_main("--batch-size", "4", "--workers", "16") / "gemini_output.json").read_text())
+    assert emotions(batched) == emotions(single)
+    assert any("batch_prompt_hash" not in row["_meta"] for row in batched.values())
@@ -0,0 +1,48 @@
+import json
+
+import pytest
+
+from test_pipeline import read_outputs
+
+import mock_server
+import music
+from conftest import REPO
+
+SONG = REPO / "data" / "raw" / "song_1.opus"
+
+
+@pytest.mark.parametrize("size", [0, 1, music.B64_CHUNK_SIZE - 1, music.B64_CHUNK_SIZE + 1])
+def test_streamed_body_matches_json_dumps(tmp_path, size):
+    audio = tmp_path / "clip.opus"
+    audio.write_bytes(bytes(range(256)) * (size // 256) + bytes(size % 256))
+    body = music.PayloadBody(audio, 20)
+    data = b"".join(body)
+    assert data == json.dumps(music.build_payload(audio, 20)).encode()
+    assert len(body) == len(data)
+
+
+def test_in_memory_audio_streams_like_the_file():
+    assert b"".join(music.PayloadBody(SONG.read_bytes(), 20)) == b"".join(music.PayloadBody(SONG, 20))
+
+
+@pytest.mark.parametrize("encoding", ["gzip", "zstd"])
+def test_compressed_body_decodes_to_the_payload(encoding, monkeypatch):
+    monkeypatch.setenv("OPENROUTER_API_KEY", "test")
+    body, headers = music.with_headers(music.PayloadBody(SONG, 20), encoding)
+    assert headers["Content-Encoding"] == encoding and "Content-Length" not in headers
+    data = mock_server.decode_body(b"".join(body), encoding)
+    assert data == json.dumps(music.build_payload(SONG, 20)).encode()
+
+
+def test_multipart_body_carries_raw_audio():
+    body = music.MultipartBody(SONG, 20)
+    data = b"".join(body)
+    assert len(body) == len(data)
+    assert mock_server.parse_multipart(data, body.content_type) == music.build_payload(SONG, 20)
+
+
+@pytest.mark.parametrize("argv", [["--compress", "gzip"], ["--compress", "zstd"], ["--upload", "multipart"],
+                                  ["--upload", "multipart", "--compress", "gzip", "--async"]])
+def test_upload_options_give_identical_output(mock, run_main, argv):
+    mock()
+    assert read_outputs(run_main("--workers", "8", *argv)) == read_outputs(run_main("--workers", "8"))
@@ -0,0 +1,71 @@
+import json
+import os
+
+import music
+from conftest import request_count
+
+
+def prediction(song):
+    return {"amazement": {"mean": 0.5, "std": 0.5}, "song": song}
+
+
+def test_least_recently_used_entry_is_evicted(tmp_path):
+    size = len(json.dumps(prediction("a")))
+    cache = music.ResponseCache(tmp_path, 3 * size)
+    for key in ("aa", "bb", "cc"):
+        cache.put(key, prediction(key[0]))
+    assert cache.get("aa") == prediction("a")
+    cache.put("dd", prediction("d"))
+    assert cache.evictions == 1
+    assert cache.get("bb") is None
+    assert [cache.get(key)["song"] for key in ("aa", "cc", "dd")] == ["a", "c", "d"]
+
+
+def test_recency_survives_a_restart(tmp_path):
+    size = len(json.dumps(prediction("a")))
+    cache = music.ResponseCache(tmp_path, 3 * size)
+    for i, key in enumerate(("aa", "bb", "cc")):
+        cache.put(key, prediction(key[0]))
+        os.utime(cache._path(key), (1000 + i, 1000 + i))
+    # A smaller budget on restart evicts the entry written first
+    cache = music.ResponseCache(tmp_path, 2 * size)
+    assert cache.evictions == 1
+    assert cache.get("aa") is None and cache.get("bb") is not None
+
+
+def test_stale_reason():
+    pred = {"_meta": music.provenance(20)}
+    assert music.stale_reason(pred, 20) is None
+    assert music.stale_reason(pred, 21) == "prompt changed"
+    assert music.stale_reason({"_meta": {**pred["_meta"], "model": "other/model"}}, 20) == "model other/model"
+    # Rows saved before provenance was recorded are kept
+    assert music.stale_reason({}, 20) is None
+
+
+def test_rerun_only_predicts_rows_from_another_model(mock, run_main):
+    server = mock()
+    workdir = run_main("--workers", "8")
+    output = workdir / "gemini_output.json"
+    data = json.loads(output.read_text())
+    data["song_1"]["_meta"]["model"] = "other/model"
+    del data["song_2"]["_meta"]
+    output.write_text(json.dumps(data))
+    before = request_count(server)
+    music.main(["--no-cache", "--workers", "8"])
+    assert request_count(server) == before + 1
+    rerun = json.loads(output.read_text())
+    assert rerun["song_1"]["_meta"]["model"] == music.MODEL_NAME
+    assert "_meta" not in rerun["song_2"]
+    music.main(["--no-cache", "--workers", "8"])
+    assert request_count(server) == before + 1
+
+
+def test_cached_responses_answer_a_rerun(mock, run_main):
+    server = mock()
+    workdir = run_main("--workers", "8")
+    before = request_count(server)
+    expected = json.loads((workdir / "gemini_output.json").read_text())
+    music.main(["--workers", "8", "--rerun"])
+    music.main(["--workers", "8", "--rerun"])
+    assert request_count(server) == before + 40
+    assert json.loads((workdir / "gemini_output.json").read_text()) == expected
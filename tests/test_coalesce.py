@@ -0,0 +1,56 @@
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import music
+
+
+class CountingCall:
+    def __init__(self, error=None):
+        self.calls = 0
+        self.error = error
+        self._lock = threading.Lock()
+
+    def __call__(self, audio, n_listeners):
+        with self._lock:
+            self.calls += 1
+        time.sleep(0.2)
+        if self.error:
+            raise self.error
+        return {"audio": bytes(audio), "n": n_listeners}
+
+
+def run_together(flight, analyze, jobs):
+    with ThreadPoolExecutor(len(jobs)) as pool:
+        futures = [pool.submit(flight.analyze, audio, n, analyze=analyze) for audio, n in jobs]
+        return [future.result() for future in futures]
+
+
+def test_concurrent_identical_requests_share_one_call():
+    flight, api = music.SingleFlight(), CountingCall()
+    results = run_together(flight, api, [(b"same", 20)] * 4 + [(b"same", 21), (b"other", 20)])
+    assert api.calls == 3 and flight.coalesced == 3
+    assert results[:4] == [{"audio": b"same", "n": 20}] * 4
+    # Each song gets its own copy
+    assert len({id(result) for result in results[:4]}) == 4
+
+
+def test_waiting_songs_get_the_error():
+    flight, api = music.SingleFlight(), CountingCall(music.APIError(500))
+    with pytest.raises(music.APIError):
+        run_together(flight, api, [(b"same", 20)] * 3)
+    assert api.calls == 1
+
+
+@pytest.mark.parametrize("argv,coalesced", [([], True), (["--no-coalesce"], False)])
+def test_coalescing_is_timed_apart_from_the_cache(mock, run_main, argv, coalesced):
+    mock()
+    workdir = run_main("--workers", "8", "--metrics-jsonl", "timings.jsonl", *argv)
+    stages = set()
+    for line in (workdir / "timings.jsonl").read_text().splitlines():
+        stages.update(json.loads(line)["stages"])
+    assert "cache" not in stages
+    assert ("coalesce" in stages) == coalesced
@@ -0,0 +1,36 @@
+import json
+import subprocess
+
+import music
+from conftest import request_count
+
+
+def test_linked_copy_records_its_own_prompt():
+    pred = {"_meta": music.provenance(48)}
+    copy = music.link_duplicate(pred, "song_1", 0.5, 47)
+    assert copy["_meta"] == {**music.provenance(47), "duplicate_of": "song_1", "similarity": 0.5}
+    assert music.stale_reason(copy, 47) is None
+    local = {"_meta": {"backend": "local", "model": music.LocalBackend.MODEL}}
+    assert "prompt_hash" not in music.link_duplicate(local, "song_1", 0.5, 47)["_meta"]
+
+
+def test_second_run_repredicts_nothing(mock, run_main, capsys):
+    server = mock()
+    workdir = run_main("--workers", "8", songs=["song_1", "song_2", "song_3"])
+    # song_2 becomes a re-encode of song_1, whose listener count differs
+    raw = workdir / "data" / "raw"
+    subprocess.run(["ffmpeg", "-v", "error", "-y", "-i", str(raw / "song_1.opus"), "-c:a", "libopus", "-b:a", "24k",
+                    str(raw / "song_2.opus")], check=True)
+    for name in ("gemini_output.json", "out.parquet"):
+        (workdir / name).unlink(missing_ok=True)
+    before = request_count(server)
+    music.main(["--no-cache", "--workers", "8", "--dedupe", "--columnar", "out.parquet"])
+    rows = json.loads((workdir / "gemini_output.json").read_text())
+    assert rows["song_2"]["_meta"]["duplicate_of"] == "song_1"
+    assert request_count(server) == before + 2
+    capsys.readouterr()
+    for argv in (["--dedupe"], ["--dedupe", "--columnar", "out.parquet"], [], ["--columnar", "out.parquet"]):
+        music.main(["--no-cache", "--workers", "8", *argv])
+        assert "Re-predicting" not in capsys.readouterr().out
+    assert request_count(server) == before + 2
+    assert json.loads((workdir / "gemini_output.json").read_text()) == rows
@@ -0,0 +1,33 @@
+import shutil
+
+import numpy as np
+
+import music
+
+
+def test_features_are_computed_once_per_distinct_audio(tmp_path, catalog):
+    store = music.FeatureStore(tmp_path / "features.arrow")
+    songs = catalog[:2] + [("copy_of_1", catalog[0][1])]
+    X = store.compute(songs)
+    assert X.shape == (3, len(music.FEATURES)) and np.isfinite(X).all()
+    assert (store.computed, store.cached) == (2, 1)
+    np.testing.assert_array_equal(X[0], X[2])
+    reloaded = music.FeatureStore(tmp_path / "features.arrow")
+    np.testing.assert_array_equal(reloaded.compute(songs), X)
+    assert (reloaded.computed, reloaded.cached) == (0, 3)
+
+
+def test_store_matches_a_fresh_extraction(tmp_path, catalog, feature_store_path):
+    shutil.copy(feature_store_path, tmp_path / "features.arrow")
+    store = music.FeatureStore(tmp_path / "features.arrow")
+    X = store.compute(catalog)
+    assert store.computed == 0 and X.shape == (len(catalog), len(music.FEATURES))
+    np.testing.assert_allclose(X[4], music._features_for(catalog[4][1]))
+
+
+def test_new_feature_version_rebuilds_the_store(tmp_path, catalog, feature_store_path, monkeypatch):
+    shutil.copy(feature_store_path, tmp_path / "features.arrow")
+    monkeypatch.setattr(music, "FEATURE_VERSION", "test")
+    store = music.FeatureStore(tmp_path / "features.arrow")
+    store.compute(catalog[:1])
+    assert store.computed == 1 and len(store.hashes) == 1
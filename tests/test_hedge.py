@@ -0,0 +1,78 @@
+import asyncio
+import threading
+import time
+
+import music
+from conftest import request_count
+from test_pipeline import read_outputs
+
+
+class SlowFirstCopy:
+    """Stand-in API call that answers at once, except the first copy of a request for b"slow" stalls"""
+
+    def __init__(self):
+        self.slow_calls = 0
+        self._lock = threading.Lock()
+
+    def _stall(self, audio):
+        with self._lock:
+            self.slow_calls += audio == b"slow"
+            return audio == b"slow" and self.slow_calls == 1
+
+    def __call__(self, audio, n_listeners):
+        time.sleep(2 if self._stall(audio) else 0.01)
+        return {"audio": audio}
+
+    async def call_async(self, client, audio, n_listeners):
+        await asyncio.sleep(2 if self._stall(audio) else 0.01)
+        return {"audio": audio}
+
+
+def warm_up(hedger, analyze):
+    for i in range(music.RequestHedger.min_samples):
+        analyze(f"fast-{i}".encode(), 20)
+    assert hedger.hedges == 0
+
+
+def test_hedge_wins_over_a_stalled_copy():
+    api = SlowFirstCopy()
+    hedger = music.RequestHedger(music.RequestScheduler(4), api, 90, budget=1.0)
+    warm_up(hedger, hedger.analyze)
+    start = time.perf_counter()
+    assert hedger.analyze(b"slow", 20) == {"audio": b"slow"}
+    assert time.perf_counter() - start < 1
+    assert (hedger.hedges, hedger.hedge_wins, hedger.abandoned) == (1, 1, 1)
+    hedger.close()
+
+
+def test_async_hedge_cancels_the_loser():
+    api = SlowFirstCopy()
+    hedger = music.RequestHedger(music.RequestScheduler(4), api.call_async, 90, budget=1.0)
+
+    async def run():
+        for i in range(music.RequestHedger.min_samples):
+            await hedger.analyze_async(None, f"fast-{i}".encode(), 20)
+        start = time.perf_counter()
+        assert await hedger.analyze_async(None, b"slow", 20) == {"audio": b"slow"}
+        return time.perf_counter() - start
+
+    assert asyncio.run(run()) < 1
+    assert (hedger.hedges, hedger.hedge_wins, hedger.cancelled) == (1, 1, 1)
+    hedger.close()
+
+
+def test_budget_caps_hedges():
+    api = SlowFirstCopy()
+    hedger = music.RequestHedger(music.RequestScheduler(4), api, 90, budget=0.01)
+    warm_up(hedger, hedger.analyze)
+    assert hedger.analyze(b"slow", 20) == {"audio": b"slow"}
+    assert hedger.hedges == 0
+    hedger.close()
+
+
+def test_hedged_run_gives_identical_output(mock, run_main):
+    mock()
+    expected = read_outputs(run_main("--workers", "8"))
+    server = mock(latency=0.02, slow_rate=0.2, slow_latency=1.0)
+    assert read_outputs(run_main("--workers", "8", "--hedge", "80", "--hedge-budget", "0.5")) == expected
+    assert request_count(server) > 40
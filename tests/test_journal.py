@@ -0,0 +1,57 @@
+import json
+
+import music
+
+
+def record(song_id):
+    return json.dumps({"song_id": song_id, "prediction": {"song": song_id}})
+
+
+def replay(path):
+    journal = music.ResultJournal(path)
+    return journal, journal.replay()
+
+
+def test_torn_tail_is_dropped(tmp_path):
+    path = tmp_path / "out.journal.jsonl"
+    path.write_text(record("a") + "\n" + record("b")[:20])
+    journal, records = replay(path)
+    assert list(records) == ["a"]
+    assert journal.dropped == 1
+    assert path.read_text() == record("a") + "\n"
+
+
+def test_last_record_without_newline_survives_the_next_append(tmp_path):
+    path = tmp_path / "out.journal.jsonl"
+    path.write_text(record("a"))
+    journal, records = replay(path)
+    assert list(records) == ["a"] and journal.dropped == 0
+    for song_id in "bcd":
+        journal.append(song_id, {"song": song_id})
+    journal.close()
+    journal, records = replay(path)
+    assert list(records) == ["a", "b", "c", "d"] and journal.dropped == 0
+
+
+def test_records_after_a_bad_line_are_kept(tmp_path):
+    path = tmp_path / "out.journal.jsonl"
+    path.write_text("\n".join([record("a"), record("b")[:20], record("c"), record("d")[:-1]]) + "\n")
+    journal, records = replay(path)
+    assert list(records) == ["a", "c"]
+    assert journal.dropped == 2
+    journal.append("e", {"song": "e"})
+    journal.close()
+    assert list(replay(path)[1]) == ["a", "c", "e"]
+
+
+def test_main_resumes_from_a_torn_journal(mock, run_main):
+    mock()
+    expected = json.loads((run_main("--workers", "8") / "gemini_output.json").read_text())
+    # A run that died after journaling three songs, the last one torn mid-line
+    workdir = run_main("--workers", "8")
+    (workdir / "gemini_output.json").unlink()
+    lines = [json.dumps({"song_id": song_id, "prediction": expected[song_id]}) for song_id in list(expected)[:3]]
+    (workdir / "gemini_output.journal.jsonl").write_text("\n".join(lines)[:-10])
+    music.main(["--no-cache", "--workers", "8"])
+    assert json.loads((workdir / "gemini_output.json").read_text()) == expected
+    assert not (workdir / "gemini_output.journal.jsonl").exists()
@@ -0,0 +1,81 @@
+import json
+import shutil
+
+import numpy as np
+import pytest
+
+import music
+from conftest import REPO, request_count
+
+
+@pytest.fixture
+def store(tmp_path, feature_store_path):
+    shutil.copy(feature_store_path, tmp_path / "features.arrow")
+    return music.FeatureStore(tmp_path / "features.arrow")
+
+
+@pytest.fixture
+def truth():
+    with open(REPO / "truth.json") as f:
+        return json.load(f)
+
+
+def test_truth_songs_get_leave_one_out_predictions(store, truth, catalog):
+    backend = music.LocalBackend(store, truth, catalog)
+    assert backend.trained_on == len(catalog)
+    means, disagreement = backend.estimate(catalog[0][1])
+    np.testing.assert_allclose(means, backend.model.loo_predictions[0])
+    assert disagreement >= 0
+    # A song outside the training set gets the full model's prediction
+    full = backend.model.predict(store.compute(catalog[:1]))[0]
+    assert not np.allclose(means, full)
+    pred = backend.analyze(catalog[0][1], 20)
+    assert pred["_meta"] == {"backend": "local", "model": music.LocalBackend.MODEL}
+    assert not music.GemsAnswer.from_object(pred).missing()
+
+
+def test_needs_three_truth_songs(store, truth, catalog):
+    with pytest.raises(RuntimeError):
+        music.LocalBackend(store, {song_id: truth[song_id] for song_id, _ in catalog[:2]}, catalog)
+
+
+def test_local_run_and_api_escalation(mock, run_main, store, capsys):
+    server = mock()
+    workdir = run_main("--backend", "local", "--feature-store", str(store.path))
+    assert capsys.readouterr().out.count("Local model:") == 1
+    rows = json.loads((workdir / "local_output.json").read_text())
+    assert len(rows) == 40 and request_count(server) == 0
+    assert (workdir / "means_comparison_local_output.csv").exists()
+    # An API run on the same output sends every locally answered song
+    music.main(["--no-cache", "--workers", "8", "--output", "local_output.json"])
+    assert request_count(server) == 40
+    rows = json.loads((workdir / "local_output.json").read_text())
+    assert {row["_meta"]["model"] for row in rows.values()} == {music.MODEL_NAME}
+
+
+def test_router_escalates_by_disagreement(store, truth, catalog):
+    backend = music.LocalBackend(store, truth, catalog)
+
+    def api(audio_path, n_listeners):
+        return {**music.gems_from_means([0.5] * 9), "_meta": music.provenance(n_listeners)}
+
+    disagreement = backend.estimate(catalog[0][1])[1]
+    pred = music.Router(backend, disagreement).analyze(catalog[0][1], 20, analyze=api)
+    assert pred["_meta"] == {"backend": "local", "model": music.LocalBackend.MODEL,
+                             "disagreement": round(disagreement, 4)}
+    pred = music.Router(backend, disagreement / 2).analyze(catalog[0][1], 20, analyze=api)
+    assert pred["_meta"] == {**music.provenance(20), "backend": "api", "disagreement": round(disagreement, 4)}
+
+
+def test_routed_run_resumes_without_requests(mock, run_main, store, capsys):
+    server = mock()
+    workdir = run_main("--backend", "route", "--workers", "8", "--feature-store", str(store.path))
+    rows = json.loads((workdir / "gemini_output.json").read_text())
+    local = [song_id for song_id, row in rows.items() if row["_meta"]["backend"] == "local"]
+    assert 0 < len(local) < 40 and request_count(server) == 40 - len(local)
+    music.main(["--no-cache", "--backend", "route", "--feature-store", str(store.path)])
+    assert request_count(server) == 40 - len(local)
+    assert "Re-predicting" not in capsys.readouterr().out
+    # An API run sends only the songs answered locally
+    music.main(["--no-cache", "--workers", "8"])
+    assert request_count(server) == 40
@@ -0,0 +1,41 @@
+import os
+import shutil
+
+import music
+from conftest import REPO
+
+
+def copy_songs(data_dir, numbers):
+    data_dir.mkdir(exist_ok=True)
+    for n in numbers:
+        shutil.copy(REPO / "data" / "raw" / f"song_{n}.opus", data_dir)
+
+
+def test_refresh_tracks_added_changed_and_removed_files(tmp_path):
+    data_dir = tmp_path / "raw"
+    copy_songs(data_dir, [1, 2, 10, 3])
+    manifest = music.SongManifest(tmp_path / "manifest.sqlite")
+    assert manifest.refresh(data_dir) == (4, 0, 0)
+    assert manifest.refresh(data_dir) == (0, 0, 0)
+    (data_dir / "song_2.opus").unlink()
+    copy_songs(data_dir, [4])
+    stat = os.stat(data_dir / "song_1.opus")
+    os.utime(data_dir / "song_1.opus", ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+    assert manifest.refresh(data_dir) == (1, 1, 1)
+    assert [song_id for song_id, _ in manifest.todo()] == ["song_1", "song_3", "song_4", "song_10"]
+    assert [song_id for song_id, _ in manifest.todo({"song_3", "song_9"})] == ["song_1", "song_4", "song_10"]
+    manifest.close()
+
+
+def test_index_persists_and_seeds_file_hashes(tmp_path):
+    data_dir = tmp_path / "raw"
+    copy_songs(data_dir, [1])
+    music.SongManifest(tmp_path / "manifest.sqlite").refresh(data_dir)
+    music._known_hashes.clear()
+    manifest = music.SongManifest(tmp_path / "manifest.sqlite")
+    assert manifest.refresh(data_dir) == (0, 0, 0)
+    assert manifest.count() == 1
+    path = data_dir / "song_1.opus"
+    stat = path.stat()
+    expected = music.file_sha256(REPO / "data" / "raw" / "song_1.opus")
+    assert music._known_hashes[(str(path), stat.st_size, stat.st_mtime_ns)] == expected
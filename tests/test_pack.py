@@ -0,0 +1,41 @@
+import hashlib
+import json
+
+import pytest
+
+import music
+from conftest import REPO, request_count
+
+
+def test_pack_round_trip(tmp_path):
+    raw = REPO / "data" / "raw"
+    count, size = music.write_pack(raw, tmp_path / "songs.pack")
+    sources = sorted(raw.glob("song_*.opus"))
+    assert count == len(sources) and size == sum(path.stat().st_size for path in sources)
+    pack = music.AudioPack(tmp_path / "songs.pack")
+    assert pack.song_ids()[:3] == ["song_1", "song_2", "song_3"]
+    for path in sources:
+        audio = pack.get(path.stem)
+        assert bytes(audio.data) == path.read_bytes()
+        assert music.file_sha256(audio) == hashlib.sha256(path.read_bytes()).hexdigest()
+    assert "song_1" in pack and "song_999" not in pack
+    with pytest.raises(KeyError):
+        pack.get("song_999")
+    pack.close()
+
+
+def test_rejects_other_files(tmp_path):
+    path = tmp_path / "not.pack"
+    path.write_bytes(b"x" * 64)
+    with pytest.raises(ValueError):
+        music.AudioPack(path)
+
+
+def test_run_from_a_pack_matches_data_raw(mock, run_main):
+    server = mock()
+    expected = (run_main("--workers", "8") / "gemini_output.json").read_text()
+    workdir = run_main("--build-pack", str(REPO / "data" / "raw"), "songs.pack")
+    before = request_count(server)
+    music.main(["--no-cache", "--workers", "8", "--pack", "songs.pack"])
+    assert request_count(server) == before + 40
+    assert json.loads((workdir / "gemini_output.json").read_text()) == json.loads(expected)
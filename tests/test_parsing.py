@@ -0,0 +1,110 @@
+import json
+
+import pytest
+
+import bench
+import music
+from conftest import REPO, request_count
+from test_pipeline import read_outputs
+
+# What parse_gems() should make of each reply type in bench.reply_corpus()
+EXPECTED = {
+    "bare JSON": "complete",
+    "indented JSON": "complete",
+    "code fence": "complete",
+    "prose around": "complete",
+    "long chatter after": "complete",
+    "cut off": "re-ask",
+    "out of range": "re-ask",
+    "emotion missing": "re-ask",
+    "brace in prose first": "complete",
+    "braces in strings": "complete",
+    "no JSON": "rejected",
+    "10 KB of '{'": "rejected",
+    "10 KB of '{\"'": "rejected",
+    "5 KB of '{ ' first": "complete",
+}
+
+
+def load_predictions(count=5):
+    with open(REPO / "gemini_output.json") as f:
+        results = {song_id: pred for song_id, pred in json.load(f).items()
+                   if all(emotion in pred for emotion in music.EMOTIONS)}
+    return dict(list(results.items())[:count])
+
+
+def load_corpus():
+    return bench.reply_corpus(load_predictions())
+
+
+def outcome(answer):
+    if not answer.missing():
+        return "complete"
+    return "re-ask" if answer.estimates else "rejected"
+
+
+def stream(reply, step):
+    """GemsAnswer from feeding reply to EmotionStreamParser step characters at a time"""
+    parser = music.EmotionStreamParser(music.GemsAnswer(n_listeners=20), stop_on_error=False)
+    for start in range(0, len(reply), step):
+        if parser.feed(reply[start:start + step]):
+            break
+    return parser.answer
+
+
+def test_corpus_covers_every_reply_type():
+    assert [name for name, _ in load_corpus()] == list(EXPECTED)
+
+
+@pytest.mark.parametrize("name,replies", load_corpus(), ids=list(EXPECTED))
+def test_parse_gems(name, replies):
+    preds = [{emotion: pred[emotion] for emotion in music.EMOTIONS} for pred in load_predictions().values()]
+    for i, reply in enumerate(replies):
+        answer = music.parse_gems(reply, n_listeners=20)
+        assert outcome(answer) == EXPECTED[name]
+        if EXPECTED[name] == "complete":
+            # Single-reply types are built from the first prediction
+            assert answer.prediction() == preds[i if len(replies) > 1 else 0]
+
+
+@pytest.mark.parametrize("name,replies", load_corpus(), ids=list(EXPECTED))
+def test_stream_parser_agrees_with_parse_gems(name, replies):
+    for reply in replies:
+        whole = music.parse_gems(reply, n_listeners=20)
+        for step in (1, 7, len(reply)):
+            streamed = stream(reply, step)
+            if EXPECTED[name] == "complete":
+                assert streamed.estimates == whole.estimates
+            else:
+                assert streamed.missing()
+
+
+def test_stream_event_guards():
+    result = music.StreamedResult(n_listeners=20)
+    assert not result.feed(b'data: {"choices": []}\n\n')
+    with pytest.raises(music.APIError) as error:
+        result.feed(b"data: {not json\n\n")
+    assert error.value.status_code == 502
+
+
+@pytest.mark.parametrize("argv", [["--workers", "8"], ["--async", "--max-in-flight", "8"]])
+def test_streamed_responses_give_identical_output(mock, run_main, argv):
+    server = mock(chatter_tokens=200)
+    expected = read_outputs(run_main(*argv))
+    assert read_outputs(run_main("--stream", *argv)) == expected
+    assert request_count(server) == 80
+
+
+def test_std_bound_follows_listener_count():
+    value = {"mean": 0.5, "std": 0.5244}
+    music.check_emotion("power", value, n_listeners=11)
+    with pytest.raises(music.OutputError):
+        music.check_emotion("power", value, n_listeners=40)
+
+
+def test_cut_off_replies_are_reasked(mock, run_main):
+    mock()
+    expected = read_outputs(run_main("--workers", "8"))
+    server = mock(truncate_rate=0.3, chatter_tokens=50)
+    assert read_outputs(run_main("--workers", "8")) == expected
+    assert request_count(server) > 40
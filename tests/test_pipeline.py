@@ -0,0 +1,20 @@
+import json
+
+OUTPUTS = ["gemini_output.json", "means_comparison.csv", "stds_comparison.csv"]
+
+
+def read_outputs(workdir):
+    return {name: (workdir / name).read_bytes() for name in OUTPUTS}
+
+
+def test_workers_give_identical_output(mock, run_main):
+    mock()
+    serial = read_outputs(run_main("--workers", "1"))
+    assert read_outputs(run_main("--workers", "8")) == serial
+    assert len(json.loads(serial["gemini_output.json"])) == 40
+
+
+def test_async_client_gives_identical_output(mock, run_main):
+    mock()
+    serial = read_outputs(run_main("--workers", "1"))
+    assert read_outputs(run_main("--async", "--max-in-flight", "8")) == serial
@@ -0,0 +1,58 @@
+import json
+
+import music
+from conftest import REPO, request_count
+
+
+def test_comparison_csvs_are_byte_identical(tmp_path, monkeypatch):
+    # The checked-in CSVs were written by pandas' DataFrame.to_csv from the checked-in predictions
+    monkeypatch.chdir(REPO)
+    truth_data, _ = music.load_ground_truth_and_listeners()
+    with open(REPO / "gemini_output.json") as f:
+        gemini_data = json.load(f)
+    paths = [tmp_path / "means.csv", tmp_path / "stds.csv"]
+    music.create_comparison_csvs(truth_data, gemini_data, [str(path) for path in paths])
+    assert paths[0].read_bytes() == (REPO / "means_comparison.csv").read_bytes()
+    assert paths[1].read_bytes() == (REPO / "stds_comparison.csv").read_bytes()
+
+
+def sample_rows():
+    with open(REPO / "gemini_output.json") as f:
+        data = dict(list(json.load(f).items())[:4])
+    songs = list(data)
+    data[songs[0]]["_meta"] = music.provenance(20)
+    data[songs[1]]["_meta"] = {**music.provenance(20), "backend": "api", "disagreement": 0.1}
+    data[songs[2]]["_meta"] = {"backend": "local", "model": music.LocalBackend.MODEL}
+    del data[songs[3]]["sadness"]
+    return data
+
+
+def test_columnar_round_trip(tmp_path):
+    data = sample_rows()
+    for name in ("out.arrow", "out.parquet"):
+        music.write_columnar(tmp_path / name, music.EmotionTable.from_json(data))
+        assert music.read_columnar(tmp_path / name).to_json() == data
+
+
+def test_table_update_and_stale_rows_match_the_dict_path():
+    data = sample_rows()
+    table = music.EmotionTable.from_json(data)
+    songs = list(data)
+    new = {songs[0]: {**data[songs[1]], "_meta": music.provenance(30)}, "song_new": data[songs[2]]}
+    assert table.update(new).to_json() == music.merge_results(data, new)
+    listeners = dict.fromkeys(songs, 20)
+    for backend in ("api", "route", "local"):
+        assert music.stale_rows(table, listeners, backend) == music.stale_rows(data, listeners, backend)
+    assert music.stale_rows(table, {**listeners, songs[0]: 21}) == {songs[0]: "prompt changed",
+                                                                     songs[2]: "answered locally"}
+
+
+def test_resume_from_columnar_file(mock, run_main):
+    server = mock()
+    workdir = run_main("--workers", "8", "--columnar", "out.parquet")
+    expected = (workdir / "gemini_output.json").read_text()
+    before = request_count(server)
+    (workdir / "gemini_output.json").unlink()
+    music.main(["--no-cache", "--workers", "8", "--columnar", "out.parquet"])
+    assert request_count(server) == before
+    assert music.load_results(workdir / "out.parquet").to_json() == json.loads(expected)
@@ -0,0 +1,44 @@
+import asyncio
+
+import music
+from conftest import request_count
+from test_pipeline import read_outputs
+
+
+def test_aimd_limit():
+    control = music.AIMDController(8, cooldown=60)
+    for _ in range(3):
+        control.acquire()
+    control.release(throttled=True)
+    control.release(throttled=True)
+    # Throttles within one cooldown count as a single congestion event
+    assert control.limit == 4
+    control.release(cancelled=True)
+    assert control.limit == 4
+    control.acquire()
+    control.release()
+    assert control.limit == 4.25
+
+
+def test_async_waiter_wakes_on_release():
+    control = music.AIMDController(1)
+
+    async def run():
+        control.acquire()
+        waiter = asyncio.create_task(control.acquire_async())
+        await asyncio.sleep(0.01)
+        assert not waiter.done()
+        control.release()
+        await asyncio.wait_for(waiter, 1)
+
+    asyncio.run(run())
+    assert control.in_flight == 1
+
+
+def test_throttled_requests_are_retried(mock, run_main):
+    mock()
+    expected = read_outputs(run_main("--workers", "8"))
+    server = mock(throttle_rate=0.3, retry_after=0.01)
+    assert read_outputs(run_main("--workers", "8", "--max-retries", "10")) == expected
+    assert server.RequestHandlerClass.stats.snapshot()["status"].get("429", 0) > 0
+    assert request_count(server) > 40